@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 import os
+import sys
+import time
 
 from flask_script import Manager
 from flask_script.commands import ShowUrls, Clean
+from itsdangerous import JSONWebSignatureSerializer
 
 from oniongate import create_app
 from oniongate.models import *
-from oniongate.dns import generate_zone_file
+from oniongate.models.domain import backfill_subdomains
+from oniongate.models.change import compact_changes as compact_change_log
+from oniongate.dns import generate_zone_file, sync_zone, sync_all_zones, write_zone
+from oniongate.dns_update import push_zone_updates
+from oniongate import bulk, dns_server, profiler, proxy_checker, scanner, snapshot, utils
 
 # default to dev config
 env = os.environ.get('ONIONGATE_ENV', 'dev')
-app = create_app('oniongate.settings.%sConfig' % env.capitalize())
+config_object = 'oniongate.settings.%sConfig' % env.capitalize()
+app = create_app(config_object)
 
 manager = Manager(app)
 manager.add_command("show-urls", ShowUrls())
@@ -36,6 +44,70 @@ def createdb():
     db.create_all()
 
 
+@manager.command
+def migrate_subdomains(batch_size=1000):
+    """
+    Add the stored subdomain label to an existing database and fill it in for every domain
+    """
+    count = backfill_subdomains(int(batch_size))
+    print("Filled in the subdomain of {} domains".format(count))
+
+
+@manager.command
+def compact_changes():
+    """
+    Remove the change log entries which are superseded by later changes or too old
+    """
+    removed = compact_change_log(app.config["CHANGES_COMPACT_AFTER"],
+                                 app.config["CHANGES_PURGE_DELETES_AFTER"])
+    print("Removed {} change log entries".format(removed))
+
+
+@manager.command
+def publish_snapshot():
+    """
+    Publish a snapshot of the domain to onion address mappings and the delta to it
+    """
+    manifest = snapshot.publish_snapshot()
+    print("Published version {} with {} mappings".format(manifest['version'],
+                                                       manifest['count']))
+
+
+@manager.command
+def import_domains(filename, format=None, chunk_size=1000):
+    """
+    Import domains from a JSON lines or CSV file, or '-' for stdin
+    """
+    format = format or bulk.file_format(filename)
+
+    def report(line_number, domain_name, message):
+        print("Row {} ({}): {}".format(line_number, domain_name, message), file=sys.stderr)
+
+    file_handler = sys.stdin if filename == '-' else open(filename, newline='')
+    try:
+        imported, skipped = bulk.import_domains(bulk.read_domains(file_handler, format),
+                                                report, chunk_size=int(chunk_size))
+    finally:
+        if file_handler is not sys.stdin:
+            file_handler.close()
+    print("Imported {} domains, skipped {}".format(imported, skipped), file=sys.stderr)
+
+
+@manager.command
+def export_domains(filename='-', format=None, chunk_size=1000):
+    """
+    Export all domains as JSON lines or CSV to a file, or '-' for stdout
+    """
+    format = format or bulk.file_format(filename)
+    file_handler = sys.stdout if filename == '-' else open(filename, 'w', newline='')
+    try:
+        count = bulk.export_domains(file_handler, format, chunk_size=int(chunk_size))
+    finally:
+        if file_handler is not sys.stdout:
+            file_handler.close()
+    print("Exported {} domains".format(count), file=sys.stderr)
+
+
 @manager.command
 def create_zone(zone_name):
     """
@@ -44,5 +116,106 @@ def create_zone(zone_name):
     print(generate_zone_file(zone_name))
 
 
+@manager.command
+def write_zone_file(zone_name):
+    """
+    Stream a BIND-style zone file with all records for a domain to the zone directory
+    """
+    write_zone(zone_name)
+
+
+@manager.command
+def sync_zone_file(zone_name, full=False):
+    """
+    Write the zone file for a domain to the zone directory, only loading changed records
+    """
+    sync_zone(zone_name, full=full)
+
+
+@manager.command
+def create_all_zones(processes=None, full=False):
+    """
+    Write the zone files for all zones in parallel, skipping zones which have not changed
+    """
+    start = time.time()
+    results = sync_all_zones(config_object, processes=processes and int(processes), full=full)
+    for zone_name, duration, error in sorted(results):
+        if error:
+            print("{}: failed after {:.2f}s: {}".format(zone_name, duration, error))
+        else:
+            print("{}: {:.2f}s".format(zone_name, duration))
+    print("Synced {} zones in {:.2f}s".format(len(results), time.time() - start))
+
+
+@manager.command
+def push_updates(zone_name):
+    """
+    Send records changed since the last sync to the nameserver as dynamic DNS updates
+    """
+    print("Sent {} update messages".format(push_zone_updates(zone_name)))
+
+
+@manager.command
+def serve_dns():
+    """
+    Answer DNS queries for all zones directly from the database
+    """
+    dns_server.serve(app)
+
+
+@manager.command
+def check_proxies(interval=None):
+    """
+    Check which entry proxies are online, repeating every `interval` seconds when it is set
+    """
+    while True:
+        checked, online, changed = proxy_checker.check_proxies()
+        print("Checked {} proxies, {} online, {} changed state".format(checked, online, changed))
+        if not interval:
+            break
+        time.sleep(float(interval))
+
+
+@manager.command
+def scan_services(interval=None):
+    """
+    Check which onion services are reachable, repeating every `interval` seconds when it is set
+    """
+    while True:
+        counts = scanner.scan_domains()
+        print("Scanned {} services, {} online, {} offline, {} failed".format(
+            sum(counts.values()), counts['online'], counts['offline'], counts['failed']))
+        if not interval:
+            break
+        time.sleep(float(interval))
+
+
+@manager.command
+def benchmark_auth(requests=10000):
+    """
+    Time the update token check per request, with a new serializer each time and cached
+    """
+    requests = int(requests)
+    with app.test_request_context():
+        token = utils.create_jwt({'domain': 'benchmark.oniongate.com'}).decode('utf-8')
+
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    with app.test_request_context(headers=headers):
+        started = time.perf_counter()
+        for _ in range(requests):
+            serializer = JSONWebSignatureSerializer(app.secret_key, algorithm_name='HS256')
+            serializer.loads(utils.read_auth_header())
+        uncached = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(requests):
+            utils.jwt_domain()
+        cached = time.perf_counter() - started
+
+    print("New serializer per request: {:.1f}us".format(uncached / requests * 1e6))
+    print("Cached serializer and token: {:.1f}us".format(cached / requests * 1e6))
+
+
 if __name__ == "__main__":
-    manager.run()
+    with profiler.profile_command(app, ' '.join(sys.argv[1:2]) or 'manage.py'):
+        manager.run()
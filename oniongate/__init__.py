@@ -5,8 +5,9 @@ from flask_restful import Api
 from flask_cors import CORS
 import humanize
 
-from .models import db
-from .resources import Domains, Records, Proxies
+from . import metrics, profiler
+from .models import db, mixins
+from .resources import Domains, Records, RecordBatch, Proxies, Changes, Snapshots
 from .main import main_bp
 
 
@@ -32,6 +33,10 @@ def create_app(object_name):
     app.config["zone_dir"] = zone_directory
 
     api_bp = Blueprint('api', __name__)
+    if app.config["UNIT_OF_WORK_PER_REQUEST"]:
+        # Commit the changes made by each API request once, after the request succeeds
+        api_bp.before_request(mixins.begin_unit_of_work)
+        api_bp.after_request(mixins.commit_request)
     api = Api(api_bp)
     CORS(app, resources={r"/api/*": {"origins": "*"}})
 
@@ -43,7 +48,15 @@ def create_app(object_name):
 
     api.add_resource(Domains, '/domains', '/domains/<domain_name>')
     api.add_resource(Records, '/records/<domain_name>', '/records/<domain_name>/<record_id>')
+    api.add_resource(RecordBatch, '/records/<domain_name>/batch')
     api.add_resource(Proxies, '/proxies', '/proxies/<ip_address>')
+    api.add_resource(Changes, '/changes')
+    api.add_resource(Snapshots, '/snapshots', '/snapshots/<filename>')
+
+    if app.config["METRICS_ENABLED"]:
+        metrics.init_app(app)
+    if app.config["SQL_PROFILER_ENABLED"]:
+        profiler.init_app(app)
 
     app.jinja_env.filters['naturaltime'] = humanize.naturaltime
 
@@ -0,0 +1,265 @@
+"""
+Import and export domains in bulk as JSON lines or CSV
+
+Both directions stream the rows a chunk at a time, so files with millions of domains can
+be moved in bounded memory.
+"""
+import csv
+import json
+import datetime
+import itertools
+
+from flask_restful import inputs
+from sqlalchemy import exc
+
+from . import validators
+from .suffixes import ownership_index, SuffixTrie
+from .models import db, Change, Domain
+
+# Columns written by the export and read back by the import
+EXPORT_FIELDS = ['domain_name', 'zone', 'onion_address', 'public', 'date_created']
+
+
+def file_format(filename, default='jsonl'):
+    """
+    Guess the format of a domain file from its extension
+    """
+    return 'csv' if filename.lower().endswith('.csv') else default
+
+
+class InvalidRow(object):
+    """
+    Marks a line of a domain file which could not be read, so it is reported and skipped
+    """
+    def __init__(self, message):
+        self.message = message
+
+
+def read_domains(file_handler, format='jsonl'):
+    """
+    Yield each domain in a JSON lines or CSV file as a dict, or an InvalidRow
+    """
+    if format == 'csv':
+        for row in csv.DictReader(file_handler):
+            yield row
+    else:
+        for line in file_handler:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield InvalidRow("The line is not valid JSON: {}".format(e))
+
+
+def string_field(row, name):
+    value = row.get(name)
+    if value is not None and not isinstance(value, str):
+        raise ValueError("The {} must be a string".format(name))
+    return (value or '').strip()
+
+
+def parse_zone_name(name, zone, rules):
+    """
+    Validate a name given with its own full domain zone, such as an exported domain
+
+    The zone is trusted instead of registration rules such as FQDN_REGISTRATION_CLOSED, so
+    domains added by the administrators can be imported again. It must still be a valid
+    domain which is allowed and not inside a zone which is already registered.
+    """
+    if name != zone and not name.endswith('.' + zone):
+        raise ValueError("{} is not inside its zone {}".format(name, zone))
+    if not validators.is_valid_hostname(name) or '.' not in zone:
+        raise ValueError("{} is not a valid domain name".format(name))
+    if name in rules.blacklisted_domains:
+        raise ValueError("The domain is not allowed")
+    if rules.public_suffixes.is_public_suffix(zone):
+        raise ValueError("{} is a public suffix and cannot be registered".format(zone))
+    owner = ownership_index().owner(zone)
+    if owner:
+        raise ValueError("{} is inside {} which is already registered".format(zone, owner))
+    return {'label': name[:-len(zone) - 1] or None, 'zone': zone}
+
+
+def parse_date(value):
+    """
+    Parse an ISO 8601 date as a naive UTC datetime, or return the current time without one
+    """
+    if not value:
+        return datetime.datetime.utcnow()
+    date = inputs.datetime_from_iso8601(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def parse_import_row(row, rules):
+    """
+    Validate an imported domain against the compiled registration rules and return the
+    values to insert
+
+    Subdomains of SUBDOMAIN_HOST are validated like a registration of their label. Names
+    given with another zone, as exported, are checked against that zone, and other names
+    are validated like a registration of the full domain.
+    """
+    if isinstance(row, InvalidRow):
+        raise ValueError(row.message)
+    if not isinstance(row, dict):
+        raise ValueError("Each domain must be an object")
+    name = string_field(row, 'domain_name').lower().rstrip('.')
+    zone = string_field(row, 'zone').lower().rstrip('.')
+    subdomain_suffix = '.' + rules.subdomain_host
+    if zone and zone != rules.subdomain_host:
+        parsed = parse_zone_name(name, zone, rules)
+    else:
+        if name.endswith(subdomain_suffix):
+            name = name[:-len(subdomain_suffix)]
+        elif zone:
+            raise ValueError("{} is not inside its zone {}".format(name, zone))
+        parsed = validators.parse_domain_name(name, rules)
+
+    onion_address = string_field(row, 'onion_address').lower() or None
+    if onion_address:
+        validators.onion_address(onion_address)
+
+    public = row.get('public')
+    if public is not None and not isinstance(public, (bool, str)):
+        raise ValueError("The public flag must be a boolean")
+    return {
+        'domain_name': "{}.{}".format(parsed["label"], parsed["zone"])
+                       if parsed["label"] else parsed["zone"],
+        'zone': parsed["zone"],
+        'onion_address': onion_address,
+        'public': True if public in (None, '') else inputs.boolean(public),
+        'date_created': parse_date(string_field(row, 'date_created')),
+    }
+
+
+def change_rows(mappings):
+    """
+    Return the change log entries for imported domains, to insert with them
+    """
+    return [{'kind': 'domain', 'action': 'create', 'key': mapping['domain_name'],
+             'data': json.dumps({'zone': mapping['zone'],
+                                 'onion_address': mapping['onion_address'],
+                                 'public': mapping['public']}, sort_keys=True)}
+            for mapping in mappings]
+
+
+def insert_domains(mappings):
+    """
+    Insert new domains with a single multi-row insert, returning the names which already exist
+
+    When another writer registers one of the names first the chunk is inserted a row at a
+    time instead, so only the conflicting rows are skipped.
+    """
+    names = [mapping['domain_name'] for mapping in mappings]
+    existing = set(name for name, in db.session.query(Domain.domain_name).
+                   filter(Domain.domain_name.in_(names)))
+    new_mappings = [mapping for mapping in mappings if mapping['domain_name'] not in existing]
+    if not new_mappings:
+        return existing
+
+    table = Domain.__table__
+    try:
+        db.session.execute(table.insert(), new_mappings)
+        Change.insert_rows(change_rows(new_mappings))
+        db.session.commit()
+    except exc.IntegrityError:
+        db.session.rollback()
+        for mapping in new_mappings:
+            try:
+                db.session.execute(table.insert(), mapping)
+                Change.insert_rows(change_rows([mapping]))
+                db.session.commit()
+            except exc.IntegrityError:
+                db.session.rollback()
+                existing.add(mapping['domain_name'])
+
+    index = ownership_index()
+    for mapping in new_mappings:
+        if mapping['domain_name'] == mapping['zone'] and mapping['domain_name'] not in existing:
+            index.add(mapping['domain_name'])
+    return existing
+
+
+def import_domains(rows, report, chunk_size=1000):
+    """
+    Validate and insert domains a chunk at a time
+
+    Problems are passed to `report(row number, domain name, message)` without stopping the
+    import. Returns the number of domains imported and the number skipped.
+    """
+    imported, skipped = 0, 0
+    rules = validators.domain_rules()
+    # Full domains accepted earlier in the import, which are not in the ownership index yet
+    accepted_zones = SuffixTrie()
+    rows = enumerate(rows, 1)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        mappings, line_numbers = [], {}
+        for line_number, row in chunk:
+            try:
+                mapping = parse_import_row(row, rules)
+            except ValueError as e:
+                report(line_number, row.get('domain_name') if isinstance(row, dict) else None,
+                       str(e))
+                skipped += 1
+                continue
+            if mapping['domain_name'] in line_numbers:
+                report(line_number, mapping['domain_name'], "Duplicate of row {}".format(
+                    line_numbers[mapping['domain_name']]))
+                skipped += 1
+                continue
+            zone = mapping['zone']
+            if zone != rules.subdomain_host:
+                owner = accepted_zones.find(zone)
+                if owner and owner[0] != zone:
+                    report(line_number, mapping['domain_name'],
+                           "{} is inside {} imported on row {}".format(zone, *owner))
+                    skipped += 1
+                    continue
+                if mapping['domain_name'] == zone:
+                    accepted_zones.add(zone, (zone, line_number))
+            line_numbers[mapping['domain_name']] = line_number
+            mappings.append(mapping)
+
+        if mappings:
+            existing = insert_domains(mappings)
+            for domain_name in sorted(existing, key=line_numbers.get):
+                report(line_numbers[domain_name], domain_name, "Domain already exists")
+            skipped += len(existing)
+            imported += len(mappings) - len(existing)
+    return imported, skipped
+
+
+def export_rows(chunk_size=1000):
+    """
+    Yield the exported columns of every live domain, streaming them from the database
+    """
+    columns = [getattr(Domain, field) for field in EXPORT_FIELDS]
+    query = db.session.query(*columns).filter(Domain.deleted == False).order_by(Domain.id)
+    for row in query.yield_per(chunk_size):
+        yield dict(zip(EXPORT_FIELDS, row))
+
+
+def export_domains(file_handler, format='jsonl', chunk_size=1000):
+    """
+    Write every live domain to a file as JSON lines or CSV, returning the number written
+    """
+    if format == 'csv':
+        writer = csv.DictWriter(file_handler, EXPORT_FIELDS)
+        writer.writeheader()
+
+    count = 0
+    for row in export_rows(chunk_size):
+        row['date_created'] = row['date_created'] and row['date_created'].isoformat()
+        if format == 'csv':
+            row['public'] = 'true' if row['public'] else 'false'
+            writer.writerow(row)
+        else:
+            file_handler.write(json.dumps(row) + '\n')
+        count += 1
+    return count
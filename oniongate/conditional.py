@@ -0,0 +1,57 @@
+"""
+Conditional GET support with ETag and Last-Modified validators
+
+Resources compute a version from a few columns or an aggregate over a table, so polling
+clients can be answered with 304 Not Modified without loading or marshalling any rows.
+"""
+import hashlib
+
+from flask import request, Response
+from werkzeug.http import http_date, quote_etag
+
+
+def version_etag(*parts):
+    """
+    Return a weak ETag for the values which identify a version of a resource
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def latest(*dates):
+    """
+    Return the most recent of the dates which are set, or None
+    """
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def validator_headers(etag, last_modified=None):
+    """
+    Return the ETag and Last-Modified headers for a version of a resource
+    """
+    headers = {'ETag': quote_etag(etag, weak=True)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+def is_not_modified(etag, last_modified=None):
+    """
+    Check if the client already has this version of a resource
+
+    If-None-Match takes precedence over If-Modified-Since, which only has a resolution of
+    one second.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        if_modified_since = request.if_modified_since.replace(tzinfo=None)
+        return last_modified.replace(microsecond=0) <= if_modified_since
+    return False
+
+
+def not_modified(headers):
+    """
+    Return an empty 304 Not Modified response with the validator headers
+    """
+    return Response(status=304, headers=headers)
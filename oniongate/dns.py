@@ -1,13 +1,62 @@
 """
 Scripts for loading domain->onion mappings and generating zone files
 """
+import io
 import os
+import copy
+import json
 import time
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 
 from flask import current_app, render_template_string, Markup
-from blockstack_zones import parse_zone_file, make_zone_file
+from blockstack_zones import parse_zone_file
 
-from .models import Domain, Proxy
+from . import metrics
+from .models import db, Domain, Record, Proxy
+from .proxy_selection import ProxySelector
+
+# The field which holds the value of a user record in the zone file records, by record type
+RECORD_VALUE_FIELDS = {
+    'a': 'ip',
+    'aaaa': 'ip',
+    'cname': 'alias',
+    'txt': 'txt',
+}
+
+# Record types in the order they are written to zone files, with the DNS type and the
+# fields holding their values. This follows the layout used by `make_zone_file`.
+ZONE_FILE_FORMATS = OrderedDict([
+    ('ns', ('NS', ['host'])),
+    ('mx', ('MX', ['preference', 'host'])),
+    ('a', ('A', ['ip'])),
+    ('aaaa', ('AAAA', ['ip'])),
+    ('cname', ('CNAME', ['alias'])),
+    ('alias', ('ALIAS', ['host'])),
+    ('ptr', ('PTR', ['host'])),
+    ('txt', ('TXT', ['txt'])),
+    ('srv', ('SRV', ['priority', 'weight', 'port', 'target'])),
+    ('spf', ('SPF', ['data'])),
+    ('uri', ('URI', ['priority', 'weight', 'target'])),
+])
+
+# Fields which are written as quoted strings
+QUOTED_FIELDS = {'txt': 'txt', 'uri': 'target'}
+
+# Spooled records are kept in memory until they reach this many characters
+ZONE_SPOOL_MAX_SIZE = 1024 * 1024
+
+# The columns of a domain and its user records needed to publish them in a zone
+ZoneDomain = namedtuple('ZoneDomain', ['id', 'domain_name', 'zone', 'subdomain', 'txt_label',
+                                       'onion_address', 'deleted'])
+ZoneRecord = namedtuple('ZoneRecord', ['id', 'label', 'record_type', 'value', 'ttl'])
+
+# Parsed base records for each zone, with the template paths and mtimes they were built from
+base_zone_cache = {}
 
 
 def read_if_exists(filename):
@@ -21,20 +70,86 @@ def read_if_exists(filename):
         current_app.logger.info("Could not open file %s", filename)
         return
 
-def build_zone_base_template(zone):
+
+@contextmanager
+def atomic_write(filename, mode='w'):
     """
-    Load template files from the zone file directory and create the base NS and static records
+    Open a temporary file which is renamed over `filename` once it has been written
+
+    The rename is atomic so readers never see a partially written file.
+    """
+    temp_filename = '{}.tmp'.format(filename)
+    try:
+        with open(temp_filename, mode) as file_handler:
+            yield file_handler
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def zone_file_path(zone_name):
+    """
+    Path of the generated zone file for a zone
+    """
+    return os.path.join(current_app.config['zone_dir'], '{}.zone'.format(zone_name))
+
+
+def zone_state_path(zone_name):
+    """
+    Path of the file which stores the state of the last generated zone
+    """
+    return os.path.join(current_app.config['zone_dir'], '{}.state.json'.format(zone_name))
+
+
+def zone_stats_path(zone_name):
+    """
+    Path of the file which stores the duration and size of the last zone generation
+    """
+    return os.path.join(current_app.config['zone_dir'],
+                        '{}{}'.format(zone_name, metrics.ZONE_STATS_SUFFIX))
+
+
+def save_zone_stats(zone_name, seconds, records):
+    """
+    Record how long a zone took to generate and how many records it holds, for the metrics
+    """
+    metrics.record_zone_generation(zone_name, seconds)
+    with atomic_write(zone_stats_path(zone_name)) as file_handler:
+        json.dump({'zone': zone_name, 'seconds': seconds, 'records': records}, file_handler)
+
+
+def zone_template_paths(zone):
+    """
+    Paths of the template files which hold the base records for a zone
     """
-    template_data = []
     zone_dir = current_app.config['zone_dir']
+    return [os.path.join(zone_dir, 'base_zone.j2'),
+            os.path.join(zone_dir, '{}.zone.j2'.format(zone))]
 
-    base_template = read_if_exists(os.path.join(zone_dir, 'base_zone.j2'))
-    if base_template:
-        template_data.append(base_template)
 
-    zone_template = read_if_exists(os.path.join(zone_dir, '{}.zone.j2'.format(zone)))
-    if zone_template:
-        template_data.append(zone_template)
+def template_mtimes(zone):
+    """
+    Return the (path, mtime) of each template for a zone, the mtime is None for missing files
+    """
+    mtimes = []
+    for path in zone_template_paths(zone):
+        try:
+            mtimes.append((path, os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            mtimes.append((path, None))
+    return tuple(mtimes)
+
+
+def build_zone_base_template(zone):
+    """
+    Load template files from the zone file directory and create the base NS and static records
+    """
+    template_data = []
+    for path in zone_template_paths(zone):
+        template = read_if_exists(path)
+        if template:
+            template_data.append(template)
 
     template = '\n'.join(template_data)
 
@@ -45,64 +160,465 @@ def build_zone_base_template(zone):
 def select_proxy_a_records(record_label):
     """
     Select online A and AAAA records to include in a zone
+
+    At most PROXY_MAX_ANSWERS proxies of each type are chosen, weighted by their capacity
+    and latency.
     """
-    records = {'a': [], 'aaaa': []}
-    for proxy in Proxy.query.filter_by(online=True).all():
+    selector = ProxySelector.from_database()
+    records = {}
+    for record_type, ip_type in [('a', '4'), ('aaaa', '6')]:
         # Create a dict with the values for the A or AAAA record.
-        record = {
+        records[record_type] = [{
             'name': record_label,
             'ttl': current_app.config["A_RECORD_TTL"],
-            'ip': proxy.ip_address,
-        }
-        if proxy.ip_type == '4':
-            records["a"].append(record)
-        elif proxy.ip_type == '6':
-            records["aaaa"].append(record)
+            'ip': ip_address,
+        } for ip_address in selector.select(ip_type)]
+    return records
+
+
+def proxy_subdomain_for_zone(zone_name):
+    """
+    Return the label holding the proxy A records if they are part of this zone, otherwise None
+    """
+    proxy_domain = current_app.config["PROXY_ZONE"]
+    if proxy_domain.endswith(zone_name):
+        return proxy_domain.split(zone_name)[0].strip(".")
+    return None
+
+
+def select_zone_proxy_records(zone_name):
+    """
+    Select the proxy A and AAAA records which should be included in a zone
+    """
+    # Check if we are generating the zone that returns proxy A records
+    proxy_subdomain = proxy_subdomain_for_zone(zone_name)
+    if proxy_subdomain is None:
+        return {'a': [], 'aaaa': []}
+
+    # Add all online entry proxies to round-robin on this subdomain
+    return select_proxy_a_records(proxy_subdomain)
+
+
+def domains_with_records(domain_query, yield_per=None):
+    """
+    Yield each domain in a query together with a list of its user records
+
+    The domains and their records are loaded with a single outer joined query ordered by
+    domain, instead of lazy loading `Domain.records` separately for every domain. Only the
+    columns needed for the zone are selected, and are returned as `ZoneDomain` and
+    `ZoneRecord` tuples rather than ORM objects. Rows are streamed from the database in
+    batches when `yield_per` is set.
+    """
+    rows = domain_query.with_entities(
+        Domain.id, Domain.domain_name, Domain.zone, Domain.subdomain.label('subdomain'),
+        Domain.txt_label.label('txt_label'), Domain.onion_address, Domain.deleted,
+    ).outerjoin(Domain.records).add_columns(
+        Record.id, Record.label, Record.record_type, Record.value, Record.ttl,
+    ).order_by(Domain.id, Record.id)
+    if yield_per:
+        rows = rows.yield_per(yield_per)
+
+    domain_size = len(ZoneDomain._fields)
+    for domain, domain_rows in itertools.groupby(rows, key=lambda row: row[:domain_size]):
+        yield ZoneDomain(*domain), [ZoneRecord(*row[domain_size:]) for row in domain_rows
+                                    if row[domain_size] is not None]
+
+
+def user_record_name(domain, record):
+    """
+    Return the name of a user record relative to the zone
+    """
+    return '.'.join(label for label in [record.label, domain.subdomain] if label)
+
+
+def domain_zone_records(domain, user_records=()):
+    """
+    Create the records which publish a domain and its user records in its zone
+    """
+    records = {}
+
+    # Create the CNAME or ALIAS record pointing to the proxy
+    record = {'name': domain.subdomain, 'ttl': current_app.config["A_RECORD_TTL"]}
+    if current_app.config.get("USE_ALIAS_RECORDS"):
+        record["host"] = current_app.config["PROXY_ZONE"]
+        records["alias"] = [record]
+    else:
+        record["alias"] = current_app.config["PROXY_ZONE"]
+        records["cname"] = [record]
+
+    # Create the TXT record with the domain->onion address mapping
+    records["txt"] = [{
+        'name': domain.txt_label,
+        'txt': "onion={}".format(domain.onion_address),
+        'ttl': current_app.config["TXT_RECORD_TTL"]
+    }]
+
+    for user_record in user_records:
+        record_type = user_record.record_type.lower()
+        value_field = RECORD_VALUE_FIELDS.get(record_type)
+        if not value_field:
+            current_app.logger.warning("Skipping %s record on %s, the type is not supported",
+                                       user_record.record_type, domain.domain_name)
+            continue
+
+        record = {'name': user_record_name(domain, user_record), 'ttl': user_record.ttl,
+                  value_field: user_record.value}
+        # Don't repeat records which are already published, such as the onion mapping
+        entries = records.setdefault(record_type, [])
+        if not any(entry['name'] == record['name'] and entry[value_field] == record[value_field]
+                   for entry in entries):
+            entries.append(record)
     return records
 
 
+def changed_domains(zone_name):
+    """
+    Query the domains in a zone which changed, or had records change, since the last sync
+    """
+    return Domain.query.filter(Domain.zone == zone_name,
+                               db.or_(Domain.updated_since_synced == True,
+                                      Domain.records.any(Record.updated_since_synced == True)))
+
+
+def changed_proxy_ids(zone_name):
+    """
+    Return the ids of proxies which changed since the last sync if the zone lists proxies
+    """
+    if proxy_subdomain_for_zone(zone_name) is None:
+        return []
+    return [proxy_id for proxy_id, in
+            db.session.query(Proxy.id).filter_by(updated_since_synced=True)]
+
+
+def build_zone_state(zone_name):
+    """
+    Load everything needed to generate a zone from the templates and the database
+
+    The state keeps the base records, the proxy records and the records for each domain
+    separately so that individual domains can later be replaced without a full rebuild.
+    """
+    domains = domains_with_records(Domain.query.filter_by(zone=zone_name, deleted=False))
+    return {
+        'base': base_zone_records(zone_name),
+        'proxies': select_zone_proxy_records(zone_name),
+        'domains': {domain.domain_name: domain_zone_records(domain, records)
+                    for domain, records in domains},
+    }
+
+
+def format_zone_record(record_type, record):
+    """
+    Format a record as a zone file line
+    """
+    rr_type, value_fields = ZONE_FILE_FORMATS[record_type]
+    line = [str(record.get('name', '@'))]
+    if record.get('ttl') is not None:
+        line.append(str(record['ttl']))
+    line.append(rr_type)
+
+    for field in value_fields:
+        value = str(record[field])
+        if field == QUOTED_FIELDS.get(record_type):
+            value = '"{}"'.format(value).replace(";", "\\;")
+        line.append(value)
+    return " ".join(line).strip()
+
+
+def format_soa_record(soa):
+    """
+    Format the SOA record as a zone file line
+    """
+    line = [str(soa.get('name', '@'))]
+    if soa.get('ttl') is not None:
+        line.append(str(soa['ttl']))
+    line.extend(["IN", "SOA", str(soa['mname']), str(soa['rname']), "("])
+    line.extend(str(soa[field]) for field in ['serial', 'refresh', 'retry', 'expire', 'minimum'])
+    line.append(")")
+    return " ".join(line)
+
+
+def write_zone_file(file_handler, base, record_groups, serial=None):
+    """
+    Write a zone file from the base records and an iterable of record dicts
+
+    Records are grouped by type in the zone file. Each type is spooled to a temporary file
+    while `record_groups` is consumed, so the zone never has to be held in memory at once.
+    Returns the number of records written, not counting the SOA.
+    """
+    count = 0
+    spools = OrderedDict((record_type, tempfile.SpooledTemporaryFile(ZONE_SPOOL_MAX_SIZE,
+                                                                     mode='w+'))
+                         for record_type in ZONE_FILE_FORMATS)
+    try:
+        for records in itertools.chain([base], record_groups):
+            for record_type, entries in records.items():
+                if record_type not in spools:
+                    continue
+                for record in entries:
+                    spools[record_type].write(format_zone_record(record_type, record) + "\n")
+                count += len(entries)
+
+        if base.get('$origin') is not None:
+            file_handler.write("$ORIGIN {}\n".format(base['$origin']))
+        if base.get('$ttl') is not None:
+            file_handler.write("$TTL {}\n".format(base['$ttl']))
+
+        # `parse_zone_file` places the SOA record inside a list
+        soa = dict(base['soa'][-1])
+
+        # Bump the serial number in the SOA
+        soa['serial'] = serial or int(time.time())
+        file_handler.write(format_soa_record(soa) + "\n")
+
+        for spool in spools.values():
+            spool.seek(0)
+            shutil.copyfileobj(spool, file_handler)
+    finally:
+        for spool in spools.values():
+            spool.close()
+    return count
+
+
+def render_zone_state(state):
+    """
+    Generate a zone file from a zone state, returning it with the number of records
+    """
+    record_groups = itertools.chain([state['proxies']], state['domains'].values())
+    zone_file = io.StringIO()
+    count = write_zone_file(zone_file, state['base'], record_groups)
+    return zone_file.getvalue(), count
+
+
+def base_zone_records(zone_name):
+    """
+    Load the base records for the zone from the zone templates
+
+    The parsed records are cached until one of the template files is modified.
+    """
+    mtimes = template_mtimes(zone_name)
+    cached = base_zone_cache.get(zone_name)
+    if cached is None or cached[0] != mtimes:
+        cached = (mtimes, parse_zone_file(build_zone_base_template(zone_name)))
+        base_zone_cache[zone_name] = cached
+
+    # Callers get their own copy so the cached records can't be modified
+    return copy.deepcopy(cached[1])
+
+
 def generate_zone_file(zone_name):
     """
     Generate a zone file containing all the records for a zone.
     """
-    # Load the base records for the zone from a static zone file
-    zone_base = build_zone_base_template(zone_name)
-    records = parse_zone_file(zone_base)
+    started = time.perf_counter()
+    zone_file, count = render_zone_state(build_zone_state(zone_name))
+    save_zone_stats(zone_name, time.perf_counter() - started, count)
+    return zone_file
 
-    # Check if we are generating the zone that returns proxy A records
-    proxy_domain = current_app.config["PROXY_ZONE"]
-    if proxy_domain.endswith(zone_name):
-        # Determine the subdomain where proxy A records will be listed
-        proxy_subdomain = proxy_domain.split(zone_name)[0].strip(".")
-
-        # Add all online entry proxies to round-robin on this subdomain
-        proxy_records  = select_proxy_a_records(proxy_subdomain)
-        for record_type in ["a", "aaaa"]:
-            records[record_type].extend(proxy_records[record_type])
-
-    # Add all subdomains and associated TXT records for this zone
-    domains = Domain.query.filter_by(zone=zone_name, deleted=False).all()
-    for domain in domains:
-        # Create the CNAME or ALIAS record pointing to the proxy
-        record = {'name': domain.subdomain, 'ttl': current_app.config["A_RECORD_TTL"]}
-        if current_app.config.get("USE_ALIAS_RECORDS"):
-            record["host"] = current_app.config["PROXY_ZONE"]
-            records["alias"].append(record)
+
+def write_zone(zone_name):
+    """
+    Stream all the records for a zone from the database into its file in the zone directory
+
+    The file is replaced atomically once it has been completely written.
+    """
+    domains = domains_with_records(Domain.query.filter_by(zone=zone_name, deleted=False),
+                                   yield_per=current_app.config["ZONE_QUERY_BATCH_SIZE"])
+    record_groups = itertools.chain(
+        [select_zone_proxy_records(zone_name)],
+        (domain_zone_records(domain, records) for domain, records in domains)
+    )
+
+    started = time.perf_counter()
+    with atomic_write(zone_file_path(zone_name)) as file_handler:
+        count = write_zone_file(file_handler, base_zone_records(zone_name), record_groups)
+    save_zone_stats(zone_name, time.perf_counter() - started, count)
+
+
+def load_zone_state(zone_name):
+    """
+    Load the state saved when the zone was last synced, or None if there is no saved state
+    """
+    try:
+        with open(zone_state_path(zone_name), 'r') as file_handler:
+            return json.load(file_handler)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def update_zone_state(zone_name, state):
+    """
+    Apply the domains and proxies which changed since the last sync to a saved zone state
+
+    Returns the lists of synced domain and proxy ids.
+    """
+    # Pick up changes to the templates, this is cheap while they are cached
+    state['base'] = base_zone_records(zone_name)
+
+    domain_ids = []
+    for domain, records in domains_with_records(changed_domains(zone_name)):
+        domain_ids.append(domain.id)
+        if domain.deleted:
+            state['domains'].pop(domain.domain_name, None)
         else:
-            record["alias"] = current_app.config["PROXY_ZONE"]
-            records["cname"].append(record)
+            state['domains'][domain.domain_name] = domain_zone_records(domain, records)
+
+    proxy_ids = changed_proxy_ids(zone_name)
+    if proxy_ids:
+        state['proxies'] = select_zone_proxy_records(zone_name)
+
+    return domain_ids, proxy_ids
+
+
+def clear_synced_flags(model, ids, column=None, chunk_size=500):
+    """
+    Reset `updated_since_synced` on the rows matching the ids. The caller commits.
+    """
+    if column is None:
+        column = model.id
+    for i in range(0, len(ids), chunk_size):
+        model.query.filter(column.in_(ids[i:i + chunk_size])).\
+            update({'updated_since_synced': False}, synchronize_session=False)
+
+
+def mark_synced(domain_ids, proxy_ids):
+    """
+    Clear the flags of synced domains, their records and proxies in one transaction
+    """
+    clear_synced_flags(Domain, domain_ids)
+    clear_synced_flags(Record, domain_ids, column=Record.domain_id)
+    clear_synced_flags(Proxy, proxy_ids)
+    db.session.commit()
+
+
+def sync_zone(zone_name, full=False):
+    """
+    Write the zone file for a zone to the zone directory
+
+    Only domains and proxies which were updated since the last sync are loaded, the rest
+    of the zone comes from the state saved by the previous sync. A full rebuild is done
+    when requested, or when there is no saved state.
+    """
+    started = time.perf_counter()
+    state = None if full else load_zone_state(zone_name)
+    if state is None:
+        # Read the flagged ids first so rows changed during the rebuild stay flagged
+        domain_ids = [domain_id for domain_id, in
+                      changed_domains(zone_name).with_entities(Domain.id)]
+        proxy_ids = changed_proxy_ids(zone_name)
+        state = build_zone_state(zone_name)
+    else:
+        domain_ids, proxy_ids = update_zone_state(zone_name, state)
+
+    zone_file, count = render_zone_state(state)
+    with atomic_write(zone_file_path(zone_name)) as file_handler:
+        file_handler.write(zone_file)
+    with atomic_write(zone_state_path(zone_name)) as file_handler:
+        json.dump(state, file_handler)
+    save_zone_stats(zone_name, time.perf_counter() - started, count)
+
+    # Only mark rows as synced once the new zone has been written
+    mark_synced(domain_ids, proxy_ids)
+    return zone_file
+
+
+def all_zones():
+    """
+    Return the set of zones which hold domains, and the zone for issued subdomains
+    """
+    zones = {zone for zone, in db.session.query(Domain.zone).distinct()}
+    zones.add(current_app.config["SUBDOMAIN_HOST"])
+    return zones
+
+
+def templates_modified_since_sync(zone):
+    """
+    Check if the zone file is missing or older than one of the zone templates
+    """
+    try:
+        synced = os.stat(zone_file_path(zone)).st_mtime_ns
+    except FileNotFoundError:
+        return True
+    return any(mtime is not None and mtime > synced for path, mtime in template_mtimes(zone))
 
-        # Create the TXT record with the domain->onion address mapping
-        records["txt"].append({
-            'name': domain.txt_label,
-            'txt': "onion={}".format(domain.onion_address),
-            'ttl': current_app.config["TXT_RECORD_TTL"]
-        })
 
-    # Fixes a bug in `zone_file` which places the SOA record inside a list
-    records["soa"] = records["soa"].pop()
+def zones_needing_sync():
+    """
+    Return the zones which have changed since they were last synced, or were never synced
+    """
+    changed_zones = {zone for zone, in db.session.query(Domain.zone).filter(
+        db.or_(Domain.updated_since_synced == True,
+               Domain.records.any(Record.updated_since_synced == True))).distinct()}
+    proxies_changed = db.session.query(Proxy.id).filter_by(updated_since_synced=True).\
+        first() is not None
+
+    return sorted(zone for zone in all_zones() if
+                  zone in changed_zones or
+                  (proxies_changed and proxy_subdomain_for_zone(zone) is not None) or
+                  not os.path.exists(zone_state_path(zone)) or
+                  templates_modified_since_sync(zone))
+
+
+# App context of a zone worker process
+worker_app_context = None
+
 
-    # Bump the serial number in the SOA
-    records["soa"]["serial"] = int(time.time())
+def init_zone_worker(config_object, config):
+    """
+    Create an app with its own database connection in a zone worker process
+    """
+    from . import create_app
+
+    global worker_app_context
+    app = create_app(config_object)
+    app.config.update(config)
+    worker_app_context = app.app_context()
+    worker_app_context.push()
+
+
+def sync_zone_worker(job):
+    """
+    Sync a single zone in a worker process
 
-    return make_zone_file(records)
+    Returns the zone name, the time taken in seconds and an error message if it failed.
+    """
+    zone_name, full = job
+    start = time.time()
+    try:
+        sync_zone(zone_name, full=full)
+        error = None
+    except Exception as e:
+        current_app.logger.exception("Failed to sync zone %s", zone_name)
+        db.session.rollback()
+        error = str(e)
+    finally:
+        db.session.remove()
+    return zone_name, time.time() - start, error
+
+
+def sync_all_zones(config_object, processes=None, full=False):
+    """
+    Sync the zone file for every zone which changed, using a pool of worker processes
+
+    Each worker creates its own app from `config_object`, using the database and zone
+    directory of the current app. Returns a list of (zone, seconds, error) for each zone.
+    """
+    zones = sorted(all_zones()) if full else zones_needing_sync()
+    if not zones:
+        return []
+
+    config = {
+        'SQLALCHEMY_DATABASE_URI': current_app.config.get('SQLALCHEMY_DATABASE_URI'),
+        'zone_dir': current_app.config['zone_dir'],
+    }
+
+    # Don't share our database connections with the worker processes
+    db.session.remove()
+    db.get_engine(current_app).dispose()
+
+    pool = multiprocessing.Pool(processes, initializer=init_zone_worker,
+                                initargs=(config_object, config))
+    try:
+        return list(pool.imap_unordered(sync_zone_worker, [(zone, full) for zone in zones]))
+    finally:
+        pool.close()
+        pool.join()
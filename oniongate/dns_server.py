@@ -0,0 +1,376 @@
+"""
+Authoritative DNS server which answers queries from an in-memory index of the zones
+
+The index holds the same records as the generated zone files and is refreshed from the
+database while the server is running, so new registrations resolve without a zone reload.
+"""
+import io
+import struct
+import asyncio
+import datetime
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import dns.zone
+from flask import current_app
+
+from .models import db, Domain
+from .dns import (all_zones, base_zone_records, domains_with_records, domain_zone_records,
+                  proxy_subdomain_for_zone, select_zone_proxy_records, template_mtimes,
+                  write_zone_file)
+from .dns_update import group_rrsets
+from .proxy_selection import ProxySelector
+
+# The proxy address type for each proxy record type
+PROXY_IP_TYPES = {dns.rdatatype.A: '4', dns.rdatatype.AAAA: '6'}
+
+# Maximum size of a UDP response to a query without EDNS
+MAX_UDP_SIZE = 512
+# Maximum size of a response over TCP, whatever the EDNS payload size of the query
+MAX_TCP_SIZE = 65535
+
+
+def make_rrsets(zone_name, records):
+    """
+    Convert zone file records for a zone into a list of absolute RRsets
+    """
+    origin = dns.name.from_text(zone_name)
+    rrsets = []
+    for (name, rdtype), (ttl, rdatas) in group_rrsets(records).items():
+        rrsets.append(dns.rrset.from_rdata_list(dns.name.from_text(name or '@', origin),
+                                                ttl, rdatas))
+    return rrsets
+
+
+def base_rrsets(zone_name):
+    """
+    Load the SOA, NS and other static RRsets for a zone from its templates
+    """
+    base = base_zone_records(zone_name)
+    if not base.get('soa'):
+        current_app.logger.warning("Not serving zone %s, it has no SOA record", zone_name)
+        return []
+
+    zone_file = io.StringIO()
+    write_zone_file(zone_file, base, [])
+    zone = dns.zone.from_text(zone_file.getvalue(), origin=zone_name, relativize=False,
+                              check_origin=False)
+    return [dns.rrset.from_rdata_list(name, rdataset.ttl, list(rdataset))
+            for name, node in zone.nodes.items() for rdataset in node.rdatasets]
+
+
+class ZoneIndex(object):
+    """
+    Index of the RRsets served for each zone
+
+    RRsets are stored by owner, such as a domain or the proxy list, so the records of one
+    owner can be replaced without touching the rest of the index. Answers for the proxy
+    names are chosen by a `ProxySelector` for every query.
+    """
+    def __init__(self):
+        self.zones = {}
+        self.nodes = {}
+        self.owners = {}
+        self.proxy_selectors = {}
+
+    def replace(self, owner, rrsets):
+        """
+        Replace all the RRsets belonging to an owner
+        """
+        self.remove(owner)
+        for rrset in rrsets:
+            self.nodes.setdefault(rrset.name, {})[rrset.rdtype] = rrset
+            if rrset.rdtype == dns.rdatatype.SOA:
+                self.zones[rrset.name] = rrset
+        self.owners[owner] = [(rrset.name, rrset.rdtype) for rrset in rrsets]
+
+    def remove(self, owner):
+        """
+        Remove all the RRsets belonging to an owner
+        """
+        for name, rdtype in self.owners.pop(owner, []):
+            node = self.nodes.get(name, {})
+            node.pop(rdtype, None)
+            if not node:
+                self.nodes.pop(name, None)
+            if rdtype == dns.rdatatype.SOA:
+                self.zones.pop(name, None)
+
+    def rotate(self, rrset):
+        """
+        Replace the proxy A and AAAA RRsets with a fresh selection of proxies
+        """
+        selector = self.proxy_selectors.get(rrset.name)
+        if selector is None or rrset.rdtype not in PROXY_IP_TYPES:
+            return rrset
+
+        ip_addresses = selector.select(PROXY_IP_TYPES[rrset.rdtype])
+        if not ip_addresses:
+            return rrset
+        return dns.rrset.from_text_list(rrset.name, rrset.ttl, rrset.rdclass, rrset.rdtype,
+                                        ip_addresses)
+
+    def find_zone(self, qname):
+        """
+        Return the SOA RRset of the closest zone containing qname, or None
+        """
+        name = qname
+        while True:
+            if name in self.zones:
+                return self.zones[name]
+            if name == dns.name.root:
+                return None
+            name = name.parent()
+
+    def lookup(self, qname, rdtype):
+        """
+        Look up the answer for a query
+
+        Returns a tuple (rcode, answer RRsets, authority RRsets) or None if we are not
+        authoritative for the name.
+        """
+        soa = self.find_zone(qname)
+        if soa is None:
+            return None
+
+        node = self.nodes.get(qname)
+        if node is None:
+            return dns.rcode.NXDOMAIN, [], [soa]
+
+        if rdtype == dns.rdatatype.ANY:
+            return dns.rcode.NOERROR, list(node.values()), []
+        if rdtype in node:
+            return dns.rcode.NOERROR, [self.rotate(node[rdtype])], []
+
+        cname = node.get(dns.rdatatype.CNAME)
+        if cname is not None:
+            # Follow the CNAME if the target is one of our own names
+            answer = [cname]
+            target = self.nodes.get(cname[0].target, {}).get(rdtype)
+            if target is not None:
+                answer.append(self.rotate(target))
+            return dns.rcode.NOERROR, answer, []
+
+        return dns.rcode.NOERROR, [], [soa]
+
+
+class DNSServer(object):
+    """
+    Serve the zone index over UDP and TCP
+    """
+    def __init__(self, app):
+        self.app = app
+        self.index = ZoneIndex()
+        self.template_mtimes = {}
+        self.last_refresh = None
+
+    def load_zone(self, zone_name):
+        """
+        Return the changes which reload the base and proxy RRsets of a zone if they changed
+        """
+        changes = []
+        mtimes = template_mtimes(zone_name)
+        if self.template_mtimes.get(zone_name) != mtimes:
+            changes.append((('base', zone_name), base_rrsets(zone_name)))
+            self.template_mtimes[zone_name] = mtimes
+        changes.append((('proxies', zone_name),
+                        make_rrsets(zone_name, select_zone_proxy_records(zone_name))))
+        return changes
+
+    def load_changes(self):
+        """
+        Load the RRsets which changed since the last refresh from the database
+
+        Returns a list of (owner, rrsets) where rrsets is None for removed owners, and
+        the proxy selectors for each proxy name.
+        """
+        with self.app.app_context():
+            try:
+                return self.load_changes_since_refresh()
+            finally:
+                db.session.remove()
+
+    def load_changes_since_refresh(self):
+        """
+        Load the changed RRsets for `load_changes`, in an app context
+        """
+        started = datetime.datetime.utcnow()
+        changes, proxy_selectors = [], {}
+        selector = ProxySelector.from_database()
+        for zone_name in all_zones():
+            changes.extend(self.load_zone(zone_name))
+            proxy_subdomain = proxy_subdomain_for_zone(zone_name)
+            if proxy_subdomain is not None:
+                origin = dns.name.from_text(zone_name)
+                proxy_selectors[dns.name.from_text(proxy_subdomain or '@', origin)] = selector
+
+        domains = Domain.query
+        if self.last_refresh is not None:
+            # Allow some overlap so updates committed during the last refresh aren't missed
+            overlap = datetime.timedelta(
+                seconds=current_app.config["DNS_SERVER_REFRESH_OVERLAP"])
+            domains = domains.filter(Domain.date_updated >= self.last_refresh - overlap)
+        else:
+            domains = domains.filter_by(deleted=False)
+
+        batch_size = current_app.config["ZONE_QUERY_BATCH_SIZE"]
+        for domain, records in domains_with_records(domains, yield_per=batch_size):
+            owner = ('domain', domain.domain_name)
+            if domain.deleted:
+                changes.append((owner, None))
+            else:
+                changes.append((owner, make_rrsets(
+                    domain.zone, domain_zone_records(domain, records))))
+
+        self.last_refresh = started
+        return changes, proxy_selectors
+
+    async def refresh(self):
+        """
+        Apply changes from the database to the index
+
+        The database is read in a worker thread, the index is only modified on the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        changes, proxy_selectors = await loop.run_in_executor(None, self.load_changes)
+        self.index.proxy_selectors = proxy_selectors
+        for owner, rrsets in changes:
+            if rrsets is None:
+                self.index.remove(owner)
+            else:
+                self.index.replace(owner, rrsets)
+        return len(changes)
+
+    async def refresh_periodically(self, interval):
+        """
+        Keep refreshing the index until the server is stopped
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception:
+                self.app.logger.exception("Failed to refresh the DNS index")
+
+    def handle_query(self, wire, tcp=False):
+        """
+        Answer a query in wire format, returning the response in wire format or None
+
+        UDP responses are limited to the EDNS payload size of the query, up to
+        DNS_SERVER_MAX_UDP_PAYLOAD, or 512 bytes without EDNS. Larger responses are
+        truncated so the client retries over TCP.
+        """
+        try:
+            query = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            return None
+
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        if query.opcode() != dns.opcode.QUERY or len(query.question) != 1:
+            response.set_rcode(dns.rcode.NOTIMP)
+            return response.to_wire()
+
+        question = query.question[0]
+        result = self.index.lookup(question.name, question.rdtype)
+        if result is None:
+            response.flags &= ~dns.flags.AA
+            response.set_rcode(dns.rcode.REFUSED)
+            return response.to_wire()
+
+        rcode, response.answer, response.authority = result
+        response.set_rcode(rcode)
+
+        if tcp:
+            max_size = MAX_TCP_SIZE
+        elif query.edns >= 0:
+            max_size = min(max(query.payload, MAX_UDP_SIZE),
+                           self.app.config["DNS_SERVER_MAX_UDP_PAYLOAD"])
+        else:
+            max_size = MAX_UDP_SIZE
+        try:
+            return response.to_wire(max_size=max_size)
+        except dns.exception.TooBig:
+            # Tell the client to retry over TCP
+            response.answer, response.authority = [], []
+            response.flags |= dns.flags.TC
+            return response.to_wire()
+
+    async def handle_tcp(self, reader, writer):
+        """
+        Answer length prefixed queries on a TCP connection
+        """
+        try:
+            while True:
+                length, = struct.unpack('!H', await reader.readexactly(2))
+                response = self.handle_query(await reader.readexactly(length), tcp=True)
+                if response is None:
+                    break
+                writer.write(struct.pack('!H', len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        """
+        Load the index and start listening for queries on UDP and TCP
+        """
+        await self.refresh()
+        loop = asyncio.get_event_loop()
+        self.udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: DNSDatagramProtocol(self), local_addr=(host, port))
+        # Listen for TCP on the same port as UDP, even if an ephemeral port was requested
+        port = self.udp_transport.get_extra_info('sockname')[1]
+        self.tcp_server = await asyncio.start_server(self.handle_tcp, host, port)
+        return port
+
+    def close(self):
+        """
+        Stop listening for queries
+        """
+        self.udp_transport.close()
+        self.tcp_server.close()
+
+
+class DNSDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Answer queries received over UDP
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = self.server.handle_query(data)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+
+def serve(app):
+    """
+    Run the DNS server until it is interrupted
+    """
+    server = DNSServer(app)
+    loop = asyncio.get_event_loop()
+    port = loop.run_until_complete(server.start(app.config["DNS_SERVER_HOST"],
+                                                app.config["DNS_SERVER_PORT"]))
+    app.logger.info("Serving DNS on %s port %d", app.config["DNS_SERVER_HOST"], port)
+    refresh = asyncio.ensure_future(
+        server.refresh_periodically(app.config["DNS_SERVER_REFRESH_INTERVAL"]))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        refresh.cancel()
+        server.close()
@@ -0,0 +1,191 @@
+"""
+Publish changed domains and proxies to a nameserver with RFC 2136 dynamic DNS updates
+"""
+import os
+import json
+
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.tsigkeyring
+import dns.update
+from flask import current_app
+
+from .dns import (atomic_write, changed_domains, changed_proxy_ids, domain_zone_records,
+                  domains_with_records, mark_synced, proxy_subdomain_for_zone,
+                  select_zone_proxy_records)
+
+# ALIAS is not a standard record type, PowerDNS accepts it under this private type number
+ALIAS_RDATATYPE = 65401
+
+# Map the record lists used when generating zone files to a DNS type and value field
+RECORD_TYPES = {
+    'a': (dns.rdatatype.A, 'ip'),
+    'aaaa': (dns.rdatatype.AAAA, 'ip'),
+    'cname': (dns.rdatatype.CNAME, 'alias'),
+    'alias': (ALIAS_RDATATYPE, 'host'),
+    'txt': (dns.rdatatype.TXT, 'txt'),
+}
+
+
+class UpdateFailed(Exception):
+    """
+    The nameserver did not accept a dynamic update
+    """
+
+
+def make_rdata(rdtype, value):
+    """
+    Create the rdata for a record value
+    """
+    if rdtype == dns.rdatatype.TXT:
+        value = '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+    elif rdtype == dns.rdatatype.CNAME:
+        # Targets are always fully qualified, never relative to the zone
+        value = dns.name.from_text(value).to_text()
+    elif rdtype == ALIAS_RDATATYPE:
+        # Encode the target name as generic rdata, dnspython doesn't know ALIAS
+        wire = dns.name.from_text(value).to_wire()
+        value = r'\# {} {}'.format(len(wire), wire.hex())
+    return dns.rdata.from_text(dns.rdataclass.IN, rdtype, value)
+
+
+def group_rrsets(records):
+    """
+    Group zone file records by owner name and type
+
+    Returns a dict of (name, rdtype) -> (ttl, [rdata, ...]).
+    """
+    rrsets = {}
+    for record_type, entries in records.items():
+        rdtype, value_field = RECORD_TYPES[record_type]
+        for entry in entries:
+            ttl, rdatas = rrsets.setdefault((entry['name'], rdtype), (entry['ttl'], []))
+            rdatas.append(make_rdata(rdtype, entry[value_field]))
+    return rrsets
+
+
+def published_rrsets_path(zone_name):
+    """
+    Path of the file listing the RRsets which were sent to the nameserver for each domain
+    """
+    return os.path.join(current_app.config['zone_dir'], '{}.published.json'.format(zone_name))
+
+
+def load_published_rrsets(zone_name):
+    """
+    Load the (name, rdtype) RRsets sent for each domain by earlier syncs
+    """
+    try:
+        with open(published_rrsets_path(zone_name), 'r') as file_handler:
+            published = json.load(file_handler)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {domain_name: [tuple(key) for key in keys] for domain_name, keys in published.items()}
+
+
+def domain_changes(domain, records=(), published=()):
+    """
+    Return the RRset changes needed to bring the published records of a domain up to date
+
+    Live domains replace their RRsets while deleted domains remove them. RRsets listed in
+    `published` which no longer exist, such as deleted user records, are removed too.
+    Each change is a tuple (action, name, rdtype, ttl, rdatas).
+    """
+    rrsets = group_rrsets(domain_zone_records(domain, records))
+    stale = set(published) - set(rrsets)
+    if domain.deleted:
+        stale.update(rrsets)
+        rrsets = {}
+
+    changes = [('delete', name, rdtype, None, None) for name, rdtype in sorted(stale)]
+    for (name, rdtype), (ttl, rdatas) in rrsets.items():
+        changes.append(('replace', name, rdtype, ttl, rdatas))
+    return changes
+
+
+def proxy_changes(zone_name):
+    """
+    Return the changes which replace the proxy round-robin RRsets with the online proxies
+    """
+    proxy_subdomain = proxy_subdomain_for_zone(zone_name)
+    rrsets = group_rrsets(select_zone_proxy_records(zone_name))
+
+    changes = []
+    for rdtype in [dns.rdatatype.A, dns.rdatatype.AAAA]:
+        if (proxy_subdomain, rdtype) in rrsets:
+            ttl, rdatas = rrsets[(proxy_subdomain, rdtype)]
+            changes.append(('replace', proxy_subdomain, rdtype, ttl, rdatas))
+        else:
+            changes.append(('delete', proxy_subdomain, rdtype, None, None))
+    return changes
+
+
+def build_update_messages(zone_name, changes, batch_size=None):
+    """
+    Pack RRset changes into as few update messages as the batch size allows
+    """
+    batch_size = batch_size or current_app.config["DNS_UPDATE_BATCH_SIZE"]
+    keyring, keyname = None, None
+    tsig_key = current_app.config.get("DNS_UPDATE_TSIG_KEY")
+    if tsig_key:
+        keyring = dns.tsigkeyring.from_text(tsig_key)
+        keyname = list(tsig_key.keys())[0]
+
+    messages = []
+    for i in range(0, len(changes), batch_size):
+        update = dns.update.Update(zone_name, keyring=keyring, keyname=keyname)
+        for action, name, rdtype, ttl, rdatas in changes[i:i + batch_size]:
+            if action == 'delete':
+                update.delete(name, rdtype)
+            else:
+                update.replace(name, ttl, *rdatas)
+        messages.append(update)
+    return messages
+
+
+def send_update(message):
+    """
+    Send an update message to the nameserver over TCP and check it was accepted
+    """
+    response = dns.query.tcp(message, current_app.config["DNS_UPDATE_SERVER"],
+                             port=current_app.config["DNS_UPDATE_PORT"],
+                             timeout=current_app.config["DNS_UPDATE_TIMEOUT"])
+    if response.rcode() != dns.rcode.NOERROR:
+        raise UpdateFailed("Update was refused with {}".format(
+            dns.rcode.to_text(response.rcode())))
+    return response
+
+
+def push_zone_updates(zone_name):
+    """
+    Send the domains and proxies which changed since the last sync as dynamic updates
+
+    The `updated_since_synced` flags are only cleared once every message has been accepted.
+    Returns the number of update messages which were sent.
+    """
+    changes, domain_ids = [], []
+    published = load_published_rrsets(zone_name)
+    for domain, records in domains_with_records(changed_domains(zone_name)):
+        domain_ids.append(domain.id)
+        updates = domain_changes(domain, records, published.pop(domain.domain_name, ()))
+        changes.extend(updates)
+        if not domain.deleted:
+            published[domain.domain_name] = [(name, rdtype) for action, name, rdtype, _, _
+                                             in updates if action == 'replace']
+
+    proxy_ids = changed_proxy_ids(zone_name)
+    if proxy_ids:
+        changes.extend(proxy_changes(zone_name))
+
+    messages = build_update_messages(zone_name, changes)
+    for message in messages:
+        send_update(message)
+
+    with atomic_write(published_rrsets_path(zone_name)) as file_handler:
+        json.dump(published, file_handler)
+    mark_synced(domain_ids, proxy_ids)
+    return len(messages)
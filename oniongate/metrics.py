@@ -0,0 +1,298 @@
+"""
+Request, database and zone generation metrics, exposed in the Prometheus text format
+
+Metrics are kept in memory for each process and only cost a few additions and a lock per
+observation, so they can stay enabled in production. Zone generation often runs in other
+processes, so the duration and size of the last generation of each zone are also saved
+next to the zone file and read back when the metrics are scraped.
+"""
+import os
+import json
+import time
+import bisect
+import threading
+
+from flask import current_app, g, has_request_context, request, Response
+from .models import Domain, Proxy
+from .stats import count_with_online
+from .utils import listen_to_engines
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ZONE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Suffix of the files in the zone directory holding the stats of the last zone generation
+ZONE_STATS_SUFFIX = '.metrics.json'
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label(value))
+                          for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+    A value which only goes up, for each set of labels
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in sorted(self.values.items())]
+
+
+class Histogram(object):
+    """
+    Counts of observations in buckets, with their sum and count, for each set of labels
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        # Buckets hold the observations up to and including their bound
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # A count for each bucket and +Inf, then the sum
+                series = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            series = sorted((labels, list(values)) for labels, values in self.series.items())
+        samples = []
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + (('le', format_value(
+                    float(bound))),), cumulative))
+            samples.append((self.name + '_sum', labels, values[-1]))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class Gauge(object):
+    """
+    Values read when the metrics are scraped, from a function returning (labels, value)
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, description, collect):
+        self.name = name
+        self.description = description
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, tuple(sorted(labels.items())), value)
+                for labels, value in self.collect()]
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """
+        Return every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            samples = metric.samples()
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in samples:
+                lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def online_gauge(query, online_column):
+    """
+    Return a gauge collector for the number of online and offline rows of a query
+    """
+    def collect():
+        total, online = count_with_online(query(), online_column)
+        return [({'state': 'online'}, online), ({'state': 'offline'}, total - online)]
+    return collect
+
+
+def unit_of_work_gauge():
+    stats = current_app.extensions.get('unit_of_work', {})
+    return [({'stat': name}, stats.get(name, 0)) for name in ['requests', 'commits',
+                                                              'max_commits']]
+
+
+def saved_zone_stats():
+    """
+    Read the stats saved by the last generation of each zone, by any process
+    """
+    zone_stats = []
+    zone_dir = current_app.config['zone_dir']
+    for filename in sorted(os.listdir(zone_dir)):
+        if filename.endswith(ZONE_STATS_SUFFIX):
+            try:
+                with open(os.path.join(zone_dir, filename)) as file_handler:
+                    zone_stats.append(json.load(file_handler))
+            except (FileNotFoundError, ValueError):
+                continue
+    return zone_stats
+
+
+def create_registry():
+    """
+    Create the metrics collected by the app
+    """
+    registry = Registry()
+    registry.requests = registry.add(Counter(
+        'oniongate_http_requests_total', "Requests handled, by endpoint, method and status"))
+    registry.request_duration = registry.add(Histogram(
+        'oniongate_http_request_duration_seconds', "Time taken to handle requests"))
+    registry.db_duration = registry.add(Histogram(
+        'oniongate_db_duration_seconds', "Time spent in database queries for each request"))
+    registry.db_queries = registry.add(Histogram(
+        'oniongate_db_queries_per_request', "Database queries made by each request",
+        QUERY_COUNT_BUCKETS))
+    registry.zone_duration = registry.add(Histogram(
+        'oniongate_zone_generation_seconds', "Time taken to generate zones in this process",
+        ZONE_BUCKETS))
+    registry.add(Gauge(
+        'oniongate_zone_last_generation_seconds',
+        "Time taken by the last generation of each zone",
+        lambda: [({'zone': stats['zone']}, stats['seconds']) for stats in saved_zone_stats()]))
+    registry.add(Gauge(
+        'oniongate_zone_records', "Records written by the last generation of each zone",
+        lambda: [({'zone': stats['zone']}, stats['records']) for stats in saved_zone_stats()]))
+    registry.add(Gauge(
+        'oniongate_domains', "Registered domains by the state of their onion service",
+        online_gauge(lambda: Domain.query.filter_by(deleted=False), Domain.service_online)))
+    registry.add(Gauge(
+        'oniongate_proxies', "Entry proxies by their state",
+        online_gauge(lambda: Proxy.query, Proxy.online)))
+    registry.add(Gauge(
+        'oniongate_unit_of_work', "Requests and commits of the per request units of work",
+        unit_of_work_gauge))
+    return registry
+
+
+def metrics_registry():
+    """
+    Return the metrics of the current app
+    """
+    registry = current_app.extensions.get('metrics')
+    if registry is None:
+        registry = current_app.extensions['metrics'] = create_registry()
+    return registry
+
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if has_request_context() and 'db_time' in g:
+        g.db_time += elapsed
+        g.db_queries += 1
+
+
+def install():
+    """
+    Time the queries of every engine, once
+    """
+    listen_to_engines([('before_cursor_execute', start_query_timer),
+                       ('after_cursor_execute', stop_query_timer)])
+
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_time, g.db_queries = 0.0, 0
+
+
+def save_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+def record_request(exception=None):
+    """
+    Record the latency, status and database time of a request
+
+    This runs on teardown so requests which raised are counted too, with a 500 status.
+    """
+    if 'request_started' not in g:
+        return
+    registry = metrics_registry()
+    endpoint = request.endpoint or 'unmatched'
+    registry.requests.inc(endpoint=endpoint, method=request.method,
+                          status=g.get('response_status', 500))
+    registry.request_duration.observe(time.perf_counter() - g.request_started,
+                                      endpoint=endpoint)
+    registry.db_duration.observe(g.db_time, endpoint=endpoint)
+    registry.db_queries.observe(g.db_queries, endpoint=endpoint)
+
+
+def record_zone_generation(zone_name, seconds):
+    """
+    Add the duration of a zone generation in this process to its histogram
+    """
+    metrics_registry().zone_duration.observe(seconds, zone=zone_name)
+
+
+def metrics():
+    """
+    Serve the metrics in the Prometheus text format
+    """
+    return Response(metrics_registry().expose(), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """
+    Time every request and serve the metrics on /metrics
+    """
+    install()
+    app.before_request(start_request_timer)
+    app.after_request(save_response_status)
+    app.teardown_request(record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
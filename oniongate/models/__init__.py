@@ -5,3 +5,4 @@ db = SQLAlchemy()
 from .domain import Domain
 from .record import Record
 from .proxy import Proxy
+from .change import Change
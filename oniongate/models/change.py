@@ -0,0 +1,168 @@
+import json
+import datetime
+
+from sqlalchemy import bindparam, event, func, select, DDL
+from sqlalchemy.orm import Session
+
+from . import db, mixins
+
+# Kind of the entry which records how far deleted entries have been purged
+COMPACTION_KIND = 'compaction'
+
+# Single row counter holding the last sequence number given to a change
+change_sequence = db.Table(
+    'change_sequence',
+    db.Column('id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('value', db.BigInteger, nullable=False),
+)
+event.listen(change_sequence, 'after_create',
+             DDL("INSERT INTO change_sequence (id, value) VALUES (1, 0)"))
+
+
+class Change(db.Model, mixins.CRUDMixin):
+    """
+    An entry in the append-only log of changes to domains, records and proxies
+
+    Mirrors read the entries after the last sequence number they have seen instead of
+    downloading the whole registry again. Sequence numbers are given out when the
+    transaction which logged the change commits, while holding the lock on the counter row,
+    so they increase in commit order: once a sequence number is visible every lower one is
+    committed too. Entries of transactions which have not committed have no sequence number
+    and are not served.
+    """
+    __tablename__ = 'changes'
+    # Never reuse the ids of compacted entries
+    __table_args__ = {'extend_existing': True, 'sqlite_autoincrement': True}
+
+    # 'domain', 'record' or 'proxy'
+    kind = db.Column(db.String(10), nullable=False)
+    # 'create', 'update' or 'delete'
+    action = db.Column(db.String(10), nullable=False)
+    # What changed, such as the domain name. Compaction keeps the latest entry for each key.
+    key = db.Column(db.String(300), nullable=False, index=True)
+    data = db.Column(db.Text)
+    seq = db.Column(db.BigInteger, unique=True, index=True)
+
+    date_created = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<Change %r %s %s %r>' % (self.seq, self.action, self.kind, self.key)
+
+    @classmethod
+    def log(cls, kind, action, key, data=None, commit=True):
+        """
+        Add a change to the session, so it is committed with the change it describes
+        """
+        return cls(kind=kind, action=action, key=key,
+                   data=json.dumps(data or {}, sort_keys=True)).save(commit=commit)
+
+    @classmethod
+    def insert_rows(cls, rows):
+        """
+        Insert change log entries as dicts with a single multi-row insert, without committing
+        """
+        db.session.info['unsequenced_changes'] = True
+        db.session.execute(cls.__table__.insert(), rows)
+
+
+def has_new_changes(session):
+    return any(isinstance(instance, Change) for instance in session.new)
+
+
+@event.listens_for(Session, 'before_flush')
+def find_unsequenced_changes(session, flush_context, instances):
+    if has_new_changes(session):
+        session.info['unsequenced_changes'] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def assign_sequence_numbers(session):
+    """
+    Number the changes logged in the transaction which is about to commit
+
+    The counter row stays locked until the commit, so a transaction which commits later
+    can only get higher sequence numbers.
+    """
+    if not (session.info.get('unsequenced_changes') or has_new_changes(session)):
+        return
+    session.flush()
+    session.info.pop('unsequenced_changes', None)
+    change_ids = [change_id for change_id, in session.query(Change.id).
+                  filter(Change.seq == None).order_by(Change.id)]
+    if not change_ids:
+        return
+    session.execute(change_sequence.update().where(change_sequence.c.id == 1).
+                    values(value=change_sequence.c.value + len(change_ids)))
+    last = session.execute(select([change_sequence.c.value]).
+                           where(change_sequence.c.id == 1)).scalar()
+    changes = Change.__table__
+    session.execute(changes.update().where(changes.c.id == bindparam('change_id')).
+                    values(seq=bindparam('sequence')),
+                    [{'change_id': change_id, 'sequence': last - len(change_ids) + i + 1}
+                     for i, change_id in enumerate(change_ids)])
+
+
+def domain_data(domain):
+    """
+    Return the fields of a domain included in its changes
+    """
+    return {'zone': domain.zone, 'onion_address': domain.onion_address,
+            'public': domain.public}
+
+
+def record_data(record):
+    """
+    Return the fields of a record included in its changes
+    """
+    return {'id': record.id, 'label': record.label, 'type': record.record_type,
+            'value': record.value, 'ttl': record.ttl}
+
+
+def record_key(domain_name, record_id):
+    return '{}/{}'.format(domain_name, record_id)
+
+
+def purged_through():
+    """
+    Return the last sequence number from which deleted entries have been purged, or 0
+    """
+    data = db.session.query(Change.data).filter_by(kind=COMPACTION_KIND).\
+        order_by(Change.seq.desc()).limit(1).scalar()
+    return json.loads(data)['purged_through'] if data else 0
+
+
+def compact_changes(compact_after, purge_deletes_after, now=None):
+    """
+    Remove the old entries which are no longer needed to rebuild the current state
+
+    Entries older than `compact_after` seconds are removed when a later entry has the same
+    key. Deletions older than `purge_deletes_after` seconds are removed too, and the highest
+    sequence number purged is logged, so consumers which have not seen it are told to
+    download the full listing again. Returns the number of entries removed.
+    """
+    now = now or datetime.datetime.utcnow()
+    compact_before = now - datetime.timedelta(seconds=compact_after)
+    purge_before = now - datetime.timedelta(seconds=purge_deletes_after)
+
+    latest = db.session.query(Change.kind, Change.key, func.max(Change.seq).label('seq')).\
+        group_by(Change.kind, Change.key).subquery()
+    superseded = db.session.query(Change.id).join(
+        latest, db.and_(Change.kind == latest.c.kind, Change.key == latest.c.key)).filter(
+        Change.seq < latest.c.seq, Change.date_created < compact_before)
+    superseded_ids = [change_id for change_id, in superseded]
+
+    purged = db.session.query(Change.id, Change.seq).filter(
+        Change.action == 'delete', Change.seq != None, Change.date_created < purge_before).all()
+    purged_ids = [change_id for change_id, seq in purged]
+
+    removed_ids = sorted(set(superseded_ids) | set(purged_ids))
+    for i in range(0, len(removed_ids), 500):
+        Change.query.filter(Change.id.in_(removed_ids[i:i + 500])).\
+            delete(synchronize_session=False)
+    if purged:
+        Change.log(COMPACTION_KIND, 'update', 'deletes',
+                   {'purged_through': max(max(seq for change_id, seq in purged),
+                                          purged_through())}, commit=False)
+    db.session.commit()
+    return len(removed_ids)
+
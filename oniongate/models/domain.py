@@ -1,6 +1,7 @@
 import datetime
 
 from flask import current_app
+from sqlalchemy import bindparam, case, inspect
 from sqlalchemy.orm import exc
 from sqlalchemy.ext.hybrid import hybrid_property
 from flask_restful import abort
@@ -9,6 +10,23 @@ from .. import utils
 from . import db, mixins
 
 
+def subdomain_label(domain_name, zone):
+    """
+    Return the labels of a domain name below its zone, or '' for the zone apex
+    """
+    if domain_name.endswith(zone):
+        domain_name = domain_name[:-len(zone)]
+    return domain_name.strip(".")
+
+
+def default_subdomain_label(context):
+    """
+    Column default which fills in the subdomain label of new rows, including bulk inserts
+    """
+    parameters = context.get_current_parameters()
+    return subdomain_label(parameters['domain_name'], parameters['zone'])
+
+
 class Domain(db.Model, mixins.CRUDMixin):
     """
     A mapping of a domain name to an onion service address
@@ -17,21 +35,26 @@ class Domain(db.Model, mixins.CRUDMixin):
 
     domain_name = db.Column(db.String(256), unique=True, index=True)
     zone = db.Column(db.String(256), nullable=False, index=True)
+    # The domain name without the zone, stored so zones can be queried by label in SQL.
+    # Rows created before this column existed are filled in by `backfill_subdomains`.
+    subdomain_label = db.Column(db.String(256), default=default_subdomain_label, index=True)
     onion_address = db.Column(db.String(80))
 
     # Should this domain be publically listed in the onion service index.
     public = db.Column(db.Boolean, default=True)
 
-    date_created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    date_updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    date_created = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+    date_updated = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
     updated_since_synced = db.Column(db.Boolean, default=True)
 
     service_last_online = db.Column(db.DateTime)
+    # When the scanner last checked the service, the oldest checks are rescanned first
+    service_last_checked = db.Column(db.DateTime, index=True)
 
     # We default to True so that the service is assumed up until we can
     # scan it and determine that it it down. We want users to be able
     # to access services ASAP, before we have time to scan them.
-    service_online = db.Column(db.Boolean, default=False)
+    service_online = db.Column(db.Boolean, default=False, index=True)
 
     # Indicate domain is flagged for deletion before it is removed from DNS
     deleted = db.Column(db.Boolean, default=False)
@@ -49,7 +72,13 @@ class Domain(db.Model, mixins.CRUDMixin):
         """
         Return the subdomain label without the zone name
         """
-        return self.domain_name.split(self.zone)[0].strip(".")
+        if self.subdomain_label is not None:
+            return self.subdomain_label
+        return subdomain_label(self.domain_name, self.zone)
+
+    @subdomain.expression
+    def subdomain(cls):
+        return cls.subdomain_label
 
     @hybrid_property
     def txt_label(self):
@@ -57,9 +86,16 @@ class Domain(db.Model, mixins.CRUDMixin):
         Return the domain where the TXT record should be placed
         """
         if not current_app.config.get("USE_ALIAS_RECORDS"):
-            return "_onion.{}".format(self.subdomain)
+            return ".".join(label for label in ["_onion", self.subdomain] if label)
         return self.subdomain
 
+    @txt_label.expression
+    def txt_label(cls):
+        if not current_app.config.get("USE_ALIAS_RECORDS"):
+            return case([(cls.subdomain_label == '', '_onion')],
+                        else_='_onion.' + cls.subdomain_label)
+        return cls.subdomain_label
+
     @hybrid_property
     def token(self):
         """
@@ -86,3 +122,44 @@ class Domain(db.Model, mixins.CRUDMixin):
         except exc.NoResultFound:
             abort(404, message='Domain {} does not exist'.format(domain_name))
 
+
+def add_subdomain_column():
+    """
+    Add the subdomain label column and its index to a database created before they existed
+    """
+    table = Domain.__table__
+    columns = [column['name'] for column in inspect(db.engine).get_columns(table.name)]
+    if 'subdomain_label' in columns:
+        return False
+
+    db.engine.execute('ALTER TABLE {} ADD COLUMN subdomain_label VARCHAR(256)'.format(
+        table.name))
+    for index in table.indexes:
+        if 'subdomain_label' in index.columns:
+            index.create(db.engine)
+    return True
+
+
+def backfill_subdomains(batch_size=1000):
+    """
+    Fill in the subdomain label of domains created before it was stored
+
+    Rows are updated a batch at a time with executemany. Returns the number of domains updated.
+    """
+    add_subdomain_column()
+    table = Domain.__table__
+    update = table.update().where(table.c.id == bindparam('domain_id')).\
+        values(subdomain_label=bindparam('label'))
+
+    count = 0
+    while True:
+        rows = db.session.query(Domain.id, Domain.domain_name, Domain.zone).\
+            filter(Domain.subdomain_label == None).order_by(Domain.id).limit(batch_size).all()
+        if not rows:
+            break
+        db.session.execute(update, [{'domain_id': domain_id,
+                                     'label': subdomain_label(domain_name, zone)}
+                                    for domain_id, domain_name, zone in rows])
+        db.session.commit()
+        count += len(rows)
+    return count
@@ -1,5 +1,111 @@
+import logging
+from contextlib import contextmanager
+
+from flask import current_app, jsonify
+from sqlalchemy import event, exc
+from sqlalchemy.orm import Session
+
 from . import db
 
+logger = logging.getLogger(__name__)
+
+
+@event.listens_for(Session, 'after_commit')
+def count_commit(session):
+    """
+    Count the commits made by each session for the commits per request stats
+    """
+    session.info['commits'] = session.info.get('commits', 0) + 1
+
+
+def commit_session():
+    """
+    Commit the session, or only flush it while commits are deferred to a unit of work
+
+    Flushing still sends the changes, so errors such as an IntegrityError are raised
+    where the change was made.
+    """
+    if db.session.info.get('defer_commits'):
+        db.session.flush()
+        db.session.info['pending_commit'] = True
+    else:
+        db.session.commit()
+
+
+def begin_unit_of_work():
+    """
+    Defer the commits made with CRUDMixin until `end_unit_of_work`
+    """
+    db.session.info.update(defer_commits=True, pending_commit=False, commits=0)
+
+
+def end_unit_of_work(commit_changes=True):
+    """
+    Commit the deferred changes in one transaction, or roll them back
+
+    Returns the number of commits made since the unit of work began.
+    """
+    info = db.session.info
+    info.pop('defer_commits', None)
+    try:
+        if not commit_changes:
+            db.session.rollback()
+        elif info.pop('pending_commit', False):
+            db.session.commit()
+    finally:
+        commits = info.pop('commits', 0)
+        info.pop('pending_commit', None)
+        record_commits(commits)
+    return commits
+
+
+def record_commits(commits):
+    """
+    Add a unit of work to the commits per request stats of the app
+    """
+    stats = current_app.extensions.setdefault(
+        'unit_of_work', {'requests': 0, 'commits': 0, 'max_commits': 0})
+    stats['requests'] += 1
+    stats['commits'] += commits
+    stats['max_commits'] = max(stats['max_commits'], commits)
+    logger.debug("Unit of work finished with %d commits", commits)
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Make the CRUDMixin changes in the block with a single commit at the end
+
+    Nothing is committed if the block raises. A nested unit of work joins the outer one.
+    """
+    if db.session.info.get('defer_commits'):
+        yield
+        return
+
+    begin_unit_of_work()
+    try:
+        yield
+    except Exception:
+        end_unit_of_work(commit_changes=False)
+        raise
+    end_unit_of_work()
+
+
+def commit_request(response):
+    """
+    Commit the changes made by a successful request, roll back those of a failed request
+
+    Constraint errors raised by the final commit are returned as a 422 response.
+    """
+    try:
+        end_unit_of_work(commit_changes=response.status_code < 400)
+    except exc.IntegrityError:
+        db.session.rollback()
+        response = jsonify(message="The changes conflict with existing data")
+        response.status_code = 422
+    return response
+
+
 class CRUDMixin(object):
     """
     Mixin for adding CRUD methods to SQLAlchemy models
@@ -30,9 +136,9 @@ class CRUDMixin(object):
     def save(self, commit=True):
         db.session.add(self)
         if commit:
-            db.session.commit()
+            commit_session()
         return self
 
     def delete(self, commit=True):
         db.session.delete(self)
-        return commit and db.session.commit()
+        return commit and commit_session()
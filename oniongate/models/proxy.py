@@ -18,6 +18,12 @@ class Proxy(db.Model, mixins.CRUDMixin):
     last_checked = db.Column(db.DateTime)
     online = db.Column(db.Boolean, default=False)
 
+    # Response time of the last successful check in seconds, faster proxies get more traffic
+    latency = db.Column(db.Float)
+
+    # Relative share of traffic this proxy can handle
+    capacity = db.Column(db.Integer, default=1)
+
     updated_since_synced = db.Column(db.Boolean, default=False)
 
     def __repr__(self):
@@ -0,0 +1,230 @@
+"""
+SQL query profiler for development and tests
+
+Profiles count the queries run by the current thread, their time and how often each
+statement shape was run. A shape is the statement with its literals and lists of
+placeholders collapsed, so the lazy loads of a relationship for many rows share one shape.
+A SELECT shape run many times with different parameters is reported as a likely N+1.
+
+The engine listeners are only installed when profiling is first used, so the profiler
+costs nothing unless SQL_PROFILER_ENABLED is set or a test asks for a query budget.
+"""
+import re
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+
+from .utils import listen_to_engines
+
+# Number of times a SELECT of the same shape is run with different parameters before it
+# is reported as a likely N+1, unless the app sets SQL_PROFILER_N_PLUS_ONE_THRESHOLD
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|(?<![:\w]):\w+")
+WHITESPACE = re.compile(r"\s+")
+
+active = threading.local()
+
+
+def statement_shape(statement):
+    """
+    Return a statement with its literals and parameter lists collapsed
+    """
+    shape = WHITESPACE.sub(' ', statement).strip()
+    shape = PLACEHOLDERS.sub('?', LITERALS.sub('?', shape))
+    return PLACEHOLDER_LISTS.sub('(?...)', shape)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class StatementStats(object):
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.duration = 0.0
+        self.parameters = set()
+
+    @property
+    def is_select(self):
+        return self.shape[:6].upper() == 'SELECT'
+
+
+class QueryProfile(object):
+    """
+    The queries run while a profile is active, grouped by statement shape
+    """
+    def __init__(self, label, n_plus_one_threshold=DEFAULT_N_PLUS_ONE_THRESHOLD):
+        self.label = label
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = 0
+        self.duration = 0.0
+        self.statements = {}
+
+    def record(self, statement, parameters, elapsed):
+        shape = statement_shape(statement)
+        stats = self.statements.get(shape)
+        if stats is None:
+            stats = self.statements[shape] = StatementStats(shape)
+        stats.count += 1
+        stats.duration += elapsed
+        # Only whether the threshold is reached matters, so long running commands don't
+        # keep every parameter set
+        if stats.is_select and len(stats.parameters) < self.n_plus_one_threshold:
+            stats.parameters.add(repr(parameters))
+        self.queries += 1
+        self.duration += elapsed
+
+    def repeated(self):
+        """
+        Return the statement shapes which were run more than once, most frequent first
+        """
+        return sorted((stats for stats in self.statements.values() if stats.count > 1),
+                      key=lambda stats: (-stats.count, stats.shape))
+
+    def n_plus_one(self):
+        """
+        Return the SELECT shapes run with enough different parameters to be a likely N+1
+        """
+        return [stats for stats in self.repeated() if stats.is_select and
+                len(stats.parameters) >= self.n_plus_one_threshold]
+
+    def report(self):
+        lines = ["{}: {} queries in {:.1f}ms".format(self.label, self.queries,
+                                                     self.duration * 1000)]
+        suspects = self.n_plus_one()
+        for stats in self.repeated():
+            lines.append("  {}{}x {:.1f}ms {}".format(
+                "likely N+1: " if stats in suspects else "", stats.count,
+                stats.duration * 1000, stats.shape))
+        return '\n'.join(lines)
+
+
+def active_profiles():
+    profiles = getattr(active, 'profiles', None)
+    if profiles is None:
+        profiles = active.profiles = []
+    return profiles
+
+
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    if getattr(active, 'profiles', None):
+        conn.info.setdefault('profiler_started', []).append(time.perf_counter())
+
+
+def finish_query(conn, cursor, statement, parameters, context, executemany):
+    profiles = getattr(active, 'profiles', None)
+    started = conn.info.get('profiler_started')
+    if not profiles or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    for query_profile in profiles:
+        query_profile.record(statement, parameters, elapsed)
+
+
+def install():
+    """
+    Listen to the queries of every engine, once
+    """
+    listen_to_engines([('before_cursor_execute', start_query),
+                       ('after_cursor_execute', finish_query)])
+
+
+def configured_threshold():
+    try:
+        return current_app.config.get("SQL_PROFILER_N_PLUS_ONE_THRESHOLD",
+                                      DEFAULT_N_PLUS_ONE_THRESHOLD)
+    except RuntimeError:
+        return DEFAULT_N_PLUS_ONE_THRESHOLD
+
+
+def start_profile(label, n_plus_one_threshold=None):
+    """
+    Start recording the queries run by this thread, until `stop_profile` is called
+    """
+    install()
+    query_profile = QueryProfile(label, n_plus_one_threshold or configured_threshold())
+    active_profiles().append(query_profile)
+    return query_profile
+
+
+def stop_profile(query_profile):
+    profiles = active_profiles()
+    if query_profile in profiles:
+        profiles.remove(query_profile)
+    return query_profile
+
+
+@contextmanager
+def profile(label, n_plus_one_threshold=None):
+    """
+    Profile the queries run by this thread inside the block
+    """
+    query_profile = start_profile(label, n_plus_one_threshold)
+    try:
+        yield query_profile
+    finally:
+        stop_profile(query_profile)
+
+
+@contextmanager
+def query_budget(max_queries, allow_n_plus_one=False, label="block"):
+    """
+    Fail when the block runs more than `max_queries` queries, or a likely N+1
+    """
+    with profile(label) as query_profile:
+        yield query_profile
+    if query_profile.queries > max_queries:
+        raise QueryBudgetExceeded("Ran {} queries, the budget is {}\n{}".format(
+            query_profile.queries, max_queries, query_profile.report()))
+    if query_profile.n_plus_one() and not allow_n_plus_one:
+        raise QueryBudgetExceeded("Ran likely N+1 queries\n{}".format(
+            query_profile.report()))
+
+
+def start_request_profile():
+    g.query_profile = start_profile("{} {}".format(request.method, request.path))
+
+
+def log_request_profile(exception=None):
+    """
+    Log the queries of a request, as a warning when they look like an N+1
+    """
+    query_profile = g.pop('query_profile', None)
+    if query_profile is None:
+        return
+    stop_profile(query_profile)
+    if query_profile.n_plus_one():
+        current_app.logger.warning("%s", query_profile.report())
+    else:
+        current_app.logger.info("%s", query_profile.report())
+
+
+@contextmanager
+def profile_command(app, name):
+    """
+    Profile a CLI command and print the report to stderr, when SQL_PROFILER_ENABLED is set
+    """
+    if not app.config["SQL_PROFILER_ENABLED"]:
+        yield None
+        return
+    query_profile = start_profile(name, app.config["SQL_PROFILER_N_PLUS_ONE_THRESHOLD"])
+    try:
+        yield query_profile
+    finally:
+        stop_profile(query_profile)
+        print(query_profile.report(), file=sys.stderr)
+
+
+def init_app(app):
+    """
+    Profile the queries of every request and log them, even when the request fails
+    """
+    app.before_request(start_request_profile)
+    app.teardown_request(log_request_profile)
@@ -0,0 +1,107 @@
+"""
+Check which entry proxies are reachable and record the results on the proxies
+"""
+import time
+import asyncio
+import datetime
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+from .models import db, Proxy
+
+
+async def probe_proxy(ip_address, port, host):
+    """
+    Send a HEAD request to a proxy and wait for the HTTP status line
+    """
+    reader, writer = await asyncio.open_connection(ip_address, port)
+    try:
+        writer.write("HEAD / HTTP/1.0\r\nHost: {}\r\n\r\n".format(host).encode('ascii'))
+        status_line = await reader.readline()
+    finally:
+        writer.close()
+    return status_line.startswith(b'HTTP/')
+
+
+async def check_proxy(ip_address, port, host, timeout):
+    """
+    Check a proxy, returning the response time in seconds or None if the check failed
+    """
+    started = time.monotonic()
+    try:
+        if await asyncio.wait_for(probe_proxy(ip_address, port, host), timeout):
+            return time.monotonic() - started
+    except (OSError, asyncio.TimeoutError):
+        pass
+    return None
+
+
+async def check_all_proxies(proxies, port, host, timeout, concurrency):
+    """
+    Check a list of proxy addresses with at most `concurrency` checks in flight
+
+    Returns the response time of each proxy, or None when it is offline.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded_check(ip_address):
+        async with semaphore:
+            return await check_proxy(ip_address, port, host, timeout)
+
+    return await asyncio.gather(*[bounded_check(ip_address) for ip_address in proxies])
+
+
+def save_check_results(results, checked_at):
+    """
+    Write the check results back to the proxies in a single transaction
+
+    `results` is a list of (proxy id, was online, latency or None) tuples. Proxies are only
+    flagged as updated for the next zone sync when they went online or offline.
+    """
+    table = Proxy.__table__
+    online = [{'proxy_id': proxy_id, 'latency': latency}
+              for proxy_id, was_online, latency in results if latency is not None]
+    offline = [{'proxy_id': proxy_id}
+               for proxy_id, was_online, latency in results if latency is None]
+    changed = [proxy_id for proxy_id, was_online, latency in results
+               if bool(was_online) != (latency is not None)]
+
+    if online:
+        db.session.execute(table.update().where(table.c.id == bindparam('proxy_id')).values(
+            online=True, latency=bindparam('latency'), last_checked=checked_at,
+            last_succesful_check=checked_at), online)
+    if offline:
+        db.session.execute(table.update().where(table.c.id == bindparam('proxy_id')).values(
+            online=False, last_checked=checked_at), offline)
+    if changed:
+        db.session.execute(table.update().where(table.c.id.in_(changed)).values(
+            updated_since_synced=True))
+    db.session.commit()
+    return changed
+
+
+def check_proxies():
+    """
+    Check every proxy concurrently and update their online state
+
+    Returns the number of proxies checked, the number online and the number which changed.
+    """
+    config = current_app.config
+    proxies = db.session.query(Proxy.id, Proxy.ip_address, Proxy.online).all()
+    db.session.commit()
+
+    checked_at = datetime.datetime.utcnow()
+    loop = asyncio.new_event_loop()
+    try:
+        latencies = loop.run_until_complete(check_all_proxies(
+            [proxy.ip_address for proxy in proxies], config["PROXY_CHECK_PORT"],
+            config["PROXY_ZONE"], config["PROXY_CHECK_TIMEOUT"],
+            config["PROXY_CHECK_CONCURRENCY"]))
+    finally:
+        loop.close()
+
+    results = [(proxy.id, proxy.online, latency) for proxy, latency in zip(proxies, latencies)]
+    changed = save_check_results(results, checked_at)
+    num_online = len([latency for latency in latencies if latency is not None])
+    return len(proxies), num_online, len(changed)
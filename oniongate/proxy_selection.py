@@ -0,0 +1,72 @@
+"""
+Choose which entry proxies are returned in DNS answers
+"""
+import heapq
+import random
+import datetime
+
+from flask import current_app
+
+from .models import db, Proxy
+
+
+def proxy_weight(capacity, latency):
+    """
+    Weight a proxy by its capacity, preferring proxies which respond quickly
+    """
+    latency = latency or current_app.config["PROXY_DEFAULT_LATENCY"]
+    return (capacity or 1) / max(latency, 0.001)
+
+
+class ProxySelector(object):
+    """
+    Pick weighted random subsets of the online proxies
+
+    Each call to `select` returns a different subset, so the load is spread over all the
+    proxies while every answer stays small enough for UDP.
+    """
+    def __init__(self, proxies, max_answers):
+        """
+        `proxies` is a list of (ip_address, ip_type, weight) tuples
+        """
+        self.max_answers = max_answers
+        self.candidates = {'4': [], '6': []}
+        for ip_address, ip_type, weight in proxies:
+            self.candidates[ip_type].append((ip_address, weight))
+
+    @classmethod
+    def from_database(cls):
+        """
+        Load the online proxies, skipping proxies which have not passed a check recently
+
+        Falls back to every online proxy if none of them were checked recently.
+        """
+        proxies = db.session.query(Proxy.ip_address, Proxy.ip_type, Proxy.capacity,
+                                   Proxy.latency, Proxy.last_succesful_check).\
+            filter_by(online=True).order_by(Proxy.id).all()
+
+        max_age = datetime.timedelta(seconds=current_app.config["PROXY_MAX_CHECK_AGE"])
+        cutoff = datetime.datetime.utcnow() - max_age
+        healthy = [proxy for proxy in proxies if
+                   proxy.last_succesful_check is None or proxy.last_succesful_check >= cutoff]
+
+        return cls([(proxy.ip_address, proxy.ip_type, proxy_weight(proxy.capacity, proxy.latency))
+                    for proxy in healthy or proxies],
+                   current_app.config["PROXY_MAX_ANSWERS"])
+
+    def select(self, ip_type, count=None):
+        """
+        Pick up to `count` addresses of a type, with probability proportional to their weight
+
+        All the addresses are returned, in their original order, when there are not more
+        than `count` of them. Otherwise the chosen addresses are returned in random order.
+        """
+        count = count or self.max_answers
+        candidates = self.candidates[ip_type]
+        if len(candidates) <= count:
+            return [ip_address for ip_address, weight in candidates]
+
+        # Weighted sampling without replacement, keep the addresses with the largest keys
+        keyed = ((random.random() ** (1.0 / weight), ip_address)
+                 for ip_address, weight in candidates)
+        return [ip_address for key, ip_address in heapq.nlargest(count, keyed)]
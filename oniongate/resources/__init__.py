@@ -1,3 +1,5 @@
 from .domains import Domains
-from .records import Records
+from .records import Records, RecordBatch
 from .proxies import Proxies
+from .changes import Changes
+from .snapshots import Snapshots
@@ -0,0 +1,127 @@
+"""
+Change feed presented on the API interface, for mirrors which follow the registry
+"""
+import json
+import time
+from collections import OrderedDict
+
+from flask import current_app, request, stream_with_context, Response
+from flask_restful import inputs, reqparse, Resource, abort
+from sqlalchemy import func
+
+from ..models import db, Change
+from ..models.change import COMPACTION_KIND, purged_through
+
+
+changes_parser = reqparse.RequestParser()
+changes_parser.add_argument('since', type=inputs.natural, default=0, location='args')
+changes_parser.add_argument('limit', type=inputs.positive, location='args')
+changes_parser.add_argument('wait', type=inputs.natural, default=0, location='args')
+changes_parser.add_argument('format', choices=('json', 'sse'), location='args')
+
+
+def change_dict(change):
+    return OrderedDict([
+        ('seq', change.seq),
+        ('kind', change.kind),
+        ('action', change.action),
+        ('key', change.key),
+        ('data', json.loads(change.data) if change.data else {}),
+        ('date_created', change.date_created.isoformat()),
+    ])
+
+
+def changes_since(since, limit):
+    """
+    Return up to `limit` changes after the sequence number `since`
+    """
+    return Change.query.filter(Change.seq > since, Change.kind != COMPACTION_KIND).\
+        order_by(Change.seq).limit(limit).\
+        with_entities(Change.seq, Change.kind, Change.action, Change.key, Change.data,
+                      Change.date_created).all()
+
+
+def latest_sequence():
+    return db.session.query(func.max(Change.seq)).scalar() or 0
+
+
+def wait_for_changes(since, limit, timeout):
+    """
+    Return the changes after `since`, polling for up to `timeout` seconds until there are some
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        changes = changes_since(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        # End the read transaction so the next poll sees newly committed changes
+        db.session.rollback()
+        time.sleep(min(current_app.config["CHANGES_POLL_INTERVAL"], remaining))
+
+
+def wants_event_stream(args):
+    if args.format:
+        return args.format == 'sse'
+    return request.accept_mimetypes.best == 'text/event-stream'
+
+
+class Changes(Resource):
+    def get(self):
+        """
+        Return the changes to domains, records and proxies after the sequence number `since`
+
+        With `wait` the request is held for up to that many seconds until there is a change.
+        Clients asking for `text/event-stream` or `format=sse` receive the changes as
+        Server-Sent Events instead, resuming from the Last-Event-ID header on reconnect.
+
+        Sequence numbers follow the order in which changes were committed, so a consumer
+        which has read up to a sequence number never misses a change with a lower one.
+        """
+        args = changes_parser.parse_args()
+        since = args.since
+        if 'Last-Event-ID' in request.headers:
+            try:
+                since = int(request.headers['Last-Event-ID'])
+            except ValueError:
+                return abort(400, message={'Last-Event-ID': "Must be a sequence number"})
+
+        # Consumers which missed purged deletions must download the full listing again
+        if since and since < purged_through():
+            return abort(410, message="Changes after {} have been compacted, download the "
+                         "full domain listing and follow the changes from the sequence "
+                         "number in its X-Change-Seq header".format(since))
+
+        limit = min(args.limit or current_app.config["CHANGES_PAGE_SIZE"],
+                    current_app.config["CHANGES_PAGE_SIZE"])
+        if wants_event_stream(args):
+            return Response(stream_with_context(self.stream(since, limit)),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+
+        wait = min(args.wait, current_app.config["CHANGES_MAX_WAIT"])
+        changes = wait_for_changes(since, limit, wait)
+        return {
+            'changes': [change_dict(change) for change in changes],
+            'last_seq': changes[-1].seq if changes else since,
+            'latest_seq': latest_sequence(),
+        }
+
+    @staticmethod
+    def stream(since, limit):
+        """
+        Send changes as Server-Sent Events until CHANGES_STREAM_DURATION has passed
+
+        Comments are sent while there are no changes so proxies don't close the connection.
+        """
+        deadline = time.monotonic() + current_app.config["CHANGES_STREAM_DURATION"]
+        yield "retry: {}\n\n".format(int(current_app.config["CHANGES_POLL_INTERVAL"] * 1000))
+        while time.monotonic() < deadline:
+            timeout = min(current_app.config["CHANGES_MAX_WAIT"], deadline - time.monotonic())
+            changes = wait_for_changes(since, limit, timeout)
+            if not changes:
+                yield ": keep-alive\n\n"
+            for change in changes:
+                yield "id: {}\nevent: change\ndata: {}\n\n".format(
+                    change.seq, json.dumps(change_dict(change)))
+                since = change.seq
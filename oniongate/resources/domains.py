@@ -1,16 +1,28 @@
 """
 Domain resource presented on the API interface
 """
+import json
+import base64
 import datetime
 from collections import OrderedDict
+from urllib.parse import urlencode
 
+from flask import current_app, request, stream_with_context, Response
 from flask_restful import fields, inputs, marshal_with, marshal, reqparse, Resource, abort
 from sqlalchemy import exc
 
 from .. import validators
+from ..conditional import (is_not_modified, latest, not_modified, validator_headers,
+                           version_etag)
+from ..serializers import Serializer
+from ..stats import invalidate_stats
+from ..suffixes import ownership_index
 from ..utils import auth_domain
-from ..models import Domain
-from .records import record_fields
+from ..models import db, Change, Domain
+from ..models.change import domain_data
+from ..models.mixins import commit_session
+from .changes import latest_sequence
+from .records import record_fields, records_version
 
 
 new_domain_parser = reqparse.RequestParser()
@@ -24,6 +36,21 @@ new_domain_parser.add_argument(
 update_domain_parser = new_domain_parser.copy()
 update_domain_parser.remove_argument('domain_name')
 
+list_domains_parser = reqparse.RequestParser()
+list_domains_parser.add_argument('limit', type=inputs.positive, location='args')
+list_domains_parser.add_argument('cursor', location='args')
+list_domains_parser.add_argument(
+    'order_by', choices=('id', 'date_created'), default='id', location='args',
+)
+list_domains_parser.add_argument('zone', location='args')
+list_domains_parser.add_argument('service_online', type=inputs.boolean, location='args')
+list_domains_parser.add_argument(
+    'updated_since', type=inputs.datetime_from_iso8601, location='args',
+)
+list_domains_parser.add_argument(
+    'format', choices=('json', 'ndjson'), default='json', location='args',
+)
+
 domain_fields = OrderedDict([
     ('domain_name', fields.String),
     ('zone', fields.String),
@@ -44,18 +71,166 @@ domain_fields_with_records['records'] = fields.Nested(record_fields)
 domain_fields_with_token = domain_fields.copy()
 domain_fields_with_token['update_token'] = fields.String(attribute='token')
 
+domain_serializer = Serializer(Domain, domain_fields)
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def sort_key(domain, order_by):
+    """
+    Return the sort key of a domain in a listing
+    """
+    if order_by == 'date_created':
+        return domain.date_created, domain.id
+    return (domain.id,)
+
+
+def encode_cursor(domain, order_by):
+    """
+    Create an opaque cursor pointing after a domain in a listing
+    """
+    key = [value.strftime(CURSOR_DATE_FORMAT) if isinstance(value, datetime.datetime)
+           else value for value in sort_key(domain, order_by)]
+    return base64.urlsafe_b64encode(json.dumps([order_by] + key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, order_by):
+    """
+    Load the sort key from a cursor, raising ValueError if the cursor is invalid
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if key[0] != order_by:
+            raise ValueError
+        if order_by == 'date_created':
+            return datetime.datetime.strptime(key[1], CURSOR_DATE_FORMAT), int(key[2])
+        return (int(key[1]),)
+    except (ValueError, TypeError, IndexError):
+        raise ValueError("The cursor is not valid for this listing")
+
+
+def filter_domains(args):
+    """
+    Build the query for the public domains matching the listing filters
+    """
+    domains = Domain.query.filter_by(public=True, deleted=False)
+    if args.zone:
+        domains = domains.filter_by(zone=args.zone.lower())
+    if args.service_online is not None:
+        domains = domains.filter_by(service_online=args.service_online)
+    if args.updated_since:
+        # Dates are stored as naive UTC, dates given without an offset are taken as UTC too
+        updated_since = args.updated_since
+        if updated_since.tzinfo is not None:
+            updated_since = updated_since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        domains = domains.filter(Domain.date_updated >= updated_since)
+    return domains
+
+
+def domain_page(domains, order_by, after, limit):
+    """
+    Return the next `limit` domains from a query, following the sort key `after`
+
+    Pages are found by seeking to the sort key rather than with an OFFSET, so every page
+    is as cheap to load as the first.
+    """
+    if order_by == 'date_created':
+        if after:
+            date_created, domain_id = after
+            domains = domains.filter(db.or_(
+                Domain.date_created > date_created,
+                db.and_(Domain.date_created == date_created, Domain.id > domain_id)))
+        domains = domains.order_by(Domain.date_created, Domain.id)
+    else:
+        if after:
+            domains = domains.filter(Domain.id > after[0])
+        domains = domains.order_by(Domain.id)
+    return domains.limit(limit).all()
+
+
+def next_page_link(cursor):
+    """
+    Return a Link header value pointing to the page after the cursor
+    """
+    args = [(key, value) for key, value in request.args.items(multi=True) if key != 'cursor']
+    args.append(('cursor', cursor))
+    return '<{}?{}>; rel="next"'.format(request.base_url, urlencode(args))
+
+
+def domain_version(domain_name):
+    """
+    Return the ETag and Last-Modified of a domain and its records, without loading them
+
+    Edits through the API bump `date_updated`, the scanner sets `service_last_checked` and
+    zone syncs clear `updated_since_synced`, so these columns change with the domain.
+    """
+    version = Domain.query.filter_by(domain_name=domain_name.lower(), deleted=False).\
+        with_entities(Domain.id, Domain.date_updated, Domain.service_last_checked,
+                      Domain.updated_since_synced).first()
+    if version is None:
+        return abort(404, message='Domain {} does not exist'.format(domain_name))
+    return (version_etag(*tuple(version) + tuple(records_version(version.id))),
+            latest(version.date_updated, version.service_last_checked))
+
 
 class Domains(Resource):
     def get(self, domain_name=None):
         """
-        Return a listing of all public domains resolved by this resolver
+        Return a listing of the public domains resolved by this resolver
+
+        The listing is returned a page at a time, with a Link header pointing to the next
+        page. With `format=ndjson` every matching domain is streamed as one JSON object
+        per line instead.
+
+        The X-Change-Seq header holds the latest change feed sequence number, read before
+        the listing, so a mirror can follow the changes from the first page onwards.
         """
         if domain_name:
+            etag, last_modified = domain_version(domain_name)
+            headers = validator_headers(etag, last_modified)
+            if is_not_modified(etag, last_modified):
+                return not_modified(headers)
+
             # Include DNS records when an individual domain is requested
-            return marshal(Domain.get_or_404(domain_name), domain_fields_with_records), 200
+            return marshal(Domain.get_or_404(domain_name), domain_fields_with_records), \
+                200, headers
+
+        args = list_domains_parser.parse_args()
+        after = None
+        if args.cursor:
+            try:
+                after = decode_cursor(args.cursor, args.order_by)
+            except ValueError as e:
+                return abort(400, message={'cursor': str(e)})
+        # Select the sort key as well as the serialized columns for the cursor
+        domains = filter_domains(args).with_entities(*domain_serializer.columns + [Domain.id])
+        headers = {'X-Change-Seq': str(latest_sequence())}
+
+        if args.format == 'ndjson':
+            return Response(stream_with_context(self.stream(domains, args.order_by, after)),
+                            mimetype='application/x-ndjson', headers=headers)
 
-        all_domains = Domain.query.filter_by(public=True, deleted=False).all()
-        return marshal(all_domains, domain_fields), 200
+        limit = min(args.limit or current_app.config["DOMAINS_PAGE_SIZE"],
+                    current_app.config["DOMAINS_MAX_PAGE_SIZE"])
+        page = domain_page(domains, args.order_by, after, limit + 1)
+        if len(page) > limit:
+            page = page[:limit]
+            headers['Link'] = next_page_link(encode_cursor(page[-1], args.order_by))
+        return domain_serializer.response(page, headers=headers)
+
+    @staticmethod
+    def stream(domains, order_by, after):
+        """
+        Yield every domain from the query as a line of JSON, loading a page at a time
+        """
+        batch_size = current_app.config["DOMAINS_MAX_PAGE_SIZE"]
+        while True:
+            page = domain_page(domains, order_by, after, batch_size)
+            for line in domain_serializer.dumps_items(page):
+                yield line + '\n'
+            if len(page) < batch_size:
+                break
+            after = sort_key(page[-1], order_by)
 
     @marshal_with(domain_fields_with_token)
     def post(self):
@@ -66,15 +241,24 @@ class Domains(Resource):
         updates to this domain mapping in future.
         """
         args = new_domain_parser.parse_args()
-        domain_name = "{}.{}".format(args.domain_name["label"], args.domain_name["zone"])
+        if args.domain_name["label"]:
+            domain_name = "{}.{}".format(args.domain_name["label"], args.domain_name["zone"])
+        else:
+            domain_name = args.domain_name["zone"]
         try:
-            domain = Domain.create(domain_name=domain_name,
-                                   zone=args.domain_name["zone"],
-                                   public=args.public)
+            domain = Domain(domain_name=domain_name,
+                            zone=args.domain_name["zone"],
+                            public=args.public).save(commit=False)
+            # Log the change in the same transaction as the new domain
+            Change.log('domain', 'create', domain_name, domain_data(domain), commit=False)
+            commit_session()
         except exc.IntegrityError:
             return abort(422,
                          message={'domain_name': "Domain {} already exists".format(domain_name)})
 
+        if not args.domain_name["label"]:
+            ownership_index().update_after_commit(domain_name)
+        invalidate_stats()
         return domain
 
     @auth_domain
@@ -83,6 +267,12 @@ class Domains(Resource):
         Allow the registered domain name to be deleted
         """
         domain = Domain.get_or_404(domain_name)
-        domain.update(deleted=True,
-                      date_updated=datetime.datetime.utcnow())
+        domain.update(commit=False,
+                      deleted=True,
+                      date_updated=datetime.datetime.utcnow(),
+                      updated_since_synced=True)
+        Change.log('domain', 'delete', domain.domain_name, commit=False)
+        commit_session()
+        ownership_index().update_after_commit(domain.domain_name, deleted=True)
+        invalidate_stats()
         return {"message": "Domain {} was deleted from our service".format(domain.domain_name)}
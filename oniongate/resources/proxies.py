@@ -1,10 +1,15 @@
 from collections import OrderedDict
 
-from flask_restful import fields, marshal_with, reqparse, Resource, abort
-from sqlalchemy import exc
+from flask_restful import fields, marshal, marshal_with, reqparse, Resource, abort
+from sqlalchemy import case, exc, func
 
 from .. import validators
-from ..models import Proxy
+from ..conditional import (is_not_modified, latest, not_modified, validator_headers,
+                           version_etag)
+from ..serializers import Serializer
+from ..stats import invalidate_stats
+from ..models import db, Change, Proxy
+from ..models.mixins import commit_session
 
 
 new_proxy_parser = reqparse.RequestParser()
@@ -23,18 +28,42 @@ proxy_fields = OrderedDict([
     ('online', fields.Boolean)
 ])
 
+proxy_serializer = Serializer(Proxy, proxy_fields)
+
+
+def proxies_version():
+    """
+    Return the ETag and Last-Modified of the proxy listing from one aggregate query
+
+    Every check sets `last_checked` and zone syncs clear `updated_since_synced`, so the
+    watermark changes whenever the listing does.
+    """
+    count, latest_id, last_checked, last_created, unsynced = db.session.query(
+        func.count(Proxy.id), func.max(Proxy.id), func.max(Proxy.last_checked),
+        func.max(Proxy.date_created),
+        func.sum(case([(Proxy.updated_since_synced == True, 1)], else_=0)),
+    ).one()
+    return (version_etag(count, latest_id, last_checked, last_created, unsynced),
+            latest(last_checked, last_created))
+
 
 class Proxies(Resource):
-    @marshal_with(proxy_fields)
     def get(self, ip_address=None):
         """
         View listing of all available proxies
         """
         if ip_address:
-            return Proxy.get_or_404(ip_address)
+            return marshal(Proxy.get_or_404(ip_address), proxy_fields)
+
+        etag, last_modified = proxies_version()
+        headers = validator_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return not_modified(headers)
 
         # Display online proxies first, then order by creation date
-        return Proxy.query.order_by(Proxy.online.desc(), Proxy.date_created).all()
+        proxies = Proxy.query.order_by(Proxy.online.desc(), Proxy.date_created).\
+            with_entities(*proxy_serializer.columns)
+        return proxy_serializer.response(proxies, headers=headers)
 
     @marshal_with(proxy_fields)
     def post(self):
@@ -45,10 +74,14 @@ class Proxies(Resource):
         ip_address = args.ip_address
 
         try:
-            proxy = Proxy.create(ip_address=str(ip_address),
-                                 ip_type=str(ip_address.version))
+            proxy = Proxy(ip_address=str(ip_address),
+                          ip_type=str(ip_address.version)).save(commit=False)
+            Change.log('proxy', 'create', proxy.ip_address, {'ip_type': proxy.ip_type},
+                       commit=False)
+            commit_session()
         except exc.IntegrityError:
             return abort(422, message="Proxy {} already exists".format(str(ip_address)))
 
+        invalidate_stats()
         return proxy
 
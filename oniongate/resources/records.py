@@ -5,12 +5,16 @@ import datetime
 from collections import OrderedDict
 
 from flask import g, current_app
-from flask_restful import fields, marshal_with, reqparse, Resource, abort
-from sqlalchemy import exc
+from flask_restful import fields, inputs, marshal, marshal_with, reqparse, Resource, abort
+from sqlalchemy import case, exc, func
 
 from .. import validators
+from ..conditional import is_not_modified, not_modified, validator_headers, version_etag
+from ..serializers import Serializer
 from ..utils import auth_domain, domain_exists
-from ..models import Record
+from ..models import db, Change, Record
+from ..models.change import domain_data, record_data, record_key
+from ..models.mixins import commit_session
 
 
 new_record_parser = reqparse.RequestParser()
@@ -29,28 +33,115 @@ record_fields = OrderedDict([
     ('updated_since_synced', fields.Boolean),
 ])
 
+record_serializer = Serializer(Record, record_fields)
+
 
 def is_onion_record(record_value):
     """
     Check if this record looks like an onion address mapping
     """
+    if "=" not in record_value:
+        return None
     key, value = record_value.lower().split("=", 1)
     if key and value:
-        return key == "onion" and validators.is_onion_address(value)
+        return (key == "onion" and validators.is_onion_address(value) and
+                not validators.is_restricted_onion(value))
     return None
 
 
+def string_field(item, name):
+    value = item.get(name)
+    if value is not None and not isinstance(value, str):
+        raise ValueError("The record {} must be a string".format(name))
+    return value or ''
+
+
+def parse_new_record(item):
+    """
+    Validate a record in a batch the same way `new_record_parser` validates a single record
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Each new record must be an object")
+    value = string_field(item, 'value')
+    if not value:
+        raise ValueError("A record value is required")
+    ttl = item.get('ttl')
+    if ttl is not None:
+        if isinstance(ttl, bool):
+            raise ValueError("The record ttl must be a number")
+        ttl = inputs.natural(ttl, 'ttl')
+    return {
+        'label': validators.label(string_field(item, 'label')),
+        'ttl': ttl,
+        'type': validators.allowed_dns_record_type(string_field(item, 'type')),
+        'value': value,
+    }
+
+
+def new_records(items):
+    """
+    Validate the list of records to create in a batch
+    """
+    if not isinstance(items, list):
+        raise ValueError("Expected a list of records")
+    records = []
+    for i, item in enumerate(items):
+        try:
+            records.append(parse_new_record(item))
+        except ValueError as e:
+            raise ValueError("Record {}: {}".format(i, e))
+    return records
+
+
+def record_ids(items):
+    """
+    Validate the list of record ids to delete in a batch
+    """
+    # Booleans are ints in Python, but true is not a record id
+    if not isinstance(items, list) or not all(isinstance(item, int) and
+                                              not isinstance(item, bool) for item in items):
+        raise ValueError("Expected a list of record ids")
+    return items
+
+
+batch_parser = reqparse.RequestParser()
+batch_parser.add_argument('create', type=new_records, default=[], location='json')
+batch_parser.add_argument('delete', type=record_ids, default=[], location='json')
+
+
+def records_version(domain_id):
+    """
+    Return the number of records on a domain, the latest record id and the number of
+    records waiting to be synced, in one aggregate query
+    """
+    return db.session.query(
+        func.count(Record.id), func.max(Record.id),
+        func.sum(case([(Record.updated_since_synced == True, 1)], else_=0)),
+    ).filter(Record.domain_id == domain_id).one()
+
+
 class Records(Resource):
     method_decorators = [domain_exists]
 
-    @marshal_with(record_fields)
     def get(self, domain_name, record_id=None):
         """
         Return a listing of all records for this domain
+
+        The listing is answered with 304 Not Modified when the client has the current
+        version, without loading the records.
         """
         if record_id:
-            return Record.get_or_404(domain=g.domain, record_id=record_id)
-        return Record.query.filter_by(domain=g.domain).all()
+            return marshal(Record.get_or_404(domain=g.domain, record_id=record_id),
+                           record_fields)
+
+        etag = version_etag(g.domain.date_updated, *records_version(g.domain.id))
+        headers = validator_headers(etag, g.domain.date_updated)
+        if is_not_modified(etag, g.domain.date_updated):
+            return not_modified(headers)
+
+        records = Record.query.filter_by(domain=g.domain).order_by(Record.id).\
+            with_entities(*record_serializer.columns)
+        return record_serializer.response(records, headers=headers)
 
     @marshal_with(record_fields)
     @auth_domain
@@ -72,26 +163,37 @@ class Records(Resource):
         if is_onion_record(args.value) and args.type == "TXT":
             probable_onion_mapping = args.value.split("=")[1]
 
+        # Mark the domain as changed so the DNS server picks up the new record
+        g.domain.date_updated = datetime.datetime.utcnow()
+
         try:
-            record = Record.create(domain=g.domain,
-                                   label=args.label,
-                                   ttl=args.ttl or current_app.config["TXT_RECORD_TTL"],
-                                   record_type=args.type,
-                                   value=args.value,
-                                   is_onion_mapping=probable_onion_mapping)
+            record = Record(domain=g.domain,
+                            label=args.label,
+                            ttl=args.ttl or current_app.config["TXT_RECORD_TTL"],
+                            record_type=args.type,
+                            value=args.value,
+                            is_onion_mapping=probable_onion_mapping).save(commit=False)
+            db.session.flush()
         except exc.IntegrityError:
             return abort(422, message="An unknown error occurred when trying to create "
                          "this record")
+        Change.log('record', 'create', record_key(g.domain.domain_name, record.id),
+                   record_data(record), commit=False)
 
         # Guess that the user is updating their onion address if its a valid
         # onion=theonionaddress.onion type TXT record
         if probable_onion_mapping:
             # Update the convenience onion_address wrapper on the domain
-            g.domain.update(onion_address=probable_onion_mapping,
+            g.domain.update(commit=False,
+                            onion_address=probable_onion_mapping,
                             date_updated=datetime.datetime.utcnow(),
                             service_online=True,
                             updated_since_synced=True)
+            Change.log('domain', 'update', g.domain.domain_name, domain_data(g.domain),
+                       commit=False)
 
+        # Commit the record, the domain and their changes together
+        commit_session()
         return record
 
     @auth_domain
@@ -109,10 +211,104 @@ class Records(Resource):
                                       record_type="TXT",
                                       value=record.value).count() == 1:
                 # Last mapping with this onion address, remove onion address from the domain
-                g.domain.update(onion_address=None,
+                g.domain.update(commit=False,
+                                onion_address=None,
                                 date_updated=datetime.datetime.utcnow(),
                                 service_online=False,
                                 updated_since_synced=True)
+                Change.log('domain', 'update', g.domain.domain_name, domain_data(g.domain),
+                           commit=False)
 
-        record.delete()
+        # Flag the domain so the record is removed from DNS on the next sync
+        g.domain.date_updated = datetime.datetime.utcnow()
+        g.domain.updated_since_synced = True
+        record.delete(commit=False)
+        Change.log('record', 'delete', record_key(g.domain.domain_name, record.id),
+                   commit=False)
+        commit_session()
         return {"message": "Record has been deleted"}
+
+
+class RecordBatch(Resource):
+    method_decorators = [domain_exists]
+
+    @auth_domain
+    def post(self, domain_name):
+        """
+        Create and delete several DNS records on this domain in a single transaction
+
+        The request body lists the records to `create` and the ids of the records to
+        `delete`. Either every change is applied or none of them are.
+        """
+        args = batch_parser.parse_args()
+        new_records = args.create
+
+        delete_ids, deleted_records = set(args.delete), []
+        if delete_ids:
+            deleted_records = Record.query.filter(Record.domain == g.domain,
+                                                  Record.id.in_(delete_ids)).all()
+        missing_ids = delete_ids - set(record.id for record in deleted_records)
+        if missing_ids:
+            return abort(404, message="Records {} do not exist".format(
+                ", ".join(str(record_id) for record_id in sorted(missing_ids))))
+
+        num_records = Record.query.filter_by(domain=g.domain).count()
+        num_records += len(new_records) - len(deleted_records)
+        if num_records > current_app.config["MAX_RECORDS"]:
+            return abort(403, message="This change would take the domain over the DNS record "
+                         "limit of {}".format(current_app.config["MAX_RECORDS"]))
+
+        try:
+            created = self.apply(new_records, deleted_records)
+        except exc.IntegrityError:
+            db.session.rollback()
+            return abort(422, message="An unknown error occurred when trying to apply "
+                         "these changes")
+
+        return {'created': marshal(created, record_fields),
+                'deleted': sorted(record.id for record in deleted_records)}
+
+    @staticmethod
+    def apply(new_records, deleted_records):
+        """
+        Make the record changes and update the domain, committing them together
+        """
+        for record in deleted_records:
+            record.delete(commit=False)
+            Change.log('record', 'delete', record_key(g.domain.domain_name, record.id),
+                       commit=False)
+
+        created, onion_address = [], None
+        for new_record in new_records:
+            probable_onion_mapping = None
+            if is_onion_record(new_record['value']) and new_record['type'] == "TXT":
+                probable_onion_mapping = onion_address = new_record['value'].split("=")[1]
+            created.append(Record(domain=g.domain,
+                                  label=new_record['label'],
+                                  ttl=new_record['ttl'] or current_app.config["TXT_RECORD_TTL"],
+                                  record_type=new_record['type'],
+                                  value=new_record['value'],
+                                  is_onion_mapping=probable_onion_mapping).save(commit=False))
+
+        # Flush the new records to log their ids
+        db.session.flush()
+        for record in created:
+            Change.log('record', 'create', record_key(g.domain.domain_name, record.id),
+                       record_data(record), commit=False)
+
+        changes = {'date_updated': datetime.datetime.utcnow(), 'updated_since_synced': True}
+        if onion_address:
+            changes.update(onion_address=onion_address, service_online=True)
+        elif g.domain.onion_address and deleted_records:
+            # Remove the onion address if no remaining record maps to it
+            db.session.flush()
+            if not Record.query.filter_by(domain=g.domain,
+                                          is_onion_mapping=g.domain.onion_address).count():
+                changes.update(onion_address=None, service_online=False)
+
+        g.domain.update(commit=False, **changes)
+        if 'onion_address' in changes:
+            Change.log('domain', 'update', g.domain.domain_name, domain_data(g.domain),
+                       commit=False)
+        commit_session()
+        return created
@@ -0,0 +1,25 @@
+"""
+Snapshot resource presented on the API interface, for entry proxies which hold all the
+mappings locally
+"""
+from flask import send_from_directory
+from flask_restful import Resource, abort
+
+from ..snapshot import load_manifest, snapshot_directory
+
+
+class Snapshots(Resource):
+    def get(self, filename=None):
+        """
+        Return the manifest of the latest snapshot, or download a snapshot or delta file
+
+        Files are sent with ETag and Last-Modified headers so unchanged files aren't
+        downloaded again.
+        """
+        if filename is None:
+            manifest = load_manifest()
+            if manifest is None:
+                return abort(404, message="No snapshot has been published yet")
+            return manifest
+        return send_from_directory(snapshot_directory(), filename,
+                                   mimetype='application/octet-stream')
@@ -0,0 +1,177 @@
+"""
+Scan the onion services of registered domains to find out which ones are reachable
+"""
+import struct
+import asyncio
+import datetime
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+from .models import db, Domain
+
+
+class ScannerError(Exception):
+    """
+    The scanner could not tell whether a service is reachable
+    """
+
+
+class SocksConnector(object):
+    """
+    Check onion services by connecting to them through a Tor SOCKS5 port
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    async def check(self, onion_address, port):
+        """
+        Return True if Tor could connect to the onion service, False if it could not
+        """
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            raise ScannerError("Could not connect to the SOCKS port: {}".format(e))
+
+        try:
+            # Greeting without authentication
+            writer.write(b'\x05\x01\x00')
+            if await reader.readexactly(2) != b'\x05\x00':
+                raise ScannerError("The SOCKS port refused our greeting")
+
+            # Ask Tor to connect to the onion address by name
+            host = onion_address.encode('ascii')
+            writer.write(b'\x05\x01\x00\x03' + bytes([len(host)]) + host +
+                         struct.pack('!H', port))
+            version, reply = await reader.readexactly(2)
+            return reply == 0
+        except asyncio.IncompleteReadError:
+            raise ScannerError("The SOCKS port closed the connection")
+        finally:
+            writer.close()
+
+
+def default_connector():
+    """
+    Create the connector for the Tor SOCKS port in the config
+    """
+    return SocksConnector(current_app.config["TOR_SOCKS_HOST"],
+                          current_app.config["TOR_SOCKS_PORT"])
+
+
+def domains_due_for_scan(limit):
+    """
+    Return the (id, onion address) of the domains which have gone longest without a scan
+
+    Only domains which have not been scanned for SCANNER_RESCAN_INTERVAL are returned,
+    so repeated runs spread the rescans out instead of probing every domain at once.
+    """
+    rescan_interval = datetime.timedelta(seconds=current_app.config["SCANNER_RESCAN_INTERVAL"])
+    cutoff = datetime.datetime.utcnow() - rescan_interval
+    return db.session.query(Domain.id, Domain.onion_address).\
+        filter(Domain.onion_address != None,
+               Domain.deleted == False,
+               db.or_(Domain.service_last_checked == None,
+                      Domain.service_last_checked < cutoff)).\
+        order_by(Domain.service_last_checked, Domain.id).limit(limit).all()
+
+
+def save_scan_results(results):
+    """
+    Write a batch of (domain id, online, checked at) results back to the domains
+    """
+    table = Domain.__table__
+    online = [{'domain_id': domain_id, 'checked_at': checked_at}
+              for domain_id, is_online, checked_at in results if is_online]
+    offline = [{'domain_id': domain_id, 'checked_at': checked_at}
+               for domain_id, is_online, checked_at in results if not is_online]
+
+    if online:
+        db.session.execute(table.update().where(table.c.id == bindparam('domain_id')).values(
+            service_online=True, service_last_online=bindparam('checked_at'),
+            service_last_checked=bindparam('checked_at')), online)
+    if offline:
+        db.session.execute(table.update().where(table.c.id == bindparam('domain_id')).values(
+            service_online=False, service_last_checked=bindparam('checked_at')), offline)
+    db.session.commit()
+
+
+class DomainScanner(object):
+    """
+    Check many onion services concurrently and save the results in batches
+    """
+    def __init__(self, connector, concurrency, timeout, port, batch_size):
+        self.connector = connector
+        self.concurrency = concurrency
+        # Created in `scan`, inside the loop it must be bound to on older Pythons
+        self.semaphore = None
+        self.timeout = timeout
+        self.port = port
+        self.batch_size = batch_size
+        self.pending = []
+        self.counts = {'online': 0, 'offline': 0, 'failed': 0}
+
+    async def scan_domain(self, domain_id, onion_address):
+        """
+        Check a single onion service and queue the result to be saved
+        """
+        async with self.semaphore:
+            try:
+                is_online = await asyncio.wait_for(
+                    self.connector.check(onion_address, self.port), self.timeout)
+            except asyncio.TimeoutError:
+                is_online = False
+            except ScannerError as e:
+                # Don't mark the service offline when we couldn't check it
+                current_app.logger.warning("Could not scan %s: %s", onion_address, e)
+                self.counts['failed'] += 1
+                return
+
+        self.counts['online' if is_online else 'offline'] += 1
+        self.pending.append((domain_id, is_online, datetime.datetime.utcnow()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Save the queued results
+        """
+        results, self.pending = self.pending, []
+        if results:
+            save_scan_results(results)
+
+    async def scan(self, domains):
+        """
+        Scan a list of (domain id, onion address) tuples
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self.scan_domain(domain_id, onion_address)
+                               for domain_id, onion_address in domains])
+        self.flush()
+        return self.counts
+
+
+def scan_domains(connector=None):
+    """
+    Scan the domains which are due for a check, up to SCANNER_MAX_DOMAINS_PER_RUN
+
+    Returns the number of services found online and offline, and the number of checks
+    which failed.
+    """
+    config = current_app.config
+    domains = domains_due_for_scan(config["SCANNER_MAX_DOMAINS_PER_RUN"])
+    db.session.commit()
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        scanner = DomainScanner(connector or default_connector(),
+                                concurrency=config["SCANNER_CONCURRENCY"],
+                                timeout=config["SCANNER_TIMEOUT"],
+                                port=config["SCANNER_ONION_PORT"],
+                                batch_size=config["SCANNER_UPDATE_BATCH_SIZE"])
+        return loop.run_until_complete(scanner.scan(domains))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,139 @@
+"""
+Fast serialization of API listings, producing the same JSON as `marshal` and `output_json`
+
+A `Serializer` compiles a flask_restful field map once into the JSON text which surrounds
+each value, then serializes rows selected straight from the database. Only the columns
+named by the fields are loaded and no ORM objects are created.
+"""
+import json
+from collections import OrderedDict
+from json.encoder import encode_basestring, encode_basestring_ascii
+
+from flask import current_app, make_response
+from flask_restful import fields, inputs, reqparse
+
+
+output_parser = reqparse.RequestParser()
+output_parser.add_argument('compact', type=inputs.boolean, default=False, location='args')
+
+
+def compile_field(field, encode_string):
+    """
+    Return a function which formats a value the way `field` does, as JSON text
+    """
+    default = json.dumps(field.default)
+    if isinstance(field, fields.DateTime) and field.dt_format == 'iso8601':
+        return lambda value: default if value is None else encode_string(value.isoformat())
+    if isinstance(field, fields.Boolean):
+        return lambda value: default if value is None else ('true' if value else 'false')
+    if isinstance(field, fields.Integer):
+        return lambda value: default if value is None else str(int(value))
+    if isinstance(field, fields.String):
+        return lambda value: default if value is None else encode_string(str(value))
+    raise TypeError("Cannot compile a serializer for {!r}".format(field))
+
+
+def json_settings(compact=False):
+    """
+    Return the JSON settings used by `output_json`, or the settings for compact output
+    """
+    settings = dict(current_app.config.get('RESTFUL_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+        settings.setdefault('sort_keys', True)
+    if compact:
+        settings.pop('indent', None)
+        settings['separators'] = (',', ':')
+    return settings
+
+
+def layout(settings):
+    """
+    Return the indent string and the item and key separators `json.dumps` uses
+    """
+    indent = settings.get('indent')
+    if isinstance(indent, int):
+        indent = ' ' * indent
+    item_separator, key_separator = settings.get('separators') or (
+        (',' if indent is not None else ', '), ': ')
+    return indent, item_separator, key_separator
+
+
+class Serializer(object):
+    """
+    Serialize rows of a model with a field map
+    """
+    def __init__(self, model, field_map):
+        # Field maps may hold field classes as well as instances, like `marshal` allows
+        self.field_map = OrderedDict((key, field() if isinstance(field, type) else field)
+                                     for key, field in field_map.items())
+        self.columns = [getattr(model, field.attribute or key)
+                        for key, field in self.field_map.items()]
+        self.templates = {}
+
+    def template(self, settings, level):
+        """
+        Compile the JSON text around each value of an object nested `level` deep
+
+        Returns a list of (text before the value, column index, formatter) and the text
+        which closes the object.
+        """
+        indent, item_separator, key_separator = layout(settings)
+        sort_keys = settings.get('sort_keys', False)
+        ensure_ascii = settings.get('ensure_ascii', True)
+
+        key = (indent, item_separator, key_separator, sort_keys, ensure_ascii, level)
+        if key not in self.templates:
+            encode_string = encode_basestring_ascii if ensure_ascii else encode_basestring
+            newline, closing = '', ''
+            if indent is not None:
+                newline, closing = '\n' + indent * (level + 1), '\n' + indent * level
+
+            names = list(self.field_map.keys())
+            formatters = [(i, compile_field(field, encode_string))
+                          for i, field in enumerate(self.field_map.values())]
+            if sort_keys:
+                formatters.sort(key=lambda formatter: names[formatter[0]])
+
+            parts = []
+            for position, (i, formatter) in enumerate(formatters):
+                opening = '{' if position == 0 else item_separator
+                parts.append((opening + newline + encode_string(names[i]) + key_separator,
+                              i, formatter))
+            self.templates[key] = (parts, closing + '}')
+        return self.templates[key]
+
+    def dumps_items(self, rows, compact=True):
+        """
+        Yield the JSON text of each row on its own
+        """
+        parts, end = self.template(json_settings(compact), 0)
+        for row in rows:
+            yield ''.join([prefix + formatter(row[i]) for prefix, i, formatter in parts]) + end
+
+    def dumps(self, rows, compact=False):
+        """
+        Return the JSON text of a list of rows
+        """
+        settings = json_settings(compact)
+        parts, end = self.template(settings, 1)
+        items = [''.join([prefix + formatter(row[i]) for prefix, i, formatter in parts]) + end
+                 for row in rows]
+        if not items:
+            return '[]'
+
+        indent, item_separator, _ = layout(settings)
+        if indent is None:
+            return '[' + item_separator.join(items) + ']'
+        return '[\n' + indent + (item_separator + '\n' + indent).join(items) + '\n]'
+
+    def response(self, rows, code=200, headers=None, compact=None):
+        """
+        Make a JSON response for a list of rows, in the compact form when it was requested
+        """
+        if compact is None:
+            compact = output_parser.parse_args().compact
+        response = make_response(self.dumps(rows, compact) + "\n", code)
+        response.mimetype = 'application/json'
+        response.headers.extend(headers or {})
+        return response
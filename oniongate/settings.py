@@ -18,10 +18,106 @@ class Config(object):
 
     MAX_RECORDS = 20
 
+    # Defer the commits made while handling an API request to a single commit at the end
+    UNIT_OF_WORK_PER_REQUEST = True
+
+    # Time requests and serve Prometheus metrics on /metrics. The endpoint is not
+    # authenticated, so restrict access to it in the web server.
+    METRICS_ENABLED = True
+
+    # Log the queries of every request and CLI command, warning about likely N+1 queries.
+    # A SELECT of the same shape run with this many different parameters is reported.
+    SQL_PROFILER_ENABLED = False
+    SQL_PROFILER_N_PLUS_ONE_THRESHOLD = 5
+
+    # Number of recently verified update tokens kept to skip checking their signature again
+    JWT_CACHE_SIZE = 4096
+
+    # Seconds the home page statistics are cached before they are counted again
+    HOME_STATS_CACHE_TTL = 60
+
+    # Number of domains returned in each page of the domain listing, unless a limit is given
+    DOMAINS_PAGE_SIZE = 100
+    DOMAINS_MAX_PAGE_SIZE = 1000
+
+    # Number of entries returned by each request to the change feed
+    CHANGES_PAGE_SIZE = 1000
+    # Longest a change feed request is held open waiting for a change, and how often the
+    # log is checked for new entries while it waits, in seconds
+    CHANGES_MAX_WAIT = 30
+    CHANGES_POLL_INTERVAL = 1
+    # Server-Sent Event streams are closed after this many seconds, clients reconnect
+    CHANGES_STREAM_DURATION = 300
+    # Entries older than this many seconds are removed once a later entry has the same key
+    CHANGES_COMPACT_AFTER = 24 * 3600
+    # Deletions are removed from the log entirely after this many seconds
+    CHANGES_PURGE_DELETES_AFTER = 30 * 24 * 3600
+
+    # Directory of the published mapping snapshots, instance/snapshots by default
+    SNAPSHOT_DIR = None
+    # Number of deltas between consecutive snapshots which are kept for proxies to catch up
+    SNAPSHOT_MAX_DELTAS = 100
+
     # The label which holds the A and AAAA records point to the online proxies
     PROXY_ZONE = "proxy.oniongate.com"
 
-    # A list of public domains and subdomains which cannot be registered on this resolver
+    # Maximum number of A and AAAA records for the proxies returned in one answer
+    PROXY_MAX_ANSWERS = 8
+
+    # Proxies which have not passed a check for this many seconds are not returned
+    PROXY_MAX_CHECK_AGE = 3600
+
+    # Latency in seconds assumed for proxies which have not been measured
+    PROXY_DEFAULT_LATENCY = 0.5
+
+    # Proxies are checked with a HTTP request to this port
+    PROXY_CHECK_PORT = 80
+    PROXY_CHECK_TIMEOUT = 10
+    # Maximum number of proxy checks in flight at once
+    PROXY_CHECK_CONCURRENCY = 100
+
+    # Tor SOCKS port used to check whether onion services are reachable
+    TOR_SOCKS_HOST = "127.0.0.1"
+    TOR_SOCKS_PORT = 9050
+
+    # Onion services are checked by connecting to this port through Tor
+    SCANNER_ONION_PORT = 80
+    SCANNER_TIMEOUT = 60
+    # Maximum number of onion service checks in flight at once
+    SCANNER_CONCURRENCY = 500
+    # Each service is rescanned after this many seconds. Every run only scans the domains
+    # which have waited longest, so the rescans are spread out over the interval.
+    SCANNER_RESCAN_INTERVAL = 3600
+    SCANNER_MAX_DOMAINS_PER_RUN = 5000
+    # Number of scan results written to the database in each batch
+    SCANNER_UPDATE_BATCH_SIZE = 500
+
+    # Number of domains streamed from the database at a time when writing zone files
+    ZONE_QUERY_BATCH_SIZE = 1000
+
+    # Address of the built-in DNS server and how often it reloads changes, in seconds
+    DNS_SERVER_HOST = "127.0.0.1"
+    DNS_SERVER_PORT = 5353
+    DNS_SERVER_REFRESH_INTERVAL = 5
+    DNS_SERVER_REFRESH_OVERLAP = 5
+    # Largest UDP response sent whatever EDNS buffer size a query advertises, so the server
+    # can't be used to amplify traffic. 1232 bytes avoids IP fragmentation.
+    DNS_SERVER_MAX_UDP_PAYLOAD = 1232
+
+    # Nameserver which accepts RFC 2136 dynamic updates for our zones
+    DNS_UPDATE_SERVER = "127.0.0.1"
+    DNS_UPDATE_PORT = 53
+    DNS_UPDATE_TIMEOUT = 10
+
+    # Maximum number of RRset changes sent in each update message
+    DNS_UPDATE_BATCH_SIZE = 200
+
+    # Optional TSIG key for signing updates, e.g. {"oniongate-key.": "c2VjcmV0"}
+    DNS_UPDATE_TSIG_KEY = None
+
+    # A list of public domains and subdomains which cannot be registered on this resolver.
+    # This list and RESTRICTED_ONIONS are compiled once, replace them rather than editing
+    # them in place.
     DOMAIN_BLACKLIST = [
         SUBDOMAIN_HOST,
         'proxy',
@@ -31,10 +127,18 @@ class Config(object):
     # A list of onion address which cannot be registered
     RESTRICTED_ONIONS = []
 
-    # Only allow registration of subdomains for now to prevent
-    # potential security issues.
+    # Only allow registration of subdomains. Full domains are checked against the public
+    # suffix list and the zones which are already registered when this is turned off.
     FQDN_REGISTRATION_CLOSED = True
 
+    # Path of the public suffix list, the copy bundled in oniongate/data is used by default
+    PUBLIC_SUFFIX_LIST = None
+
+    # Seconds before the index of registered zones loads the changes made by other
+    # processes, and the overlap allowed for updates committed during the last refresh
+    OWNERSHIP_INDEX_MAX_AGE = 5
+    OWNERSHIP_INDEX_OVERLAP = 5
+
     # Restrict DNS record to a set of allowed types
     ALLOWED_DNS_RECORD_TYPES = [
         "TXT",
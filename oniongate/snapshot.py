@@ -0,0 +1,289 @@
+"""
+Versioned binary snapshots of the domain to onion address mappings, for entry proxies
+
+A snapshot holds every active mapping sorted by domain name. It starts with a header and
+an index of fixed size entries pointing into a table of names and onion addresses, so a
+proxy can memory-map the file and binary search it without parsing it. Snapshots are
+versioned by the sequence number of the change log, and each new snapshot is published
+with a delta from the previous version, so proxies only download what changed.
+
+Snapshot layout, all integers big-endian:
+
+    header  magic 'OGSN', format (u16), padding (2 bytes), version (u64), count (u32)
+    index   count entries of offset (u32), name length (u8), onion length (u8)
+    strings the name followed by the onion address of each entry, without '.onion'
+
+Delta layout:
+
+    header  magic 'OGDL', format (u16), padding (2 bytes), from version (u64),
+            to version (u64), count (u32)
+    entries name length (u8), onion length (u8), name, onion. An onion length of 0
+            removes the mapping.
+"""
+import os
+import json
+import mmap
+import struct
+
+from flask import current_app
+from sqlalchemy import func
+
+from .dns import atomic_write
+from .models import db, Change, Domain
+from .models.change import purged_through
+
+SNAPSHOT_MAGIC = b'OGSN'
+DELTA_MAGIC = b'OGDL'
+FORMAT_VERSION = 1
+
+SNAPSHOT_HEADER = struct.Struct('>4sHxxQI')
+DELTA_HEADER = struct.Struct('>4sHxxQQI')
+INDEX_ENTRY = struct.Struct('>IBB')
+DELTA_ENTRY = struct.Struct('>BB')
+
+ONION_SUFFIX = '.onion'
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def onion_label(onion_address):
+    if onion_address.endswith(ONION_SUFFIX):
+        return onion_address[:-len(ONION_SUFFIX)]
+    return onion_address
+
+
+def encode_mapping(domain_name, onion_address):
+    """
+    Return the name and onion address of a mapping as bytes, as they are stored in a file
+    """
+    name = domain_name.encode('ascii')
+    onion = onion_label(onion_address).encode('ascii') if onion_address else b''
+    if len(name) > 255 or len(onion) > 255:
+        raise SnapshotError("Mapping {} is too long to store".format(domain_name))
+    return name, onion
+
+
+def write_snapshot(file_handler, version, mappings):
+    """
+    Write a snapshot of (domain name, onion address) mappings sorted by domain name
+    """
+    entries = [encode_mapping(domain_name, onion_address)
+               for domain_name, onion_address in mappings]
+    file_handler.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, FORMAT_VERSION, version,
+                                            len(entries)))
+    offset = 0
+    for name, onion in entries:
+        file_handler.write(INDEX_ENTRY.pack(offset, len(name), len(onion)))
+        offset += len(name) + len(onion)
+    for name, onion in entries:
+        file_handler.write(name + onion)
+
+
+def write_delta(file_handler, from_version, to_version, changes):
+    """
+    Write the (domain name, onion address or None) changes between two snapshot versions
+    """
+    entries = [encode_mapping(domain_name, onion_address)
+               for domain_name, onion_address in changes]
+    file_handler.write(DELTA_HEADER.pack(DELTA_MAGIC, FORMAT_VERSION, from_version,
+                                         to_version, len(entries)))
+    for name, onion in entries:
+        file_handler.write(DELTA_ENTRY.pack(len(name), len(onion)) + name + onion)
+
+
+class Snapshot(object):
+    """
+    Read only view of a snapshot held in a bytes-like buffer, such as a memory map
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        if len(buffer) < SNAPSHOT_HEADER.size:
+            raise SnapshotError("The snapshot is truncated")
+        magic, format_version, self.version, self.count = \
+            SNAPSHOT_HEADER.unpack_from(buffer, 0)
+        if magic != SNAPSHOT_MAGIC or format_version != FORMAT_VERSION:
+            raise SnapshotError("Not a version {} snapshot".format(FORMAT_VERSION))
+        self.strings_offset = SNAPSHOT_HEADER.size + INDEX_ENTRY.size * self.count
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-map a snapshot file
+        """
+        with open(path, 'rb') as file_handler:
+            return cls(mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        """
+        Return the name and onion label of entry `i` as bytes
+        """
+        offset, name_length, onion_length = INDEX_ENTRY.unpack_from(
+            self.buffer, SNAPSHOT_HEADER.size + INDEX_ENTRY.size * i)
+        start = self.strings_offset + offset
+        return (bytes(self.buffer[start:start + name_length]),
+                bytes(self.buffer[start + name_length:start + name_length + onion_length]))
+
+    def lookup(self, domain_name):
+        """
+        Return the onion address of a domain name, or None, with a binary search
+        """
+        name = domain_name.lower().rstrip('.').encode('ascii', 'replace')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry_name, onion = self.entry(middle)
+            if entry_name < name:
+                low = middle + 1
+            elif entry_name > name:
+                high = middle
+            else:
+                return onion.decode('ascii') + ONION_SUFFIX
+        return None
+
+    def items(self):
+        for i in range(self.count):
+            name, onion = self.entry(i)
+            yield name.decode('ascii'), onion.decode('ascii') + ONION_SUFFIX
+
+
+def read_delta(buffer):
+    """
+    Return the from and to versions of a delta and its list of (domain name, onion or None)
+    """
+    magic, format_version, from_version, to_version, count = \
+        DELTA_HEADER.unpack_from(buffer, 0)
+    if magic != DELTA_MAGIC or format_version != FORMAT_VERSION:
+        raise SnapshotError("Not a version {} delta".format(FORMAT_VERSION))
+
+    changes, offset = [], DELTA_HEADER.size
+    for _ in range(count):
+        name_length, onion_length = DELTA_ENTRY.unpack_from(buffer, offset)
+        offset += DELTA_ENTRY.size
+        name = bytes(buffer[offset:offset + name_length]).decode('ascii')
+        onion = bytes(buffer[offset + name_length:offset + name_length + onion_length])
+        offset += name_length + onion_length
+        changes.append((name, onion.decode('ascii') + ONION_SUFFIX if onion else None))
+    return from_version, to_version, changes
+
+
+def apply_delta(mappings, buffer):
+    """
+    Apply a delta to a dict of mappings, returning the version it brings them to
+    """
+    from_version, to_version, changes = read_delta(buffer)
+    for domain_name, onion_address in changes:
+        if onion_address:
+            mappings[domain_name] = onion_address
+        else:
+            mappings.pop(domain_name, None)
+    return to_version
+
+
+def active_mappings(domain_query=None):
+    """
+    Return the sorted (domain name, onion address) of the live domains with an onion address
+
+    Sorting is done here so the order is the byte order of the names, whatever the
+    collation of the database.
+    """
+    domain_query = domain_query or Domain.query
+    rows = domain_query.filter(Domain.deleted == False, Domain.onion_address != None).\
+        with_entities(Domain.domain_name, Domain.onion_address).\
+        yield_per(current_app.config["ZONE_QUERY_BATCH_SIZE"])
+    return sorted((domain_name, onion_address) for domain_name, onion_address in rows)
+
+
+def changed_mappings(from_version):
+    """
+    Return the current mappings of every domain logged as changed after `from_version`
+
+    Domains which no longer have an active mapping are returned with None.
+    """
+    keys = sorted(key for key, in db.session.query(Change.key).distinct().filter(
+        Change.kind == 'domain', Change.seq > from_version))
+    changes = []
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        current = dict(active_mappings(Domain.query.filter(Domain.domain_name.in_(chunk))))
+        changes.extend((key, current.get(key)) for key in chunk)
+    return changes
+
+
+def snapshot_directory():
+    directory = current_app.config.get('SNAPSHOT_DIR') or \
+        os.path.join(current_app.instance_path, 'snapshots')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def load_manifest(directory=None):
+    """
+    Load the manifest of the published snapshot and deltas, or None
+    """
+    try:
+        with open(os.path.join(directory or snapshot_directory(), MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def publish_snapshot():
+    """
+    Write a snapshot of the current mappings and the delta from the previous snapshot
+
+    The manifest lists the latest snapshot and the chain of recent deltas leading to it.
+    Nothing is written when there were no changes since the last snapshot. Returns the
+    manifest.
+    """
+    directory = snapshot_directory()
+    manifest = load_manifest(directory) or {'version': None, 'deltas': []}
+    previous_files = {delta['file'] for delta in manifest['deltas']}
+    if manifest.get('snapshot'):
+        previous_files.add(manifest['snapshot'])
+
+    # Read the version first, changes made while the snapshot is written are picked up again
+    # by the next delta
+    version = db.session.query(func.max(Change.seq)).scalar() or 0
+    if version == manifest['version']:
+        return manifest
+
+    mappings = active_mappings()
+    snapshot_name = 'domains-{}.snap'.format(version)
+    with atomic_write(os.path.join(directory, snapshot_name), 'wb') as file_handler:
+        write_snapshot(file_handler, version, mappings)
+
+    deltas = manifest['deltas']
+    previous = manifest['version']
+    # Deltas can't be made across deletions which have been purged from the change log
+    if previous is not None and previous >= purged_through():
+        delta_name = 'domains-{}-{}.delta'.format(previous, version)
+        with atomic_write(os.path.join(directory, delta_name), 'wb') as file_handler:
+            write_delta(file_handler, previous, version, changed_mappings(previous))
+        deltas.append({'from': previous, 'to': version, 'file': delta_name})
+    else:
+        deltas = []
+
+    manifest = {
+        'version': version,
+        'count': len(mappings),
+        'snapshot': snapshot_name,
+        'deltas': deltas[-current_app.config["SNAPSHOT_MAX_DELTAS"]:],
+    }
+    with atomic_write(os.path.join(directory, MANIFEST_NAME)) as file_handler:
+        json.dump(manifest, file_handler)
+
+    # Remove the files which are no longer listed. Those of the previous manifest are kept
+    # for one more cycle, for proxies which read it just before it was replaced.
+    published = {snapshot_name} | {delta['file'] for delta in manifest['deltas']} | \
+        previous_files
+    for filename in os.listdir(directory):
+        if filename.endswith(('.snap', '.delta')) and filename not in published:
+            os.remove(os.path.join(directory, filename))
+    return manifest
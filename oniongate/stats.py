@@ -0,0 +1,61 @@
+"""
+Summary statistics for the home page, cached in each process for HOME_STATS_CACHE_TTL
+"""
+import time
+
+from flask import current_app
+from sqlalchemy import case, func
+
+from .models import Domain, Proxy
+
+
+def count_with_online(query, online_column):
+    """
+    Count all the rows of a query and the rows which are online in a single query
+    """
+    total, online = query.with_entities(
+        func.count(), func.sum(case([(online_column == True, 1)], else_=0))).one()
+    return total, int(online or 0)
+
+
+def collect_stats():
+    """
+    Query the statistics shown on the home page
+    """
+    num_domains_issued, online_domains = count_with_online(
+        Domain.query.filter_by(deleted=False), Domain.service_online)
+    num_entry_proxies, online_entry_proxies = count_with_online(Proxy.query, Proxy.online)
+
+    # Keep plain values so the cached stats never refer to a database session
+    recent_domains = [{'domain_name': domain.domain_name,
+                       'onion_address': domain.onion_address,
+                       'date_created': domain.date_created}
+                      for domain in Domain.recent_public_domains(10)]
+
+    return {
+        'recent_domains': recent_domains,
+        'num_domains_issued': num_domains_issued,
+        'percent_online_domains': online_domains / num_domains_issued if num_domains_issued else 0,
+        'num_entry_proxies': num_entry_proxies,
+        'percent_online_proxies':
+            online_entry_proxies / num_entry_proxies if num_entry_proxies else 0,
+    }
+
+
+def home_stats():
+    """
+    Return the home page statistics, querying them again once the cached copy is too old
+    """
+    cache = current_app.extensions.setdefault('home_stats', {})
+    max_age = current_app.config["HOME_STATS_CACHE_TTL"]
+    if 'stats' not in cache or time.monotonic() - cache['collected'] > max_age:
+        cache['stats'] = collect_stats()
+        cache['collected'] = time.monotonic()
+    return cache['stats']
+
+
+def invalidate_stats():
+    """
+    Drop the cached statistics after domains or proxies were changed by this process
+    """
+    current_app.extensions.get('home_stats', {}).clear()
@@ -0,0 +1,229 @@
+"""
+Indexes of domain name suffixes, for the blacklist, public suffixes and zone ownership
+
+Names are stored by their labels in reverse, so finding the entries which enclose a name
+takes one lookup per label instead of a scan.
+"""
+import os
+import datetime
+import threading
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import db, Domain
+
+DEFAULT_PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(__file__), 'data',
+                                          'public_suffix_list.dat')
+
+# Parsed public suffix lists by path
+public_suffix_lists = {}
+
+
+def reversed_labels(name):
+    return reversed(name.lower().rstrip('.').split('.'))
+
+
+class SuffixTrie(object):
+    """
+    A set of domain names stored by their reversed labels
+
+    Finds which entries are a name or one of its parent domains in O(labels).
+    """
+    def __init__(self, names=()):
+        self.root = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name, value=True):
+        node = self.root
+        for label in reversed_labels(name):
+            node = node.setdefault(label, {})
+        node[None] = value
+
+    def remove(self, name):
+        """
+        Remove a name, pruning the nodes which no longer lead to any entry
+        """
+        path, node = [], self.root
+        for label in reversed_labels(name):
+            if label not in node:
+                return
+            path.append((node, label))
+            node = node[label]
+        node.pop(None, None)
+        for parent, label in reversed(path):
+            if parent[label]:
+                break
+            del parent[label]
+
+    def find(self, name):
+        """
+        Return the value of the closest entry which is the name or a parent domain, or None
+        """
+        node, found = self.root, None
+        for label in reversed_labels(name):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+
+class PublicSuffixList(object):
+    """
+    The rules of the public suffix list (https://publicsuffix.org/)
+
+    Supports the wildcard and exception rules of the list format. Names which match no
+    rule use the default rule, so their TLD is the public suffix.
+    """
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            exception = rule.startswith('!')
+            node = self.root
+            for label in reversed_labels(rule.lstrip('!')):
+                node = node.setdefault(label, {})
+            node[None] = 'exception' if exception else 'rule'
+
+    @classmethod
+    def from_file(cls, path):
+        rules = []
+        with open(path, 'r', encoding='utf-8') as file_handler:
+            for line in file_handler:
+                line = line.strip()
+                if line and not line.startswith('//'):
+                    rules.append(line.split()[0])
+        return cls(rules)
+
+    def suffix_length(self, name):
+        """
+        Return the number of labels in the public suffix of a name
+        """
+        node, length = self.root, 1
+        for depth, label in enumerate(reversed_labels(name), 1):
+            child = node.get(label)
+            marker = child.get(None) if child is not None else None
+            if marker == 'exception':
+                # Exceptions make the parent of the matching name the public suffix
+                return depth - 1
+            if marker == 'rule' or node.get('*', {}).get(None) == 'rule':
+                length = depth
+            if child is None:
+                break
+            node = child
+        return length
+
+    def public_suffix(self, name):
+        labels = name.lower().rstrip('.').split('.')
+        return '.'.join(labels[len(labels) - self.suffix_length(name):])
+
+    def is_public_suffix(self, name):
+        """
+        Check if a name is a public suffix, under which anyone can register a domain
+        """
+        return self.suffix_length(name) >= len(name.rstrip('.').split('.'))
+
+
+def load_public_suffix_list(path=None):
+    """
+    Load a public suffix list file, parsing each file once per process
+    """
+    path = path or DEFAULT_PUBLIC_SUFFIX_LIST
+    if path not in public_suffix_lists:
+        public_suffix_lists[path] = PublicSuffixList.from_file(path)
+    return public_suffix_lists[path]
+
+
+class OwnershipIndex(object):
+    """
+    Index of the full domains registered as their own zone, to find who owns the zone
+    enclosing a new name
+
+    The index is loaded from the database once, kept up to date as this process registers
+    and deletes domains, and refreshed with the changes made by other processes.
+    """
+    def __init__(self):
+        self.trie = SuffixTrie()
+        self.last_refresh = None
+        self.lock = threading.Lock()
+
+    def add(self, domain_name):
+        with self.lock:
+            self.trie.add(domain_name, domain_name.lower())
+
+    def remove(self, domain_name):
+        with self.lock:
+            self.trie.remove(domain_name)
+
+    def update_after_commit(self, domain_name, deleted=False):
+        """
+        Add or remove a domain once the current transaction commits
+
+        Changes which are rolled back never reach the index, as a refresh only re-reads the
+        domains which were updated and would not correct them.
+        """
+        db.session.info.setdefault('ownership_updates', []).append(
+            (self, domain_name, deleted))
+
+    def refresh(self):
+        """
+        Load the domains which changed since the last refresh
+        """
+        started = datetime.datetime.utcnow()
+        domains = db.session.query(Domain.domain_name, Domain.deleted).filter(
+            Domain.domain_name == Domain.zone)
+        if self.last_refresh is not None:
+            # Allow some overlap so updates committed during the last refresh aren't missed
+            overlap = datetime.timedelta(seconds=current_app.config["OWNERSHIP_INDEX_OVERLAP"])
+            domains = domains.filter(Domain.date_updated >= self.last_refresh - overlap)
+        else:
+            domains = domains.filter_by(deleted=False)
+
+        with self.lock:
+            for domain_name, deleted in domains.yield_per(1000):
+                if deleted:
+                    self.trie.remove(domain_name)
+                else:
+                    self.trie.add(domain_name, domain_name.lower())
+            self.last_refresh = started
+
+    def refresh_if_stale(self):
+        max_age = datetime.timedelta(seconds=current_app.config["OWNERSHIP_INDEX_MAX_AGE"])
+        if self.last_refresh is None or datetime.datetime.utcnow() - self.last_refresh > max_age:
+            self.refresh()
+
+    def owner(self, name):
+        """
+        Return the registered domain which is the closest parent of a name, or None
+        """
+        parent = name.lower().rstrip('.').partition('.')[2]
+        if not parent:
+            return None
+        self.refresh_if_stale()
+        return self.trie.find(parent)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_ownership_updates(session):
+    for index, domain_name, deleted in session.info.pop('ownership_updates', ()):
+        if deleted:
+            index.remove(domain_name)
+        else:
+            index.add(domain_name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_ownership_updates(session):
+    session.info.pop('ownership_updates', None)
+
+
+def ownership_index():
+    """
+    Return the ownership index of the current app
+    """
+    return current_app.extensions.setdefault('ownership_index', OwnershipIndex())
@@ -1,20 +1,46 @@
+import json
+
 import pytest
 
-from oniongate import create_app
-from oniongate.models import db, User
+from oniongate import create_app, profiler
+from oniongate.models import db
+
+
+def post_json(client, url, data, **kwargs):
+    return client.post(url, data=json.dumps(data), content_type='application/json', **kwargs)
 
 
 @pytest.fixture
-def client(request):
-    app = create_app('appname.settings.TestConfig')
-    client = app.test_client()
+def app(request, tmpdir):
+    app = create_app('oniongate.settings.TestConfig')
+    app.config['zone_dir'] = str(tmpdir)
 
     db.app = app
     db.create_all()
 
+    context = app.app_context()
+    context.push()
+
     def teardown():
         db.session.remove()
         db.drop_all()
+        context.pop()
 
     request.addfinalizer(teardown)
-    return client
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def query_budget(app):
+    """
+    Fail a block which runs more queries than its budget, or likely N+1 queries
+
+        with query_budget(3):
+            client.get('/api/v1/domains')
+    """
+    return profiler.query_budget
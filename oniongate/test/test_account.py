@@ -7,7 +7,7 @@ def test_index(client):
     Test if the index page loads
     """
 
-    rv = cleint.get(url_for('main.index'))
+    rv = client.get('/')
     assert rv.status_code == 200
 
 
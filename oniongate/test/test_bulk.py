@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import datetime
+
+import pytest
+
+from oniongate import bulk
+from oniongate.models import Domain
+
+
+@pytest.fixture
+def problems():
+    reported = []
+    return reported, lambda line_number, domain_name, message: reported.append(
+        (line_number, domain_name))
+
+
+def test_import_jsonl(app, problems):
+    Domain.create(domain_name='existing.oniongate.com', zone='oniongate.com')
+    lines = [
+        {'domain_name': 'first.oniongate.com', 'onion_address': 'abcdefghijklmnop.onion'},
+        {'domain_name': 'second', 'public': False},
+        {'domain_name': 'existing.oniongate.com'},
+        {'domain_name': 'first.oniongate.com'},
+        {'domain_name': 'bad_name'},
+        {'domain_name': 'third', 'onion_address': 'not-an-onion'},
+        {'domain_name': 'fourth.oniongate.com'},
+    ]
+    file_handler = io.StringIO(''.join(json.dumps(line) + '\n' for line in lines))
+    reported, report = problems
+
+    # Small chunks so duplicates are found both within and across chunks
+    assert bulk.import_domains(bulk.read_domains(file_handler), report, chunk_size=3) == (3, 4)
+    assert sorted(reported) == [(3, 'existing.oniongate.com'), (4, 'first.oniongate.com'),
+                                (5, 'bad_name'), (6, 'third')]
+
+    first = Domain.query.filter_by(domain_name='first.oniongate.com').one()
+    assert first.onion_address == 'abcdefghijklmnop.onion' and first.public
+    assert first.zone == 'oniongate.com' and first.updated_since_synced
+    assert not Domain.query.filter_by(domain_name='second.oniongate.com').one().public
+
+
+def test_export_and_import_csv(app, problems):
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com',
+                  onion_address='abcdefghijklmnop.onion')
+    Domain.create(domain_name='second.oniongate.com', zone='oniongate.com', public=False)
+    Domain.create(domain_name='deleted.oniongate.com', zone='oniongate.com', deleted=True)
+
+    exported = io.StringIO()
+    assert bulk.export_domains(exported, 'csv', chunk_size=1) == 2
+    jsonl = io.StringIO()
+    bulk.export_domains(jsonl)
+    assert [json.loads(line)['domain_name'] for line in jsonl.getvalue().splitlines()] == \
+        ['first.oniongate.com', 'second.oniongate.com']
+
+    Domain.query.delete()
+    exported.seek(0)
+    reported, report = problems
+    assert bulk.import_domains(bulk.read_domains(exported, 'csv'), report) == (2, 0)
+    assert [(domain.domain_name, domain.onion_address, domain.public)
+            for domain in Domain.query.order_by(Domain.id)] == \
+        [('first.oniongate.com', 'abcdefghijklmnop.onion', True),
+         ('second.oniongate.com', None, False)]
+
+
+def test_export_round_trip_keeps_full_domain_zones(app, problems):
+    created = datetime.datetime(2017, 3, 1, 12, 30)
+    Domain.create(domain_name='example.org', zone='example.org', date_created=created)
+    Domain.create(domain_name='blog.example.org', zone='example.org',
+                  onion_address='abcdefghijklmnop.onion')
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com')
+
+    for format in ['jsonl', 'csv']:
+        exported = io.StringIO()
+        bulk.export_domains(exported, format)
+        Domain.query.delete()
+        exported.seek(0)
+        reported, report = problems
+        # Full domains are imported again even though registering them is closed
+        assert bulk.import_domains(bulk.read_domains(exported, format), report) == (3, 0)
+        assert [(domain.domain_name, domain.zone, domain.onion_address)
+                for domain in Domain.query.order_by(Domain.id)] == \
+            [('example.org', 'example.org', None),
+             ('blog.example.org', 'example.org', 'abcdefghijklmnop.onion'),
+             ('first.oniongate.com', 'oniongate.com', None)]
+        assert Domain.query.filter_by(domain_name='example.org').one().date_created == created
+
+    rows = [{'domain_name': 'blog.example.net', 'zone': 'example.org'},
+            {'domain_name': 'example.org', 'zone': 'oniongate.com'},
+            {'domain_name': 'www.blog.example.org', 'zone': 'blog.example.org'}]
+    assert bulk.import_domains(rows, lambda *args: None) == (0, 3)
+
+
+def test_import_skips_unreadable_rows(app, problems):
+    lines = [json.dumps({'domain_name': 'first'}), '{"domain_name": "broken',
+             json.dumps(['not', 'an', 'object']), json.dumps({'domain_name': 5}),
+             json.dumps({'domain_name': 'third', 'public': 1}),
+             json.dumps({'domain_name': 'second'})]
+    file_handler = io.StringIO('\n'.join(lines) + '\n')
+    reported, report = problems
+    assert bulk.import_domains(bulk.read_domains(file_handler), report) == (2, 4)
+    assert reported == [(2, None), (3, None), (4, 5), (5, 'third')]
+    assert [domain.domain_name for domain in Domain.query.order_by(Domain.id)] == \
+        ['first.oniongate.com', 'second.oniongate.com']
+
+
+def test_import_falls_back_to_single_rows(app, problems, monkeypatch):
+    Domain.create(domain_name='racing.oniongate.com', zone='oniongate.com')
+
+    # Pretend the conflicting row was inserted after the duplicate check
+    query = bulk.db.session.query
+    monkeypatch.setattr(bulk.db.session, 'query', lambda *args: query(*args).filter(False))
+    reported, report = problems
+    rows = [{'domain_name': 'racing'}, {'domain_name': 'winner'}]
+    assert bulk.import_domains(rows, report) == (1, 1)
+    assert reported == [(1, 'racing.oniongate.com')]
+
+
+def test_import_rejects_zones_inside_earlier_rows(app, problems):
+    app.config['FQDN_REGISTRATION_CLOSED'] = False
+    reported, report = problems
+    rows = [{'domain_name': 'example.org'}, {'domain_name': 'other.net'},
+            {'domain_name': 'blog.example.org'}, {'domain_name': 'example.org'}]
+    # The parent is in an earlier chunk, and again in the same chunk as its duplicate
+    assert bulk.import_domains(rows, report, chunk_size=2) == (2, 2)
+    assert reported == [(3, 'blog.example.org'), (4, 'example.org')]
+    assert [domain.domain_name for domain in Domain.query.order_by(Domain.id)] == \
+        ['example.org', 'other.net']
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import json
+import datetime
+
+import pytest
+
+from oniongate import bulk
+from oniongate.models import db, Change
+from oniongate.models.change import compact_changes
+from oniongate.test.conftest import post_json
+
+
+def get_changes(client, query=''):
+    response = client.get('/api/v1/changes' + query)
+    return response.status_code, json.loads(response.data)
+
+
+@pytest.fixture
+def feed_app(app):
+    app.config.update(CHANGES_POLL_INTERVAL=0.01, CHANGES_MAX_WAIT=0.05,
+                      CHANGES_STREAM_DURATION=0.1)
+    return app
+
+
+def test_writes_are_logged(feed_app, client):
+    token = json.loads(post_json(client, '/api/v1/domains',
+                                 {'domain_name': 'first'}).data)['update_token']
+    auth = {'Authorization': 'Bearer {}'.format(token)}
+    # A failed registration rolls back its change too
+    assert post_json(client, '/api/v1/domains', {'domain_name': 'first'}).status_code == 422
+
+    record = json.loads(post_json(client, '/api/v1/records/first.oniongate.com',
+                                  {'label': '_onion', 'type': 'TXT',
+                                   'value': 'onion=abcdefghijklmnop.onion'},
+                                  headers=auth).data)
+    client.delete('/api/v1/records/first.oniongate.com/{}'.format(record['id']), headers=auth)
+    post_json(client, '/api/v1/proxies', {'ip_address': '198.51.99.1'})
+    client.delete('/api/v1/domains/first.oniongate.com', headers=auth)
+
+    status, result = get_changes(client)
+    assert status == 200
+    record_key = 'first.oniongate.com/{}'.format(record['id'])
+    assert [(change['kind'], change['action'], change['key'])
+            for change in result['changes']] == [
+        ('domain', 'create', 'first.oniongate.com'),
+        ('record', 'create', record_key),
+        ('domain', 'update', 'first.oniongate.com'),
+        ('domain', 'update', 'first.oniongate.com'),
+        ('record', 'delete', record_key),
+        ('proxy', 'create', '198.51.99.1'),
+        ('domain', 'delete', 'first.oniongate.com'),
+    ]
+    assert result['changes'][2]['data']['onion_address'] == 'abcdefghijklmnop.onion'
+    assert result['changes'][3]['data']['onion_address'] is None
+    sequence = [change['seq'] for change in result['changes']]
+    assert sequence == sorted(sequence) and result['last_seq'] == result['latest_seq']
+
+    # Consumers only read the changes they have not seen
+    status, result = get_changes(client, '?since={}&limit=2'.format(sequence[3]))
+    assert [change['seq'] for change in result['changes']] == sequence[4:6]
+    assert result['last_seq'] == sequence[5]
+
+
+def test_long_poll(feed_app, client):
+    status, result = get_changes(client, '?wait=10')
+    assert result == {'changes': [], 'last_seq': 0, 'latest_seq': 0}
+
+    bulk.import_domains([{'domain_name': 'first'}, {'domain_name': 'second'}],
+                        lambda *args: None)
+    status, result = get_changes(client, '?wait=10')
+    assert [change['key'] for change in result['changes']] == \
+        ['first.oniongate.com', 'second.oniongate.com']
+
+
+def test_event_stream(feed_app, client):
+    post_json(client, '/api/v1/domains', {'domain_name': 'first'})
+    post_json(client, '/api/v1/domains', {'domain_name': 'second'})
+
+    response = client.get('/api/v1/changes', headers={'Accept': 'text/event-stream'})
+    assert response.mimetype == 'text/event-stream'
+    events = response.get_data(as_text=True).split('\n\n')
+    assert events[0] == 'retry: 10'
+    assert events[1].startswith('id: 1\nevent: change\ndata: {"seq": 1')
+    assert events[2].startswith('id: 2\n') and ': keep-alive' in events
+
+    # Reconnecting clients resume after the last event they received
+    response = client.get('/api/v1/changes?format=sse', headers={'Last-Event-ID': '2'})
+    assert 'id: ' not in response.get_data(as_text=True)
+
+
+def test_compaction(feed_app, client):
+    for action, key in [('create', 'a.oniongate.com'), ('update', 'a.oniongate.com'),
+                        ('create', 'b.oniongate.com'), ('delete', 'b.oniongate.com'),
+                        ('create', 'c.oniongate.com'), ('update', 'a.oniongate.com')]:
+        Change.log('domain', action, key)
+    now = datetime.datetime.utcnow() + datetime.timedelta(hours=2)
+
+    # Only entries older than an hour are compacted, deletes are kept for a day
+    Change.query.filter(Change.seq < 6).update({'date_created': now - datetime.timedelta(
+        hours=3)}, synchronize_session=False)
+    db.session.commit()
+    assert compact_changes(3600, 86400, now=now) == 3
+    assert [change.seq for change in Change.query.order_by(Change.seq)] == [4, 5, 6]
+    assert get_changes(client, '?since=1')[0] == 200
+
+    assert compact_changes(3600, 3600, now=now) == 1
+    assert [(change.seq, change.kind) for change in Change.query.order_by(Change.seq)] == \
+        [(5, 'domain'), (6, 'domain'), (7, 'compaction')]
+    status, result = get_changes(client, '?since=3')
+    assert status == 410 and 'X-Change-Seq' in result['message']
+    # The listing tells consumers where to follow the changes from again
+    seq = client.get('/api/v1/domains').headers['X-Change-Seq']
+    assert seq == '7' and get_changes(client, '?since=' + seq)[0] == 200
+    status, result = get_changes(client, '?since=4')
+    assert [change['seq'] for change in result['changes']] == [5, 6]
+
+    # Sequence numbers are never reused after compaction
+    Change.query.delete()
+    db.session.commit()
+    assert Change.log('domain', 'create', 'd.oniongate.com').seq == 8
+
+
+def test_sequence_follows_commit_order(feed_app, client):
+    # The entry of a transaction which has not committed yet is not served
+    Change(id=10, kind='domain', action='create', key='late.oniongate.com').save(commit=False)
+    db.session.flush()
+    assert get_changes(client)[1]['changes'] == []
+    db.session.commit()
+
+    # An entry with a lower id committed afterwards is still numbered after it
+    Change(id=5, kind='domain', action='create', key='early.oniongate.com').save()
+    status, result = get_changes(client)
+    assert [(change['seq'], change['key']) for change in result['changes']] == \
+        [(1, 'late.oniongate.com'), (2, 'early.oniongate.com')]
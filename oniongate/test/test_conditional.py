@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import json
+import datetime
+
+from werkzeug.http import http_date
+
+from oniongate import dns
+from oniongate.models import db, Domain, Proxy
+from oniongate.resources import records
+
+
+def get(client, url, etag=None, since=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if since:
+        headers['If-Modified-Since'] = since
+    return client.get(url, headers=headers)
+
+
+def test_domain_not_modified(app, client, monkeypatch):
+    response = client.post('/api/v1/domains', data=json.dumps({'domain_name': 'first'}),
+                           content_type='application/json')
+    token = json.loads(response.data)['update_token']
+
+    url = '/api/v1/domains/first.oniongate.com'
+    response = client.get(url)
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert response.status_code == 200 and etag.startswith('W/"')
+
+    # The domain and its records are not loaded to answer a matching request
+    monkeypatch.setattr(Domain, 'get_or_404', None)
+    response = get(client, url, etag=etag)
+    assert response.status_code == 304 and response.data == b''
+    assert response.headers['ETag'] == etag
+    assert get(client, url, since=last_modified).status_code == 304
+    monkeypatch.undo()
+
+    # Adding a record changes both the domain and its record listing
+    records_response = client.get('/api/v1/records/first.oniongate.com')
+    records_etag = records_response.headers['ETag']
+    response = client.post('/api/v1/records/first.oniongate.com',
+                           data=json.dumps({'label': 'www', 'type': 'TXT', 'value': 'hello'}),
+                           content_type='application/json',
+                           headers={'Authorization': 'Bearer {}'.format(token)})
+    assert response.status_code == 200
+    response = get(client, url, etag=etag)
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert json.loads(response.data)['records'][0]['value'] == 'hello'
+    assert get(client, '/api/v1/records/first.oniongate.com',
+               etag=records_etag).status_code == 200
+
+    # Syncing the zone clears the flags shown in the listing
+    etag = response.headers['ETag']
+    dns.mark_synced([Domain.query.one().id], [])
+    assert get(client, url, etag=etag).status_code == 200
+    assert get(client, '/api/v1/domains/missing.oniongate.com', etag=etag).status_code == 404
+
+
+def test_record_listing_not_modified(app, client, monkeypatch):
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com')
+    url = '/api/v1/records/first.oniongate.com'
+    etag = client.get(url).headers['ETag']
+
+    monkeypatch.setattr(records.record_serializer, 'response', None)
+    assert get(client, url, etag=etag).status_code == 304
+    assert get(client, url, etag='W/"other", ' + etag).status_code == 304
+
+
+def test_proxy_listing_not_modified(app, client):
+    checked = datetime.datetime(2016, 1, 1, 12, 0, 0)
+    Proxy.create(ip_address='203.0.113.1', ip_type='4', date_created=checked)
+
+    response = client.get('/api/v1/proxies')
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert last_modified == http_date(checked)
+    assert get(client, '/api/v1/proxies', etag=etag).status_code == 304
+    assert get(client, '/api/v1/proxies', since=last_modified).status_code == 304
+    assert get(client, '/api/v1/proxies', since=http_date(checked.replace(
+        hour=11))).status_code == 200
+
+    # A health check changes the listing
+    Proxy.query.update({'online': True, 'last_checked': checked.replace(minute=1)})
+    db.session.commit()
+    response = get(client, '/api/v1/proxies', etag=etag)
+    assert response.status_code == 200
+    assert json.loads(response.data)[0]['online']
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+import pytest
+from blockstack_zones import make_zone_file
+
+from oniongate import create_app, dns
+from oniongate.models import db, Domain, Record, Proxy
+from oniongate.models.domain import backfill_subdomains
+
+
+BASE_ZONE = """$ORIGIN {{ origin }}.
+$TTL 3600
+@ IN SOA ns1.{{ origin }}. admin.{{ origin }}. ( 1 7200 3600 1209600 3600 )
+@ IN NS ns1.{{ origin }}.
+ns1 IN A 198.51.100.1
+"""
+
+
+def without_serial(zone_file):
+    """
+    Drop the SOA line, its serial changes on every generation
+    """
+    return [line for line in zone_file.splitlines() if " SOA " not in line]
+
+
+@pytest.fixture
+def zone(app):
+    with open(os.path.join(app.config['zone_dir'], 'base_zone.j2'), 'w') as f:
+        f.write(BASE_ZONE)
+
+    for name in ['first', 'second', 'third']:
+        Domain.create(domain_name='{}.oniongate.com'.format(name), zone='oniongate.com',
+                      onion_address='{:a<16}.onion'.format(name))
+    Proxy.create(ip_address='203.0.113.1', ip_type='4', online=True)
+    return 'oniongate.com'
+
+
+def test_sync_zone_writes_zone_file(app, zone):
+    zone_file = dns.sync_zone(zone)
+
+    with open(dns.zone_file_path(zone)) as f:
+        assert f.read() == zone_file
+    assert 'first 120 CNAME proxy.oniongate.com' in zone_file
+    assert '_onion.second 3600 TXT "onion=secondaaaaaaaaaa.onion"' in zone_file
+    assert 'proxy 120 A 203.0.113.1' in zone_file
+    assert Domain.query.filter_by(updated_since_synced=True).count() == 0
+
+
+def test_incremental_sync_matches_full_rebuild(app, zone):
+    dns.sync_zone(zone)
+
+    Domain.query.filter_by(domain_name='first.oniongate.com').one().update(
+        deleted=True, updated_since_synced=True)
+    Domain.query.filter_by(domain_name='second.oniongate.com').one().update(
+        onion_address='changedaaaaaaaaa.onion', updated_since_synced=True)
+    Domain.create(domain_name='fourth.oniongate.com', zone='oniongate.com',
+                  onion_address='fourthaaaaaaaaaa.onion')
+    Proxy.create(ip_address='2001:db8::1', ip_type='6', online=True,
+                 updated_since_synced=True)
+
+    incremental = dns.sync_zone(zone)
+    assert 'first 120 CNAME' not in incremental
+    assert 'onion=changedaaaaaaaaa.onion' in incremental
+    assert 'fourth 120 CNAME' in incremental
+    assert 'proxy 120 AAAA 2001:db8::1' in incremental
+    assert Domain.query.filter_by(updated_since_synced=True).count() == 0
+    assert Proxy.query.filter_by(updated_since_synced=True).count() == 0
+
+    assert without_serial(incremental) == without_serial(dns.generate_zone_file(zone))
+
+
+def test_incremental_sync_ignores_unflagged_rows(app, zone):
+    dns.sync_zone(zone)
+
+    # Changes which are not flagged are only picked up by a full rebuild
+    domain = Domain.query.filter_by(domain_name='third.oniongate.com').one()
+    domain.update(onion_address='unflaggedaaaaaaa.onion', updated_since_synced=False)
+
+    assert 'unflaggedaaaaaaa' not in dns.sync_zone(zone)
+    assert 'unflaggedaaaaaaa' in dns.sync_zone(zone, full=True)
+
+
+def test_user_records_are_included(app, zone):
+    domain = Domain.query.filter_by(domain_name='second.oniongate.com').one()
+    Record.create(domain=domain, label='_keybase', ttl=300, record_type='TXT',
+                  value='keybase-site-verification=abc')
+    # The onion mapping record duplicates the generated _onion TXT record
+    Record.create(domain=domain, label='_onion', ttl=3600, record_type='TXT',
+                  value='onion=secondaaaaaaaaaa.onion')
+
+    zone_file = dns.sync_zone(zone)
+    assert '_keybase.second 300 TXT "keybase-site-verification=abc"' in zone_file
+    assert zone_file.count('onion=secondaaaaaaaaaa.onion') == 1
+    assert Record.query.filter_by(updated_since_synced=True).count() == 0
+
+    # Adding a record flags only the record, the domain is picked up through it
+    Record.create(domain=domain, label='_other', ttl=300, record_type='TXT', value='other')
+    assert '_other.second 300 TXT "other"' in dns.sync_zone(zone)
+
+    Record.query.filter_by(label='_keybase').one().delete()
+    domain.update(updated_since_synced=True)
+    assert '_keybase' not in dns.sync_zone(zone)
+
+
+def test_records_are_loaded_in_one_query(app, zone):
+    domains = Domain.query.order_by(Domain.id).all()
+    for domain in domains[1:]:
+        Record.create(domain=domain, label='_test', ttl=300, record_type='TXT',
+                      value=domain.domain_name)
+
+    grouped = [(domain.domain_name, [record.value for record in records])
+               for domain, records in dns.domains_with_records(Domain.query)]
+    assert grouped == [
+        ('first.oniongate.com', []),
+        ('second.oniongate.com', ['second.oniongate.com']),
+        ('third.oniongate.com', ['third.oniongate.com']),
+    ]
+
+
+def test_subdomain_labels_are_queried_in_sql(app, zone):
+    Domain.create(domain_name='blog.example.org', zone='example.org')
+    Domain.create(domain_name='example.org', zone='example.org')
+    db.session.execute(Domain.__table__.insert(),
+                       [{'domain_name': 'www.blog.example.net', 'zone': 'example.net'}])
+
+    rows = db.session.query(Domain.domain_name, Domain.subdomain, Domain.txt_label).\
+        order_by(Domain.id).all()
+    assert [(subdomain, txt_label) for _, subdomain, txt_label in rows] == [
+        ('first', '_onion.first'), ('second', '_onion.second'), ('third', '_onion.third'),
+        ('blog', '_onion.blog'), ('', '_onion'), ('www.blog', '_onion.www.blog'),
+    ]
+    for domain in Domain.query:
+        assert (domain.domain_name, domain.subdomain, domain.txt_label) in rows
+
+    app.config['USE_ALIAS_RECORDS'] = True
+    assert db.session.query(Domain.domain_name).filter(Domain.txt_label == 'blog').one() == \
+        ('blog.example.org',)
+
+
+def test_backfill_subdomains(app, zone):
+    Domain.query.update({'subdomain_label': None})
+    db.session.commit()
+    assert Domain.query.first().subdomain == 'first'
+
+    assert Domain.query.filter(Domain.subdomain == None).count() == 3
+    assert backfill_subdomains(batch_size=2) == 3
+    assert [subdomain for subdomain, in db.session.query(Domain.subdomain).
+            order_by(Domain.id)] == ['first', 'second', 'third']
+
+
+def test_zone_file_writer_matches_make_zone_file(app, zone):
+    Record.create(domain=Domain.query.first(), label='_spf', ttl=300, record_type='TXT',
+                  value='v=spf1 -all; comment')
+    state = dns.build_zone_state(zone)
+    state['base']['mx'] = [{'name': '@', 'preference': 10, 'host': 'mail'}]
+
+    records = {}
+    for record_group in [state['base'], state['proxies']] + list(state['domains'].values()):
+        for key, value in record_group.items():
+            if isinstance(value, list):
+                records.setdefault(key, []).extend(value)
+            else:
+                records[key] = value
+    records['soa'] = dict(records['soa'][-1], serial=1234)
+
+    streamed = io.StringIO()
+    dns.write_zone_file(streamed, state['base'],
+                        [state['proxies']] + list(state['domains'].values()), serial=1234)
+    assert streamed.getvalue() == make_zone_file(records)
+
+
+def test_write_zone_streams_to_zone_dir(app, zone):
+    app.config['ZONE_QUERY_BATCH_SIZE'] = 2
+    dns.write_zone(zone)
+
+    with open(dns.zone_file_path(zone)) as f:
+        written = f.read()
+    assert without_serial(written) == without_serial(dns.generate_zone_file(zone))
+    assert 'third 120 CNAME proxy.oniongate.com' in written
+    assert not os.path.exists(dns.zone_file_path(zone) + '.tmp')
+
+
+@pytest.fixture
+def file_app(tmpdir):
+    """
+    An app using an SQLite file, so the database can be shared with worker processes
+    """
+    app = create_app('oniongate.settings.TestConfig')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(tmpdir.join('test.db'))
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['zone_dir'] = str(tmpdir)
+
+    with open(os.path.join(app.config['zone_dir'], 'base_zone.j2'), 'w') as f:
+        f.write(BASE_ZONE)
+
+    db.app = app
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_sync_all_zones(file_app):
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com')
+    Domain.create(domain_name='blog.example.org', zone='example.org')
+
+    results = dns.sync_all_zones('oniongate.settings.TestConfig', processes=2)
+    assert sorted(zone for zone, duration, error in results) == ['example.org', 'oniongate.com']
+    assert all(error is None for zone, duration, error in results)
+    with open(dns.zone_file_path('example.org')) as f:
+        assert '_onion.blog 3600 TXT' in f.read()
+
+    # Only the zone with changes is synced again
+    Domain.create(domain_name='second.oniongate.com', zone='oniongate.com')
+    results = dns.sync_all_zones('oniongate.settings.TestConfig', processes=2)
+    assert [zone for zone, duration, error in results] == ['oniongate.com']
+    assert dns.sync_all_zones('oniongate.settings.TestConfig') == []
+
+
+def test_base_zone_records_are_cached(app, zone, monkeypatch):
+    renders = []
+    build_zone_base_template = dns.build_zone_base_template
+    monkeypatch.setattr(dns, 'build_zone_base_template',
+                        lambda zone: renders.append(zone) or build_zone_base_template(zone))
+
+    base = dns.base_zone_records(zone)
+    base['ns'].append({'name': '@', 'host': 'modified'})
+    assert dns.base_zone_records(zone)['ns'] == [{'name': '@', 'host': 'ns1.oniongate.com.'}]
+    assert renders == [zone]
+
+    # Writing the zone template invalidates the cache
+    template_path = os.path.join(app.config['zone_dir'], '{}.zone.j2'.format(zone))
+    with open(template_path, 'w') as f:
+        f.write('www IN A 198.51.100.2\n')
+    assert {'name': 'www', 'ip': '198.51.100.2'} in dns.base_zone_records(zone)['a']
+    assert renders == [zone, zone]
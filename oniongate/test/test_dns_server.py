@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+import asyncio
+import datetime
+import threading
+
+import dns.flags
+import dns.message
+import dns.query
+import dns.rcode
+import dns.rdatatype
+import pytest
+
+from oniongate.dns_server import DNSServer
+from oniongate.models import Domain, Record, Proxy
+from oniongate.test.test_dns import BASE_ZONE
+
+
+@pytest.fixture
+def server(app):
+    with open(os.path.join(app.config['zone_dir'], 'base_zone.j2'), 'w') as f:
+        f.write(BASE_ZONE)
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com',
+                  onion_address='firstaaaaaaaaaaa.onion')
+    Proxy.create(ip_address='203.0.113.1', ip_type='4', online=True)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    server = DNSServer(app)
+    server.loop = loop
+    server.port = asyncio.run_coroutine_threadsafe(server.start('127.0.0.1', 0), loop).result()
+    yield server
+
+    loop.call_soon_threadsafe(server.close)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def refresh(server):
+    asyncio.run_coroutine_threadsafe(server.refresh(), server.loop).result()
+
+
+def query(server, name, rdtype, tcp=False, payload=None):
+    if payload:
+        request = dns.message.make_query(name, rdtype, use_edns=0, payload=payload)
+    else:
+        request = dns.message.make_query(name, rdtype)
+    if tcp:
+        return dns.query.tcp(request, '127.0.0.1', port=server.port, timeout=2)
+    return dns.query.udp(request, '127.0.0.1', port=server.port, timeout=2)
+
+
+def answers(response):
+    return sorted(rdata.to_text() for rrset in response.answer for rdata in rrset)
+
+
+def test_answers_domain_records(server):
+    response = query(server, '_onion.first.oniongate.com', 'TXT')
+    assert response.flags & dns.flags.AA
+    assert answers(response) == ['"onion=firstaaaaaaaaaaa.onion"']
+
+    response = query(server, 'first.oniongate.com', 'A', tcp=True)
+    assert answers(response) == ['203.0.113.1', 'proxy.oniongate.com.']
+
+    response = query(server, 'oniongate.com', 'NS')
+    assert answers(response) == ['ns1.oniongate.com.']
+
+
+def test_negative_answers(server):
+    response = query(server, 'missing.oniongate.com', 'A')
+    assert response.rcode() == dns.rcode.NXDOMAIN
+    assert response.authority[0].rdtype == dns.rdatatype.SOA
+
+    response = query(server, '_onion.first.oniongate.com', 'AAAA')
+    assert response.rcode() == dns.rcode.NOERROR
+    assert response.answer == []
+
+    response = query(server, 'example.org', 'A')
+    assert response.rcode() == dns.rcode.REFUSED
+
+
+def test_refresh_applies_changes(server):
+    Domain.create(domain_name='second.oniongate.com', zone='oniongate.com',
+                  onion_address='secondaaaaaaaaaa.onion')
+    first = Domain.query.filter_by(domain_name='first.oniongate.com').one()
+    Record.create(domain=first, label='_keybase', ttl=300, record_type='TXT', value='proof')
+    first.update(date_updated=datetime.datetime.utcnow())
+    refresh(server)
+
+    assert answers(query(server, '_onion.second.oniongate.com', 'TXT')) == \
+        ['"onion=secondaaaaaaaaaa.onion"']
+    assert answers(query(server, '_keybase.first.oniongate.com', 'TXT')) == ['"proof"']
+
+    first.update(deleted=True, date_updated=datetime.datetime.utcnow())
+    refresh(server)
+    assert query(server, 'first.oniongate.com', 'CNAME').rcode() == dns.rcode.NXDOMAIN
+
+
+def test_large_udp_answer_is_truncated(app, server):
+    app.config['PROXY_MAX_ANSWERS'] = 40
+    for i in range(40):
+        Proxy.create(ip_address='2001:db8::{}'.format(i + 1), ip_type='6', online=True)
+    refresh(server)
+
+    response = query(server, 'proxy.oniongate.com', 'AAAA')
+    assert response.flags & dns.flags.TC
+    assert len(answers(query(server, 'proxy.oniongate.com', 'AAAA', tcp=True))) == 40
+
+
+def test_response_size_follows_edns_payload(app, server):
+    app.config['PROXY_MAX_ANSWERS'] = 40
+    for i in range(40):
+        Proxy.create(ip_address='2001:db8::{}'.format(i + 1), ip_type='6', online=True)
+    refresh(server)
+
+    # A larger EDNS buffer lets the whole answer fit in one UDP response
+    response = query(server, 'proxy.oniongate.com', 'AAAA', payload=4096)
+    assert not response.flags & dns.flags.TC
+    assert len(answers(response)) == 40
+    response = query(server, 'proxy.oniongate.com', 'AAAA', payload=512)
+    assert response.flags & dns.flags.TC
+    # The advertised size is capped so large answers can't be used for amplification
+    app.config['DNS_SERVER_MAX_UDP_PAYLOAD'] = 1000
+    response = query(server, 'proxy.oniongate.com', 'AAAA', payload=65535)
+    assert response.flags & dns.flags.TC
+
+    # Responses over TCP are never truncated to the UDP payload size
+    response = query(server, 'proxy.oniongate.com', 'AAAA', tcp=True, payload=512)
+    assert not response.flags & dns.flags.TC
+    assert len(answers(response)) == 40
+
+
+def test_proxy_answers_rotate(server):
+    for i in range(20):
+        Proxy.create(ip_address='198.51.100.{}'.format(i + 1), ip_type='4', online=True)
+    refresh(server)
+
+    seen = set()
+    for i in range(10):
+        response = answers(query(server, 'proxy.oniongate.com', 'A'))
+        assert len(response) == 8
+        seen.update(response)
+    assert len(seen) > 8
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import socketserver
+import struct
+import threading
+
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import pytest
+
+from oniongate import dns_update
+from oniongate.models import Domain, Record, Proxy
+
+
+class UpdateHandler(socketserver.BaseRequestHandler):
+    """
+    Stand-in nameserver which records each update message and accepts it
+    """
+    def handle(self):
+        length, = struct.unpack('!H', self.request.recv(2))
+        wire = b''
+        while len(wire) < length:
+            wire += self.request.recv(length - len(wire))
+
+        message = dns.message.from_wire(wire)
+        self.server.updates.append(message)
+        response = dns.message.make_response(message)
+        response.set_rcode(self.server.rcode)
+        response_wire = response.to_wire()
+        self.request.sendall(struct.pack('!H', len(response_wire)) + response_wire)
+
+
+@pytest.fixture
+def nameserver(app):
+    server = socketserver.TCPServer(('127.0.0.1', 0), UpdateHandler)
+    server.updates = []
+    server.rcode = dns.rcode.NOERROR
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    app.config['DNS_UPDATE_SERVER'], app.config['DNS_UPDATE_PORT'] = server.server_address
+    yield server
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def domains(app):
+    for name in ['first', 'second', 'third']:
+        Domain.create(domain_name='{}.oniongate.com'.format(name), zone='oniongate.com',
+                      onion_address='{:a<16}.onion'.format(name))
+
+
+def update_section(message):
+    """
+    Summarise the update section, which is carried in the authority section of the message
+    """
+    return sorted(' '.join([rrset.name.to_text(),
+                            dns.rdataclass.to_text(rrset.deleting or rrset.rdclass),
+                            dns.rdatatype.to_text(rrset.rdtype)] +
+                           [rdata.to_text() for rdata in rrset])
+                  for rrset in message.authority)
+
+
+def test_domain_changes_are_batched(app, domains):
+    app.config['DNS_UPDATE_BATCH_SIZE'] = 4
+    changes = []
+    for domain in Domain.query.order_by(Domain.id):
+        changes.extend(dns_update.domain_changes(domain))
+
+    messages = dns_update.build_update_messages('oniongate.com', changes)
+    assert len(changes) == 6
+    assert len(messages) == 2
+
+    decoded = dns.message.from_wire(messages[0].to_wire())
+    assert update_section(decoded) == [
+        '_onion.first.oniongate.com. ANY TXT',
+        '_onion.first.oniongate.com. IN TXT "onion=firstaaaaaaaaaaa.onion"',
+        '_onion.second.oniongate.com. ANY TXT',
+        '_onion.second.oniongate.com. IN TXT "onion=secondaaaaaaaaaa.onion"',
+        'first.oniongate.com. ANY CNAME',
+        'first.oniongate.com. IN CNAME proxy.oniongate.com.',
+        'second.oniongate.com. ANY CNAME',
+        'second.oniongate.com. IN CNAME proxy.oniongate.com.',
+    ]
+
+
+def test_deleted_domain_removes_rrsets(app, domains):
+    domain = Domain.query.filter_by(domain_name='first.oniongate.com').one()
+    domain.update(deleted=True)
+
+    message = dns_update.build_update_messages('oniongate.com',
+                                               dns_update.domain_changes(domain))[0]
+    assert update_section(dns.message.from_wire(message.to_wire())) == [
+        '_onion.first.oniongate.com. ANY TXT',
+        'first.oniongate.com. ANY CNAME',
+    ]
+
+
+def test_alias_records_use_generic_rdata(app, domains):
+    app.config['USE_ALIAS_RECORDS'] = True
+    domain = Domain.query.filter_by(domain_name='first.oniongate.com').one()
+
+    rrsets = dns_update.group_rrsets(dns_update.domain_zone_records(domain))
+    ttl, rdatas = rrsets[('first', dns_update.ALIAS_RDATATYPE)]
+    assert rdatas[0].to_text().startswith(r'\# 21 ')
+
+
+def test_push_zone_updates(app, domains, nameserver):
+    Proxy.create(ip_address='203.0.113.1', ip_type='4', online=True,
+                 updated_since_synced=True)
+
+    assert dns_update.push_zone_updates('oniongate.com') == 1
+    assert len(nameserver.updates) == 1
+    updates = update_section(nameserver.updates[0])
+    assert 'proxy.oniongate.com. IN A 203.0.113.1' in updates
+    assert 'proxy.oniongate.com. ANY AAAA' in updates
+    assert Domain.query.filter_by(updated_since_synced=True).count() == 0
+    assert Proxy.query.filter_by(updated_since_synced=True).count() == 0
+
+    # Nothing changed, so nothing is sent
+    assert dns_update.push_zone_updates('oniongate.com') == 0
+    assert len(nameserver.updates) == 1
+
+
+def test_refused_update_keeps_flags(app, domains, nameserver):
+    nameserver.rcode = dns.rcode.REFUSED
+
+    with pytest.raises(dns_update.UpdateFailed):
+        dns_update.push_zone_updates('oniongate.com')
+    assert Domain.query.filter_by(updated_since_synced=True).count() == 3
+
+
+def test_deleted_user_record_is_removed(app, domains, nameserver):
+    domain = Domain.query.filter_by(domain_name='first.oniongate.com').one()
+    Record.create(domain=domain, label='_keybase', ttl=300, record_type='TXT', value='proof')
+    dns_update.push_zone_updates('oniongate.com')
+    assert '_keybase.first.oniongate.com. IN TXT "proof"' in \
+        update_section(nameserver.updates[-1])
+
+    Record.query.filter_by(label='_keybase').one().delete()
+    domain.update(updated_since_synced=True)
+    dns_update.push_zone_updates('oniongate.com')
+    assert update_section(nameserver.updates[-1]) == [
+        '_keybase.first.oniongate.com. ANY TXT',
+        '_onion.first.oniongate.com. ANY TXT',
+        '_onion.first.oniongate.com. IN TXT "onion=firstaaaaaaaaaaa.onion"',
+        'first.oniongate.com. ANY CNAME',
+        'first.oniongate.com. IN CNAME proxy.oniongate.com.',
+    ]
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import datetime
+
+import pytest
+
+from oniongate.models import Domain
+
+
+@pytest.fixture
+def domains(app):
+    """
+    Create public domains in two zones, created in the reverse order of their ids
+    """
+    now = datetime.datetime.utcnow()
+    for i in range(7):
+        zone = 'example.org' if i % 3 == 0 else 'oniongate.com'
+        Domain.create(domain_name='domain{}.{}'.format(i, zone), zone=zone,
+                      service_online=i % 2 == 0,
+                      date_created=now - datetime.timedelta(minutes=i),
+                      date_updated=now - datetime.timedelta(days=i))
+    Domain.create(domain_name='private.oniongate.com', zone='oniongate.com', public=False)
+    Domain.create(domain_name='deleted.oniongate.com', zone='oniongate.com', deleted=True)
+
+
+def domain_names(response):
+    return [domain['domain_name'].split('.')[0] for domain in json.loads(response.data)]
+
+
+def fetch_all_pages(client, url):
+    """
+    Follow the Link headers through every page of a listing
+    """
+    names = []
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        names.extend(domain_names(response))
+        link = response.headers.get('Link')
+        url = link[1:link.index('>')] if link else None
+    return names
+
+
+def test_list_domains(client, domains):
+    response = client.get('/api/v1/domains')
+    assert 'Link' not in response.headers
+    assert domain_names(response) == ['domain{}'.format(i) for i in range(7)]
+
+
+def test_list_domains_by_page(app, client, domains):
+    response = client.get('/api/v1/domains?limit=3')
+    assert domain_names(response) == ['domain0', 'domain1', 'domain2']
+    assert 'limit=3' in response.headers['Link']
+
+    assert fetch_all_pages(client, '/api/v1/domains?limit=3') == \
+        ['domain{}'.format(i) for i in range(7)]
+    assert fetch_all_pages(client, '/api/v1/domains?limit=2&order_by=date_created') == \
+        ['domain{}'.format(i) for i in reversed(range(7))]
+
+    app.config['DOMAINS_PAGE_SIZE'] = 4
+    assert len(domain_names(client.get('/api/v1/domains'))) == 4
+    app.config['DOMAINS_MAX_PAGE_SIZE'] = 2
+    assert len(domain_names(client.get('/api/v1/domains?limit=5'))) == 2
+
+
+def test_list_domains_with_filters(client, domains):
+    response = client.get('/api/v1/domains?zone=example.org')
+    assert domain_names(response) == ['domain0', 'domain3', 'domain6']
+
+    response = client.get('/api/v1/domains?zone=oniongate.com&service_online=false')
+    assert domain_names(response) == ['domain1', 'domain5']
+
+    since = (datetime.datetime.utcnow() - datetime.timedelta(days=2, hours=1)).isoformat()
+    response = client.get('/api/v1/domains', query_string={'updated_since': since})
+    assert domain_names(response) == ['domain0', 'domain1', 'domain2']
+
+
+def test_updated_since_without_offset_is_utc(client, domains, monkeypatch):
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=2, hours=1)
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        response = client.get('/api/v1/domains',
+                              query_string={'updated_since': since.isoformat()})
+        assert domain_names(response) == ['domain0', 'domain1', 'domain2']
+        response = client.get('/api/v1/domains', query_string={
+            'updated_since': (since - datetime.timedelta(hours=5)).isoformat() + '-05:00'})
+        assert domain_names(response) == ['domain0', 'domain1', 'domain2']
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_list_domains_invalid_cursor(client, domains):
+    response = client.get('/api/v1/domains?limit=2')
+    cursor = response.headers['Link'].split('cursor=')[1].split('>')[0]
+
+    assert client.get('/api/v1/domains?cursor=notacursor').status_code == 400
+    # Cursors can't be used with a different sort order
+    response = client.get('/api/v1/domains?order_by=date_created&cursor={}'.format(cursor))
+    assert response.status_code == 400
+
+
+def test_stream_domains(app, client, domains):
+    app.config['DOMAINS_MAX_PAGE_SIZE'] = 2
+    response = client.get('/api/v1/domains?format=ndjson&service_online=true')
+    assert response.mimetype == 'application/x-ndjson'
+
+    lines = response.data.decode('utf-8').splitlines()
+    assert [json.loads(line)['domain_name'] for line in lines] == \
+        ['domain0.example.org', 'domain2.oniongate.com', 'domain4.oniongate.com',
+         'domain6.example.org']
+    assert list(json.loads(lines[0]).keys())[:2] == ['domain_name', 'zone']
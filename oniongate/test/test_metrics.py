@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+
+from oniongate import create_app, dns, metrics
+from oniongate.models import Domain, Proxy
+from oniongate.settings import TestConfig
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('test_seconds', "Test", buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value, endpoint='a')
+    assert histogram.samples() == [
+        ('test_seconds_bucket', (('endpoint', 'a'), ('le', '0.1')), 2),
+        ('test_seconds_bucket', (('endpoint', 'a'), ('le', '1.0')), 3),
+        ('test_seconds_bucket', (('endpoint', 'a'), ('le', '+Inf')), 4),
+        ('test_seconds_sum', (('endpoint', 'a'),), 3.65),
+        ('test_seconds_count', (('endpoint', 'a'),), 4),
+    ]
+    assert metrics.format_labels((('path', 'a"b\\c\n'),)) == r'{path="a\"b\\c\n"}'
+
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+    return response.get_data(as_text=True).splitlines()
+
+
+def test_metrics_endpoint(app, client):
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com',
+                  onion_address='firstaaaaaaaaaaa.onion', service_online=True)
+    Domain.create(domain_name='second.oniongate.com', zone='oniongate.com')
+    Proxy.create(ip_address='198.51.99.1', ip_type='4', online=True)
+
+    client.get('/api/v1/domains')
+    client.get('/api/v1/domains/missing.oniongate.com')
+    client.post('/api/v1/domains', data=json.dumps({'domain_name': 'third'}),
+                content_type='application/json')
+    with open(os.path.join(app.config['zone_dir'], 'base_zone.j2'), 'w') as f:
+        f.write("$ORIGIN {{ origin }}.\n@ IN SOA ns1 admin ( 1 7200 3600 1209600 3600 )\n")
+    dns.write_zone('oniongate.com')
+
+    lines = scrape(client)
+    assert 'oniongate_http_requests_total{endpoint="api.domains",method="GET",status="200"} 1' \
+        in lines
+    assert 'oniongate_http_requests_total{endpoint="api.domains",method="GET",status="404"} 1' \
+        in lines
+    assert 'oniongate_http_requests_total{endpoint="api.domains",method="POST",status="200"} 1' \
+        in lines
+    assert 'oniongate_http_request_duration_seconds_count{endpoint="api.domains"} 3' in lines
+    assert 'oniongate_db_queries_per_request_bucket{endpoint="api.domains",le="0.0"} 0' in lines
+    assert '# TYPE oniongate_db_duration_seconds histogram' in lines
+
+    assert 'oniongate_domains{state="online"} 1' in lines
+    assert 'oniongate_domains{state="offline"} 2' in lines
+    assert 'oniongate_proxies{state="online"} 1' in lines
+    # The zone has a CNAME and TXT record for each domain and the proxy A record
+    assert 'oniongate_zone_records{zone="oniongate.com"} 7' in lines
+    assert 'oniongate_zone_generation_seconds_count{zone="oniongate.com"} 1' in lines
+    assert any(line.startswith('oniongate_zone_last_generation_seconds{zone="oniongate.com"}')
+               for line in lines)
+    assert 'oniongate_unit_of_work{stat="requests"} 3' in lines
+
+    # The scrape itself is counted on the next one
+    assert 'oniongate_http_requests_total{endpoint="metrics",method="GET",status="200"} 1' \
+        in scrape(client)
+
+
+def test_failed_requests_are_counted(app, client):
+    def fail():
+        raise RuntimeError("Failed")
+    app.add_url_rule('/fail', 'fail', fail)
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+
+    assert client.get('/fail').status_code == 500
+    lines = scrape(client)
+    assert 'oniongate_http_requests_total{endpoint="fail",method="GET",status="500"} 1' in lines
+    assert 'oniongate_http_request_duration_seconds_count{endpoint="fail"} 1' in lines
+
+
+class NoMetricsConfig(TestConfig):
+    METRICS_ENABLED = False
+
+
+def test_metrics_can_be_disabled(app):
+    assert 'metrics' in app.view_functions
+    disabled = create_app('oniongate.test.test_metrics.NoMetricsConfig')
+    assert 'metrics' not in disabled.view_functions
+    assert disabled.before_request_funcs.get(None) is None
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import logging
+
+import pytest
+
+from oniongate import create_app, dns, profiler
+from oniongate.models import db, Domain, Proxy, Record
+from oniongate.settings import TestConfig
+
+
+def add_domains(count):
+    for i in range(count):
+        domain = Domain.create(domain_name='domain{}.oniongate.com'.format(i),
+                               zone='oniongate.com', onion_address='{:a<16}.onion'.format(i))
+        Record.create(domain=domain, label='@', record_type='TXT', value='record {}'.format(i))
+
+
+def test_statement_shape():
+    assert profiler.statement_shape(
+        "SELECT * FROM domains\n  WHERE id IN (?, ?, ?) AND name = 'it''s' LIMIT 10") == \
+        "SELECT * FROM domains WHERE id IN (?...) AND name = ? LIMIT ?"
+    assert profiler.statement_shape("SELECT anon_1.x FROM t WHERE a = %(a_1)s AND b = :b") == \
+        "SELECT anon_1.x FROM t WHERE a = ? AND b = ?"
+
+
+def test_lazy_loads_are_flagged(app):
+    add_domains(6)
+    with profiler.profile('lazy') as query_profile:
+        for domain in Domain.query.all():
+            len(domain.records)
+    assert query_profile.queries == 7
+    [suspect] = query_profile.n_plus_one()
+    assert suspect.count == 6 and 'FROM records' in suspect.shape
+    assert 'likely N+1: 6x' in query_profile.report()
+    assert len(suspect.parameters) == profiler.DEFAULT_N_PLUS_ONE_THRESHOLD
+
+    # The same lookup repeated with the same parameters is not an N+1
+    with profiler.profile('repeated') as query_profile:
+        for _ in range(6):
+            db.session.query(Domain.id).filter_by(domain_name='domain0.oniongate.com').all()
+    assert len(query_profile.repeated()) == 1 and query_profile.n_plus_one() == []
+
+
+def test_endpoint_query_budgets(app, client, query_budget):
+    add_domains(10)
+    Proxy.create(ip_address='198.51.99.1', ip_type='4', online=True)
+    with open(os.path.join(app.config['zone_dir'], 'base_zone.j2'), 'w') as f:
+        f.write("$ORIGIN {{ origin }}.\n@ IN SOA ns1 admin ( 1 7200 3600 1209600 3600 )\n")
+
+    with query_budget(2):
+        assert client.get('/api/v1/domains').status_code == 200
+    with query_budget(4):
+        assert client.get('/api/v1/domains/domain1.oniongate.com').status_code == 200
+    with query_budget(3):
+        assert client.get('/api/v1/records/domain1.oniongate.com').status_code == 200
+    with query_budget(2):
+        dns.generate_zone_file('oniongate.com')
+
+    with pytest.raises(profiler.QueryBudgetExceeded) as error:
+        with query_budget(3):
+            [domain.records for domain in Domain.query.all()]
+    assert 'Ran 11 queries, the budget is 3' in str(error.value)
+    with pytest.raises(profiler.QueryBudgetExceeded, match='likely N\\+1'):
+        with query_budget(20):
+            [domain.records for domain in Domain.query.all()]
+
+
+class ProfilerConfig(TestConfig):
+    SQL_PROFILER_ENABLED = True
+    SQL_PROFILER_N_PLUS_ONE_THRESHOLD = 3
+
+
+def test_request_profiles_are_logged(app, caplog):
+    profiled = create_app('oniongate.test.test_profiler.ProfilerConfig')
+    add_domains(3)
+    with caplog.at_level(logging.INFO, logger=profiled.logger.name):
+        profiled.test_client().get('/api/v1/domains')
+    assert 'GET /api/v1/domains: 2 queries' in caplog.text
+    assert profiler.active_profiles() == []
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import socket
+import asyncio
+import socketserver
+import threading
+
+import pytest
+
+from oniongate import proxy_checker
+from oniongate.models import Proxy
+
+
+class HTTPHandler(socketserver.StreamRequestHandler):
+    """
+    Stand-in proxy which answers every request with a HTTP status line
+    """
+    def handle(self):
+        self.rfile.readline()
+        self.wfile.write(b'HTTP/1.0 200 OK\r\n\r\n')
+
+
+@pytest.fixture
+def proxies(app):
+    """
+    Create a working proxy, a closed port and a proxy which never answers
+    """
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), HTTPHandler)
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    silent = socket.socket()
+    silent.bind(('127.0.0.3', port))
+    silent.listen(5)
+
+    app.config['PROXY_CHECK_PORT'] = port
+    app.config['PROXY_CHECK_TIMEOUT'] = 0.5
+    Proxy.create(ip_address='127.0.0.1', ip_type='4')
+    Proxy.create(ip_address='127.0.0.2', ip_type='4', online=True)
+    Proxy.create(ip_address='127.0.0.3', ip_type='4', online=True)
+    yield
+
+    silent.close()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_check_proxies(app, proxies):
+    assert proxy_checker.check_proxies() == (3, 1, 3)
+
+    working = Proxy.query.filter_by(ip_address='127.0.0.1').one()
+    assert working.online and working.updated_since_synced
+    assert working.latency < 0.5
+    assert working.last_succesful_check == working.last_checked
+
+    for ip_address in ['127.0.0.2', '127.0.0.3']:
+        proxy = Proxy.query.filter_by(ip_address=ip_address).one()
+        assert not proxy.online and proxy.updated_since_synced
+        assert proxy.last_checked and proxy.last_succesful_check is None
+
+
+def test_unchanged_proxies_are_not_flagged(app, proxies):
+    proxy_checker.check_proxies()
+    Proxy.query.update({'updated_since_synced': False})
+
+    assert proxy_checker.check_proxies() == (3, 1, 0)
+    assert Proxy.query.filter_by(updated_since_synced=True).count() == 0
+
+
+def test_checks_are_bounded(monkeypatch):
+    in_flight, peak = [0], [0]
+
+    async def probe_proxy(ip_address, port, host):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return True
+
+    monkeypatch.setattr(proxy_checker, 'probe_proxy', probe_proxy)
+    loop = asyncio.new_event_loop()
+    latencies = loop.run_until_complete(proxy_checker.check_all_proxies(
+        ['203.0.113.{}'.format(i) for i in range(20)], 80, 'proxy.oniongate.com', 1, 5))
+    loop.close()
+
+    assert peak[0] == 5
+    assert all(latency is not None for latency in latencies)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import datetime
+from collections import Counter
+
+from oniongate.models import Proxy
+from oniongate.proxy_selection import ProxySelector
+
+
+def test_small_proxy_lists_are_returned_in_order():
+    selector = ProxySelector([('203.0.113.1', '4', 1), ('203.0.113.2', '4', 1),
+                              ('2001:db8::1', '6', 1)], max_answers=2)
+    assert selector.select('4') == ['203.0.113.1', '203.0.113.2']
+    assert selector.select('6') == ['2001:db8::1']
+
+
+def test_selection_is_capped_and_weighted():
+    proxies = [('203.0.113.{}'.format(i), '4', 1) for i in range(1, 10)]
+    proxies.append(('203.0.113.100', '4', 100))
+    selector = ProxySelector(proxies, max_answers=3)
+
+    counts = Counter()
+    for i in range(500):
+        selected = selector.select('4')
+        assert len(selected) == 3 == len(set(selected))
+        counts.update(selected)
+
+    # The heavy proxy is nearly always chosen, the others share the remaining answers
+    assert counts['203.0.113.100'] > 480
+    assert all(counts['203.0.113.{}'.format(i)] > 0 for i in range(1, 10))
+
+
+def test_from_database_skips_stale_and_offline_proxies(app):
+    app.config['PROXY_MAX_ANSWERS'] = 10
+    now = datetime.datetime.utcnow()
+    Proxy.create(ip_address='203.0.113.1', ip_type='4', online=True,
+                 last_succesful_check=now, latency=0.1)
+    Proxy.create(ip_address='203.0.113.2', ip_type='4', online=True,
+                 last_succesful_check=now - datetime.timedelta(days=1))
+    Proxy.create(ip_address='203.0.113.3', ip_type='4', online=False,
+                 last_succesful_check=now)
+    assert ProxySelector.from_database().select('4') == ['203.0.113.1']
+
+    # Stale proxies are still used when there is nothing better
+    Proxy.query.filter_by(ip_address='203.0.113.1').one().update(online=False)
+    assert ProxySelector.from_database().select('4') == ['203.0.113.2']
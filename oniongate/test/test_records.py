@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from oniongate.models import Domain, Record
+
+
+@pytest.fixture
+def domain(client):
+    """
+    Register a domain and return an authenticated batch request helper
+    """
+    response = client.post('/api/v1/domains', data=json.dumps({'domain_name': 'batch'}),
+                           content_type='application/json')
+    headers = {'Authorization': 'Bearer {}'.format(json.loads(response.data)['update_token'])}
+
+    def batch(create=(), delete=()):
+        response = client.post('/api/v1/records/batch.oniongate.com/batch',
+                               data=json.dumps({'create': list(create), 'delete': list(delete)}),
+                               content_type='application/json', headers=headers)
+        return response.status_code, json.loads(response.data)
+    return batch
+
+
+def onion_record(onion_address):
+    return {'label': '_onion', 'type': 'TXT', 'value': 'onion={}'.format(onion_address)}
+
+
+def test_rotate_onion_address(domain):
+    status, result = domain(create=[onion_record('aaaaaaaaaaaaaaaa.onion'),
+                                    {'label': 'www', 'type': 'TXT', 'value': 'hello'}])
+    assert status == 200
+    assert [record['value'] for record in result['created']] == \
+        ['onion=aaaaaaaaaaaaaaaa.onion', 'hello']
+    assert Domain.query.one().onion_address == 'aaaaaaaaaaaaaaaa.onion'
+
+    old_id = result['created'][0]['id']
+    Domain.query.update({'updated_since_synced': False})
+    status, result = domain(create=[onion_record('bbbbbbbbbbbbbbbb.onion')], delete=[old_id])
+    assert status == 200 and result['deleted'] == [old_id]
+
+    domain_row = Domain.query.one()
+    assert domain_row.onion_address == 'bbbbbbbbbbbbbbbb.onion'
+    assert domain_row.service_online and domain_row.updated_since_synced
+    assert sorted(record.value for record in Record.query) == \
+        ['hello', 'onion=bbbbbbbbbbbbbbbb.onion']
+
+    # Removing the last mapping clears the onion address
+    status, result = domain(delete=[record.id for record in Record.query])
+    assert status == 200
+    assert Domain.query.one().onion_address is None
+    assert Record.query.count() == 0
+
+
+def test_batch_is_all_or_nothing(app, domain):
+    status, result = domain(create=[onion_record('aaaaaaaaaaaaaaaa.onion')])
+    record_id = result['created'][0]['id']
+
+    status, result = domain(create=[onion_record('bbbbbbbbbbbbbbbb.onion'),
+                                    {'label': '-bad-', 'type': 'TXT', 'value': 'x'},
+                                    {'label': 'ok', 'type': 'MX', 'value': 'x'}])
+    assert status == 400 and 'create' in result['message']
+
+    status, result = domain(create=[onion_record('bbbbbbbbbbbbbbbb.onion')],
+                            delete=[record_id, record_id + 100])
+    assert status == 404
+
+    app.config['MAX_RECORDS'] = 2
+    status, result = domain(create=[{'label': 'a', 'type': 'TXT', 'value': 'x'},
+                                    {'label': 'b', 'type': 'TXT', 'value': 'x'}])
+    assert status == 403
+    status, result = domain(create=[{'label': 'a', 'type': 'TXT', 'value': 'x'},
+                                    {'label': 'b', 'type': 'TXT', 'value': 'x'}],
+                            delete=[record_id])
+    assert status == 200
+
+    assert Domain.query.one().onion_address is None
+    assert sorted(record.label for record in Record.query) == ['a', 'b']
+
+
+def test_batch_rejects_malformed_fields(domain):
+    status, result = domain(create=[onion_record('aaaaaaaaaaaaaaaa.onion')])
+    record_id = result['created'][0]['id']
+
+    for record in [{'label': 'www', 'type': 'TXT', 'value': 5},
+                   {'label': 'www', 'type': 'TXT', 'value': 'x', 'ttl': 'abc'},
+                   {'label': 'www', 'type': 'TXT', 'value': 'x', 'ttl': True},
+                   {'label': 5, 'type': 'TXT', 'value': 'x'},
+                   {'label': 'www', 'type': ['TXT'], 'value': 'x'}]:
+        status, result = domain(create=[record])
+        assert status == 400 and 'create' in result['message']
+    status, result = domain(delete=[True])
+    assert status == 400 and 'delete' in result['message']
+    assert [record.id for record in Record.query] == [record_id]
+
+    status, result = domain(create=[{'label': 'www', 'type': 'TXT', 'value': 'x',
+                                     'ttl': '300'}])
+    assert status == 200 and result['created'][0]['ttl'] == 300
+
+
+def test_batch_requires_token(client, domain):
+    response = client.post('/api/v1/records/batch.oniongate.com/batch',
+                           data=json.dumps({'create': [onion_record('aaaaaaaaaaaaaaaa.onion')]}),
+                           content_type='application/json')
+    assert response.status_code == 401
+    assert Record.query.count() == 0
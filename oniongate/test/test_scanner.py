@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import socketserver
+import threading
+
+import pytest
+
+from oniongate import scanner
+from oniongate.models import Domain
+
+
+class StubConnector(object):
+    """
+    Connector which answers from a dict of onion address -> reachable instead of using Tor
+    """
+    def __init__(self, services):
+        self.services = services
+        self.checked = []
+        self.in_flight, self.peak = 0, 0
+
+    async def check(self, onion_address, port):
+        self.checked.append(onion_address)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            result = self.services[onion_address]
+            if isinstance(result, Exception):
+                raise result
+            if result is None:
+                await asyncio.sleep(10)
+            return result
+        finally:
+            self.in_flight -= 1
+
+
+@pytest.fixture
+def domains(app):
+    app.config['SCANNER_TIMEOUT'] = 0.2
+    for name in ['up', 'down', 'slow', 'broken']:
+        Domain.create(domain_name='{}.oniongate.com'.format(name), zone='oniongate.com',
+                      onion_address='{}xxxxxxxxxxxx.onion'.format(name))
+    Domain.create(domain_name='nothing.oniongate.com', zone='oniongate.com')
+    return StubConnector({'upxxxxxxxxxxxx.onion': True, 'downxxxxxxxxxxxx.onion': False,
+                          'slowxxxxxxxxxxxx.onion': None,
+                          'brokenxxxxxxxxxxxx.onion': scanner.ScannerError("no Tor")})
+
+
+def test_scan_domains(app, domains):
+    counts = scanner.scan_domains(domains)
+    assert counts == {'online': 1, 'offline': 2, 'failed': 1}
+
+    up = Domain.query.filter_by(domain_name='up.oniongate.com').one()
+    assert up.service_online and up.service_last_online == up.service_last_checked
+
+    for name in ['down', 'slow']:
+        domain = Domain.query.filter_by(domain_name='{}.oniongate.com'.format(name)).one()
+        assert not domain.service_online and domain.service_last_online is None
+        assert domain.service_last_checked
+
+    # A failed check leaves the domain to be scanned again on the next run
+    broken = Domain.query.filter_by(domain_name='broken.oniongate.com').one()
+    assert broken.service_last_checked is None
+    assert scanner.scan_domains(domains) == {'online': 0, 'offline': 0, 'failed': 1}
+
+
+def test_rescans_are_spread_out(app, domains):
+    app.config['SCANNER_MAX_DOMAINS_PER_RUN'] = 2
+    scanner.scan_domains(domains)
+    scanner.scan_domains(domains)
+    assert len(domains.checked) == 4
+    assert len(set(domains.checked)) == 4
+
+    # Nothing is due again until the rescan interval has passed
+    domains.checked = []
+    domains.services['brokenxxxxxxxxxxxx.onion'] = True
+    scanner.scan_domains(domains)
+    assert domains.checked == ['brokenxxxxxxxxxxxx.onion']
+
+    Domain.query.filter_by(domain_name='down.oniongate.com').update(
+        {'service_last_checked': datetime.datetime.utcnow() - datetime.timedelta(days=1)})
+    domains.checked = []
+    scanner.scan_domains(domains)
+    assert domains.checked == ['downxxxxxxxxxxxx.onion']
+
+
+def test_scans_are_bounded_and_batched(app, monkeypatch):
+    saved = []
+    monkeypatch.setattr(scanner, 'save_scan_results', saved.append)
+    connector = StubConnector({'{}.onion'.format(i): i % 2 == 0 for i in range(1000)})
+    domain_scanner = scanner.DomainScanner(connector, concurrency=50, timeout=5, port=80,
+                                           batch_size=300)
+
+    loop = asyncio.new_event_loop()
+    try:
+        counts = loop.run_until_complete(domain_scanner.scan(
+            [(i, '{}.onion'.format(i)) for i in range(1000)]))
+    finally:
+        loop.close()
+
+    assert counts == {'online': 500, 'offline': 500, 'failed': 0}
+    assert connector.peak == 50
+    assert [len(batch) for batch in saved] == [300, 300, 300, 100]
+
+
+class SocksHandler(socketserver.BaseRequestHandler):
+    """
+    Stand-in SOCKS5 port which can only reach one onion address
+    """
+    def handle(self):
+        assert self.request.recv(3) == b'\x05\x01\x00'
+        self.request.sendall(b'\x05\x00')
+        request = self.request.recv(262)
+        host = request[5:5 + request[4]]
+        reply = 0 if host == b'reachablexxxxxxx.onion' else 4
+        self.request.sendall(bytes([5, reply, 0, 1, 0, 0, 0, 0, 0, 0]))
+
+
+def test_socks_connector():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SocksHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    connector = scanner.SocksConnector(*server.server_address)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(connector.check('reachablexxxxxxx.onion', 80))
+        assert not loop.run_until_complete(connector.check('missingxxxxxxxxx.onion', 80))
+    finally:
+        loop.close()
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    # The scan is not counted as offline when Tor itself cannot be reached
+    with pytest.raises(scanner.ScannerError):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(connector.check('reachablexxxxxxx.onion', 80))
+        finally:
+            loop.close()
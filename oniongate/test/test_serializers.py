@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import json
+import datetime
+
+import pytest
+from flask_restful import marshal
+from flask_restful.representations.json import output_json
+
+from oniongate.models import Domain, Proxy, Record
+from oniongate.resources.domains import domain_fields, domain_serializer
+from oniongate.resources.proxies import proxy_fields, proxy_serializer
+from oniongate.resources.records import record_fields, record_serializer
+
+
+@pytest.fixture
+def rows(app):
+    domain = Domain.create(domain_name='ünicode.oniongate.com', zone='oniongate.com',
+                           onion_address='abcdefghijklmnop.onion', service_online=True,
+                           service_last_online=datetime.datetime(2017, 1, 2, 3, 4, 5, 678))
+    Domain.create(domain_name='empty.oniongate.com', zone='oniongate.com')
+    Record.create(domain=domain, label='www', ttl=60, record_type='TXT',
+                  value='say "hi"\\ ☃')
+    Record.create(domain=domain, label='@', record_type='A', value='127.0.0.1')
+    Proxy.create(ip_address='127.0.0.1', ip_type='4', online=True,
+                 last_checked=datetime.datetime(2017, 1, 1))
+    Proxy.create(ip_address='::1', ip_type='6')
+
+
+def expected_output(objects, field_map):
+    return output_json(marshal(objects, field_map), 200).get_data(as_text=True)
+
+
+@pytest.mark.parametrize('model,field_map,serializer', [
+    (Domain, domain_fields, domain_serializer),
+    (Record, record_fields, record_serializer),
+    (Proxy, proxy_fields, proxy_serializer),
+])
+def test_output_matches_marshal(app, rows, model, field_map, serializer):
+    objects = model.query.order_by(model.id).all()
+    selected = model.query.order_by(model.id).with_entities(*serializer.columns).all()
+
+    assert serializer.response(selected, compact=False).get_data(as_text=True) == \
+        expected_output(objects, field_map)
+    assert serializer.dumps([]) == '[]'
+
+    compact = serializer.dumps(selected, compact=True)
+    assert json.loads(compact) == marshal(objects, field_map)
+    assert ', ' not in compact and '\n' not in compact
+    assert [json.loads(item) for item in serializer.dumps_items(selected)] == \
+        marshal(objects, field_map)
+
+    app.config['RESTFUL_JSON'] = {'indent': 2, 'sort_keys': True, 'ensure_ascii': False}
+    assert serializer.response(selected, compact=False).get_data(as_text=True) == \
+        expected_output(objects, field_map)
+
+
+def test_list_endpoints(client, rows):
+    response = client.get('/api/v1/proxies')
+    assert response.mimetype == 'application/json'
+    assert [proxy['ip_address'] for proxy in json.loads(response.data)] == ['127.0.0.1', '::1']
+
+    response = client.get('/api/v1/records/ünicode.oniongate.com')
+    assert [record['label'] for record in json.loads(response.data)] == ['www', '@']
+
+    response = client.get('/api/v1/domains?compact=true')
+    assert b'\n' not in response.data.strip()
+    assert len(json.loads(response.data)) == 2
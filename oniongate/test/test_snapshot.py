@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import json
+
+import pytest
+
+from oniongate import snapshot
+from oniongate.models import Change, Domain
+
+
+def add_domain(domain_name, onion_address=None, **kwargs):
+    domain = Domain.create(domain_name=domain_name, zone='oniongate.com',
+                           onion_address=onion_address, **kwargs)
+    Change.log('domain', 'create', domain_name)
+    return domain
+
+
+def test_snapshot_lookup():
+    mappings = sorted([('{}.oniongate.com'.format(name), '{:a<16}.onion'.format(name))
+                       for name in ['first', 'second', 'third', 'b', 'zeta']] +
+                      [('v3.example.org', '{:b<56}.onion'.format('v'))])
+    buffer = io.BytesIO()
+    snapshot.write_snapshot(buffer, 42, mappings)
+    data = buffer.getvalue()
+
+    reader = snapshot.Snapshot(data)
+    assert reader.version == 42 and len(reader) == 6
+    assert list(reader.items()) == mappings
+    for domain_name, onion_address in mappings:
+        assert reader.lookup(domain_name.upper() + '.') == onion_address
+    assert reader.lookup('missing.oniongate.com') is None
+    assert reader.lookup('a.oniongate.com') is None
+
+    # Each mapping takes 6 bytes of index with the name and onion label
+    assert len(data) == snapshot.SNAPSHOT_HEADER.size + sum(
+        6 + len(name) + len(onion) - len('.onion') for name, onion in mappings)
+
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.Snapshot(b'not a snapshot at all')
+
+
+def test_publish_snapshot_and_deltas(app, client, tmpdir):
+    app.config['SNAPSHOT_DIR'] = str(tmpdir.join('snapshots'))
+    add_domain('first.oniongate.com', 'firstaaaaaaaaaaa.onion')
+    add_domain('second.oniongate.com', 'secondaaaaaaaaaa.onion')
+    add_domain('nomapping.oniongate.com')
+    add_domain('deleted.oniongate.com', 'deletedaaaaaaaaa.onion', deleted=True)
+
+    first = snapshot.publish_snapshot()
+    assert first['count'] == 2 and first['deltas'] == []
+    assert snapshot.publish_snapshot() == first
+
+    path = os.path.join(app.config['SNAPSHOT_DIR'], first['snapshot'])
+    reader = snapshot.Snapshot.open(path)
+    assert reader.version == first['version']
+    assert reader.lookup('first.oniongate.com') == 'firstaaaaaaaaaaa.onion'
+    assert reader.lookup('nomapping.oniongate.com') is None
+    mappings = dict(reader.items())
+
+    second_domain = Domain.query.filter_by(domain_name='second.oniongate.com').one()
+    second_domain.update(onion_address='changedaaaaaaaaa.onion')
+    Change.log('domain', 'update', 'second.oniongate.com')
+    Domain.query.filter_by(domain_name='first.oniongate.com').one().update(deleted=True)
+    Change.log('domain', 'delete', 'first.oniongate.com')
+    add_domain('third.oniongate.com', 'thirdaaaaaaaaaaa.onion')
+
+    second = snapshot.publish_snapshot()
+    assert [(delta['from'], delta['to']) for delta in second['deltas']] == \
+        [(first['version'], second['version'])]
+    # Proxies which just read the old manifest can still download its snapshot
+    assert client.get('/api/v1/snapshots/' + first['snapshot']).status_code == 200
+
+    # The manifest and files are served to proxies, which apply the delta to their copy
+    response = client.get('/api/v1/snapshots')
+    assert json.loads(response.data) == second
+    response = client.get('/api/v1/snapshots/' + second['deltas'][0]['file'])
+    assert response.status_code == 200 and response.headers['ETag']
+    assert snapshot.apply_delta(mappings, response.data) == second['version']
+
+    response = client.get('/api/v1/snapshots/' + second['snapshot'])
+    assert mappings == dict(snapshot.Snapshot(response.data).items()) == {
+        'second.oniongate.com': 'changedaaaaaaaaa.onion',
+        'third.oniongate.com': 'thirdaaaaaaaaaaa.onion',
+    }
+    assert client.get('/api/v1/snapshots/../test.db').status_code == 404
+
+    # The old snapshot is removed by the publish after
+    add_domain('fourth.oniongate.com', 'fourthaaaaaaaaaa.onion')
+    snapshot.publish_snapshot()
+    assert not os.path.exists(path)
+    assert os.path.exists(os.path.join(app.config['SNAPSHOT_DIR'], second['snapshot']))
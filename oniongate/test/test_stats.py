@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from oniongate import stats
+from oniongate.models import Domain, Proxy
+
+
+def create_network():
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com',
+                  onion_address='abcdefghijklmnop.onion', service_online=True)
+    Domain.create(domain_name='second.oniongate.com', zone='oniongate.com')
+    Domain.create(domain_name='deleted.oniongate.com', zone='oniongate.com', deleted=True,
+                  service_online=True)
+    Proxy.create(ip_address='127.0.0.1', ip_type='4', online=True)
+    Proxy.create(ip_address='127.0.0.2', ip_type='4')
+    Proxy.create(ip_address='127.0.0.3', ip_type='4')
+    Proxy.create(ip_address='127.0.0.4', ip_type='4')
+
+
+def test_collect_stats(app):
+    assert stats.collect_stats()['percent_online_domains'] == 0
+
+    create_network()
+    home_stats = stats.collect_stats()
+    assert home_stats['num_domains_issued'] == 2
+    assert home_stats['percent_online_domains'] == 0.5
+    assert home_stats['num_entry_proxies'] == 4
+    assert home_stats['percent_online_proxies'] == 0.25
+    assert [domain['domain_name'] for domain in home_stats['recent_domains']] == \
+        ['first.oniongate.com']
+
+
+def test_stats_are_cached(app, client):
+    create_network()
+    assert stats.home_stats()['num_domains_issued'] == 2
+
+    Domain.create(domain_name='third.oniongate.com', zone='oniongate.com')
+    assert stats.home_stats()['num_domains_issued'] == 2
+
+    stats.invalidate_stats()
+    assert stats.home_stats()['num_domains_issued'] == 3
+
+    # Registering through the API refreshes the stats straight away
+    client.post('/api/v1/domains', data='{"domain_name": "fourth"}',
+                content_type='application/json')
+    assert stats.home_stats()['num_domains_issued'] == 4
+
+    Domain.create(domain_name='fifth.oniongate.com', zone='oniongate.com')
+    app.config['HOME_STATS_CACHE_TTL'] = -1
+    assert stats.home_stats()['num_domains_issued'] == 5
+
+    response = client.get('/')
+    assert b'first.oniongate.com' in response.data
+    assert b'<strong>4 public</strong> entry proxies' in response.data
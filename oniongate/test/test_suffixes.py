@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import json
+import datetime
+
+from oniongate import suffixes
+from oniongate.models import db, Domain
+
+
+def test_public_suffix_list():
+    public_suffixes = suffixes.PublicSuffixList(['uk', 'co.uk', '*.ck', '!www.ck'])
+    assert public_suffixes.is_public_suffix('co.uk') and public_suffixes.is_public_suffix('uk')
+    assert not public_suffixes.is_public_suffix('example.co.uk')
+    assert public_suffixes.public_suffix('www.example.co.uk') == 'co.uk'
+
+    # Wildcards cover every label under the rule, except for the exceptions
+    assert public_suffixes.is_public_suffix('anything.ck')
+    assert public_suffixes.public_suffix('www.anything.ck') == 'anything.ck'
+    assert public_suffixes.public_suffix('www.ck') == 'ck'
+    assert not public_suffixes.is_public_suffix('www.ck')
+
+    # Names matching no rule use their TLD
+    assert public_suffixes.public_suffix('example.unlisted') == 'unlisted'
+    assert not public_suffixes.is_public_suffix('example.unlisted')
+
+
+def test_bundled_public_suffix_list():
+    public_suffixes = suffixes.load_public_suffix_list()
+    assert public_suffixes is suffixes.load_public_suffix_list()
+    assert public_suffixes.is_public_suffix('co.uk') and public_suffixes.is_public_suffix('com')
+    assert not public_suffixes.is_public_suffix('example.com')
+
+
+def test_suffix_trie_remove():
+    trie = suffixes.SuffixTrie(['example.com', 'blog.example.com'])
+    trie.remove('example.com')
+    assert 'www.example.com' not in trie and 'www.blog.example.com' in trie
+    trie.remove('blog.example.com')
+    trie.remove('missing.example.com')
+    assert trie.root == {}
+
+
+def test_ownership_index(app):
+    Domain.create(domain_name='example.org', zone='example.org')
+    Domain.create(domain_name='first.oniongate.com', zone='oniongate.com')
+    index = suffixes.ownership_index()
+    assert index.owner('blog.example.org') == 'example.org'
+    assert index.owner('www.blog.example.org') == 'example.org'
+    assert index.owner('example.org') is None
+    assert index.owner('www.first.oniongate.com') is None
+
+    # Changes made by another process are picked up by the next refresh
+    Domain.query.filter_by(domain_name='example.org').update(
+        {'deleted': True, 'date_updated': datetime.datetime.utcnow()})
+    Domain.create(domain_name='example.net', zone='example.net')
+    db.session.commit()
+    assert index.owner('blog.example.org') == 'example.org'
+    index.refresh()
+    assert index.owner('blog.example.org') is None
+    assert index.owner('blog.example.net') == 'example.net'
+
+
+def test_ownership_index_follows_commits(app):
+    index = suffixes.ownership_index()
+    index.refresh()
+    Domain(domain_name='example.org', zone='example.org').save(commit=False)
+    index.update_after_commit('example.org')
+    assert index.owner('blog.example.org') is None
+    db.session.rollback()
+    db.session.commit()
+    assert index.owner('blog.example.org') is None
+
+    Domain(domain_name='example.org', zone='example.org').save(commit=False)
+    index.update_after_commit('example.org')
+    db.session.commit()
+    assert index.owner('blog.example.org') == 'example.org'
+
+
+def post_domain(client, domain_name):
+    return client.post('/api/v1/domains', data=json.dumps({'domain_name': domain_name}),
+                       content_type='application/json')
+
+
+def test_register_full_domains(app, client):
+    app.config['FQDN_REGISTRATION_CLOSED'] = False
+    response = post_domain(client, 'example.org')
+    assert response.status_code == 200
+    assert json.loads(response.data)['domain_name'] == 'example.org'
+
+    for domain_name in ['co.uk', 'blog.example.org', 'www.blog.example.org']:
+        response = post_domain(client, domain_name)
+        assert response.status_code == 400
+        assert 'domain_name' in json.loads(response.data)['message']
+    assert post_domain(client, 'example.co.uk').status_code == 200
+
+    token = json.loads(post_domain(client, 'example.net').data)['update_token']
+    assert post_domain(client, 'blog.example.net').status_code == 400
+    client.delete('/api/v1/domains/example.net',
+                  headers={'Authorization': 'Bearer {}'.format(token)})
+    assert post_domain(client, 'blog.example.net').status_code == 200
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from oniongate.models import db, mixins, Domain, Record
+from oniongate.test.conftest import post_json
+
+
+def test_request_commits_once(app, client):
+    response = post_json(client, '/api/v1/domains', {'domain_name': 'first'})
+    token = json.loads(response.data)['update_token']
+    assert app.extensions['unit_of_work']['commits'] == 1
+
+    # Creating the record and updating the onion address are committed together
+    response = post_json(client, '/api/v1/records/first.oniongate.com',
+                         {'label': '_onion', 'type': 'TXT',
+                          'value': 'onion=abcdefghijklmnop.onion'},
+                         headers={'Authorization': 'Bearer {}'.format(token)})
+    assert response.status_code == 200
+    assert app.extensions['unit_of_work'] == {'requests': 2, 'commits': 2, 'max_commits': 1}
+
+    db.session.expire_all()
+    assert Domain.query.one().onion_address == 'abcdefghijklmnop.onion'
+
+
+def test_integrity_errors_are_still_422(app, client):
+    post_json(client, '/api/v1/domains', {'domain_name': 'first'})
+    response = post_json(client, '/api/v1/domains', {'domain_name': 'first'})
+    assert response.status_code == 422
+    assert json.loads(response.data)['message'] == \
+        {'domain_name': "Domain first.oniongate.com already exists"}
+
+    # The failed request left the session usable
+    assert Domain.query.count() == 1
+    assert app.extensions['unit_of_work']['commits'] == 1
+
+
+def test_unit_of_work(app):
+    with mixins.unit_of_work():
+        domain = Domain.create(domain_name='first.oniongate.com', zone='oniongate.com')
+        with mixins.unit_of_work():
+            Record.create(domain=domain, label='www', record_type='TXT', value='hello')
+        assert domain.id and db.session.info['pending_commit']
+    assert app.extensions['unit_of_work']['commits'] == 1
+
+    with pytest.raises(RuntimeError):
+        with mixins.unit_of_work():
+            Domain.create(domain_name='second.oniongate.com', zone='oniongate.com')
+            raise RuntimeError
+    assert [domain.domain_name for domain in Domain.query] == ['first.oniongate.com']
+    assert app.extensions['unit_of_work'] == {'requests': 2, 'commits': 1, 'max_commits': 1}
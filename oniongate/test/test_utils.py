@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import pytest
+from itsdangerous import BadSignature
+
+from oniongate import utils
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c'), len(cache)) == (1, 3, 2)
+
+
+def test_verified_tokens_are_cached(app):
+    token = utils.create_jwt({'domain': 'first.oniongate.com'}).decode('utf-8')
+    serializer, verified = utils.jwt_serializer()
+    assert utils.jwt_serializer()[0] is serializer
+
+    assert utils.load_jwt(token) == {'domain': 'first.oniongate.com'}
+    assert verified.get(token) == {'domain': 'first.oniongate.com'}
+
+    # Changing a loaded payload doesn't change the cached copy
+    utils.load_jwt(token)['domain'] = 'second.oniongate.com'
+    assert utils.load_jwt(token) == {'domain': 'first.oniongate.com'}
+
+    with pytest.raises(BadSignature):
+        utils.load_jwt(token[:-2])
+    assert len(verified) == 1
+
+
+def test_rotating_secret_key(app):
+    token = utils.create_jwt({'domain': 'first.oniongate.com'}).decode('utf-8')
+    serializer, verified = utils.jwt_serializer()
+    utils.load_jwt(token)
+
+    app.secret_key = b'rotated-secret-key'
+    assert utils.jwt_serializer()[0] is not serializer
+    with pytest.raises(BadSignature):
+        utils.load_jwt(token)
+
+    new_token = utils.create_jwt({'domain': 'first.oniongate.com'}).decode('utf-8')
+    assert new_token != token
+    assert utils.load_jwt(new_token) == {'domain': 'first.oniongate.com'}
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+
+import pytest
+
+from oniongate import validators
+
+
+def test_suffix_trie():
+    trie = validators.SuffixTrie(['example.com', 'co.uk.'])
+    trie.add('blog.example.com', 'blog')
+    assert 'example.com' in trie and 'www.Example.com' in trie and 'a.b.co.uk' in trie
+    assert 'example.org' not in trie and 'com' not in trie and 'uk' not in trie
+    assert trie.find('www.blog.example.com') == 'blog'
+    assert trie.find('www.example.com') is True
+
+
+def test_domain_name(app):
+    assert validators.domain_name('MySite') == {'label': 'mysite', 'zone': 'oniongate.com'}
+    app.config['FQDN_REGISTRATION_CLOSED'] = False
+    assert validators.domain_name('blog.example.org.') == {'label': None,
+                                                            'zone': 'blog.example.org'}
+
+    for name in ['', 'abc', 'proxy', 'Proxy', '_onion', '-bad-name', '1.2.3.4',
+                 'www.example.org', 'oniongate.com', 'mine.oniongate.com', 'bad_name.org']:
+        with pytest.raises(ValueError):
+            validators.domain_name(name)
+
+
+def test_rules_follow_the_config(app):
+    assert validators.domain_rules() is validators.domain_rules()
+    validators.domain_name('special')
+
+    app.config['DOMAIN_BLACKLIST'] = app.config['DOMAIN_BLACKLIST'] + ['special']
+    with pytest.raises(ValueError):
+        validators.domain_name('special')
+    # Entries replaced in place are picked up once the rules are invalidated
+    app.config['DOMAIN_BLACKLIST'][-1] = 'special2'
+    validators.invalidate_domain_rules()
+    validators.domain_name('special')
+    with pytest.raises(ValueError):
+        validators.domain_name('special2')
+
+    onion_address = 'abcdefghijklmnop.onion'
+    assert validators.onion_address(onion_address) == onion_address
+    app.config['RESTRICTED_ONIONS'] = [onion_address.upper()]
+    assert validators.is_restricted_onion(onion_address)
+    with pytest.raises(ValueError):
+        validators.onion_address(onion_address)
+    with pytest.raises(ValueError):
+        validators.onion_address('abcdefghijklmnopxonion')
+
+
+def test_validate_domain_names(app):
+    assert validators.validate_domain_names(['first', 'no', 'second']) == [
+        ({'label': 'first', 'zone': 'oniongate.com'}, None),
+        (None, "The subdomain must be at least 5 characters long."),
+        ({'label': 'second', 'zone': 'oniongate.com'}, None),
+    ]
+
+
+def uncompiled_is_valid_hostname(hostname):
+    """
+    The hostname check as it was before the patterns were compiled once
+    """
+    def is_valid_label(label):
+        regex = r"(?!-)[A-Z\d\-\_]{1,63}(?<!-)$".replace(r"\_", "")
+        return re.compile(regex, re.IGNORECASE).match(label) is not None
+
+    if len(hostname) > 255 or re.match(r"[\d.]+$", hostname):
+        return False
+    return all(is_valid_label(x) for x in hostname.split("."))
+
+
+def test_benchmark_validation(app):
+    """
+    Compare validating a batch of names against the uncompiled checks
+    """
+    app.config['FQDN_REGISTRATION_CLOSED'] = False
+    app.config['DOMAIN_BLACKLIST'] = ['blocked{}.example.org'.format(i) for i in range(1000)]
+    names = ['site{}.example.org'.format(i) for i in range(5000)] + \
+        ['blocked{}.example.org'.format(i) for i in range(0, 1000, 10)] + ['bad_name.org']
+
+    started = time.perf_counter()
+    expected = [uncompiled_is_valid_hostname(name) and name not in app.config['DOMAIN_BLACKLIST']
+                for name in names]
+    uncompiled = time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = validators.validate_domain_names(names)
+    compiled = time.perf_counter() - started
+
+    assert [error is None for result, error in results] == expected
+    print("Validated {} names: uncompiled {:.3f}s, compiled {:.3f}s".format(
+        len(names), uncompiled, compiled))
+
+
+def test_benchmark_restricted_onions(app):
+    """
+    Compare checking onion addresses against a long RESTRICTED_ONIONS list with a list scan
+    """
+    app.config['RESTRICTED_ONIONS'] = ['{:a>16}.onion'.format(i) for i in range(20000)]
+    onion_addresses = ['{:a>16}.onion'.format(i) for i in range(0, 40000, 200)]
+    restricted = app.config['RESTRICTED_ONIONS']
+
+    started = time.perf_counter()
+    expected = [onion_address in restricted for onion_address in onion_addresses]
+    scanned = time.perf_counter() - started
+
+    validators.is_restricted_onion(onion_addresses[0])
+    started = time.perf_counter()
+    results = [validators.is_restricted_onion(onion_address)
+               for onion_address in onion_addresses]
+    compiled = time.perf_counter() - started
+
+    assert results == expected and sum(results) == 100
+    assert compiled < scanned
+    print("Checked {} onion addresses: list scan {:.3f}s, compiled {:.4f}s".format(
+        len(onion_addresses), scanned, compiled))
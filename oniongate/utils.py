@@ -1,23 +1,89 @@
+import threading
 from functools import wraps
+from collections import OrderedDict
 
 from flask import current_app, request, g
 from flask_restful import abort
 from itsdangerous import JSONWebSignatureSerializer, BadSignature
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
+engine_listeners_lock = threading.Lock()
+
+
+def listen_to_engines(listeners):
+    """
+    Register (event name, function) listeners on every SQLAlchemy engine, once per process
+    """
+    with engine_listeners_lock:
+        for name, listener in listeners:
+            if not event.contains(Engine, name, listener):
+                event.listen(Engine, name, listener)
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping which forgets the least recently used keys beyond `max_size`
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def jwt_serializer():
+    """
+    Return the JWT serializer and verified token cache for the current secret key
+
+    Both are built once per app and replaced when the secret key changes, so tokens
+    verified with an old key are not trusted after the key is rotated.
+    """
+    secret_key, serializer, verified = current_app.extensions.get('jwt', (None, None, None))
+    if serializer is None or secret_key != current_app.secret_key:
+        secret_key = current_app.secret_key
+        serializer = JSONWebSignatureSerializer(secret_key, algorithm_name='HS256')
+        verified = LRUCache(current_app.config["JWT_CACHE_SIZE"])
+        current_app.extensions['jwt'] = (secret_key, serializer, verified)
+    return serializer, verified
 
 def create_jwt(payload):
     """
     Create a signed JSON Web Token
     """
-    serializer = JSONWebSignatureSerializer(current_app.secret_key, algorithm_name='HS256')
+    serializer, verified = jwt_serializer()
     return serializer.dumps(payload)
 
 def load_jwt(token):
     """
     Verify and load a signed JSON Web Token
+
+    Tokens which were verified recently are loaded from the cache without checking the
+    signature again.
     """
-    serializer = JSONWebSignatureSerializer(current_app.secret_key, algorithm_name='HS256')
-    return serializer.loads(token)
+    serializer, verified = jwt_serializer()
+    payload = verified.get(token)
+    if payload is None:
+        payload = serializer.loads(token)
+        verified.set(token, payload)
+    return dict(payload)
 
 def read_auth_header(header_prefix='Bearer'):
     """
@@ -6,12 +6,90 @@ import ipaddress
 
 from flask import current_app
 
+from .suffixes import SuffixTrie, load_public_suffix_list, ownership_index
+
+
+ONION_ADDRESS_RE = re.compile(r"^[a-z0-9]{16}\.onion$")
+LABEL_RE = re.compile(r"(?!-)[A-Z\d\-\_]{1,63}(?<!-)$", re.IGNORECASE)
+# Underscores are not allowed in hostnames
+HOSTNAME_LABEL_RE = re.compile(r"(?!-)[A-Z\d\-]{1,63}(?<!-)$", re.IGNORECASE)
+NUMERIC_RE = re.compile(r"[\d.]+$")
+
+
+class DomainRules(object):
+    """
+    The registration rules from the config, compiled for fast lookups
+    """
+    def __init__(self, config):
+        self.subdomain_host = config["SUBDOMAIN_HOST"].lower()
+        self.min_subdomain_length = config["MIN_SUBDOMAIN_LENGTH"]
+        self.fqdn_registration_closed = config.get("FQDN_REGISTRATION_CLOSED")
+        self.blacklisted_labels = frozenset(name.lower() for name in config["DOMAIN_BLACKLIST"])
+        self.blacklisted_domains = SuffixTrie(config["DOMAIN_BLACKLIST"])
+        self.restricted_onions = frozenset(onion_address.lower() for onion_address
+                                           in config["RESTRICTED_ONIONS"])
+        self.public_suffixes = load_public_suffix_list(config.get("PUBLIC_SUFFIX_LIST"))
+        # Keep the lists alive so their ids in the config key can't be reused by new lists
+        self.source_lists = (config["DOMAIN_BLACKLIST"], config["RESTRICTED_ONIONS"])
+
+    @staticmethod
+    def config_key(config):
+        """
+        Identify the config values the rules were compiled from
+
+        The lists are identified by their id and length, so checking the key stays cheap
+        however long they are. Replace the lists to change them, or call
+        `invalidate_domain_rules` after replacing an entry in place.
+        """
+        return (config["SUBDOMAIN_HOST"], config["MIN_SUBDOMAIN_LENGTH"],
+                config.get("FQDN_REGISTRATION_CLOSED"), config.get("PUBLIC_SUFFIX_LIST"),
+                id(config["DOMAIN_BLACKLIST"]), len(config["DOMAIN_BLACKLIST"]),
+                id(config["RESTRICTED_ONIONS"]), len(config["RESTRICTED_ONIONS"]))
+
+
+def domain_rules():
+    """
+    Return the compiled registration rules of the current app, recompiling them when the
+    config changes
+    """
+    key = DomainRules.config_key(current_app.config)
+    cached_key, rules = current_app.extensions.get('domain_rules', (None, None))
+    if cached_key != key:
+        rules = DomainRules(current_app.config)
+        current_app.extensions['domain_rules'] = (key, rules)
+    return rules
+
+
+def invalidate_domain_rules():
+    """
+    Recompile the registration rules of the current app on their next use
+    """
+    current_app.extensions.pop('domain_rules', None)
+
 
 def is_onion_address(onion_address):
     """
     Return onion_address if valid, otherwise return false.
     """
-    return re.match(r"^[a-z0-9]{16}.onion$", onion_address) is not None
+    return ONION_ADDRESS_RE.match(onion_address) is not None
+
+
+def is_restricted_onion(onion_address):
+    """
+    Check if an onion address is listed in RESTRICTED_ONIONS
+    """
+    return onion_address.lower() in domain_rules().restricted_onions
+
+
+def onion_address(onion_address_str):
+    """
+    Validate an onion address which may be mapped to a domain
+    """
+    if not is_onion_address(onion_address_str):
+        raise ValueError("{} is not a valid onion address".format(onion_address_str))
+    if is_restricted_onion(onion_address_str):
+        raise ValueError("The onion address {} is not allowed".format(onion_address_str))
+    return onion_address_str
 
 
 def label(label):
@@ -25,10 +103,8 @@ def is_valid_label(label, hostname=False):
     """
     Validate a DNS label
     """
-    regex = "(?!-)[A-Z\d\-\_]{1,63}(?<!-)$"
-    if hostname:
-        regex = regex.replace("\_", "") # Underscores are not allowed in hostnames
-    return re.compile(regex, re.IGNORECASE).match(label) is not None
+    regex = HOSTNAME_LABEL_RE if hostname else LABEL_RE
+    return regex.match(label) is not None
 
 
 def is_valid_hostname(hostname):
@@ -39,15 +115,22 @@ def is_valid_hostname(hostname):
         return False
 
     # must be not all-numeric, so that it can't be confused with an IP address
-    if re.match(r"[\d.]+$", hostname):
+    if NUMERIC_RE.match(hostname):
         return False
 
-    return all(is_valid_label(x, hostname=True) for x in hostname.split("."))
+    match_label = HOSTNAME_LABEL_RE.match
+    return all(match_label(x) is not None for x in hostname.split("."))
 
 def domain_name(domain_name_str):
     """
     Return the label and zone if valid, raise an exception in any other case.
     """
+    return parse_domain_name(domain_name_str, domain_rules())
+
+def parse_domain_name(domain_name_str, rules):
+    """
+    Validate a domain name against compiled registration rules
+    """
     if not domain_name_str:
         raise ValueError("You must specify a domain name")
 
@@ -63,18 +146,17 @@ def domain_name(domain_name_str):
 
         # We enforce a minimum subdomain length to avoid subdomains like
         # wwww. or mail. being registered.
-        min_subdomain_len = current_app.config["MIN_SUBDOMAIN_LENGTH"]
-        if len(domain_name_str) < min_subdomain_len:
+        if len(domain_name_str) < rules.min_subdomain_length:
             raise ValueError("The subdomain must be at least {} "
-                             "characters long.".format(min_subdomain_len))
+                             "characters long.".format(rules.min_subdomain_length))
 
-        if domain_name_str in current_app.config["DOMAIN_BLACKLIST"]:
+        if domain_name_str.lower() in rules.blacklisted_labels:
             raise ValueError("This subdomain is not allowed")
 
         # This looks like a valid subdomain, return the label and zone.
         return {
                 'label': domain_name_str.lower(),
-                'zone' : current_app.config["SUBDOMAIN_HOST"].lower()
+                'zone' : rules.subdomain_host
         }
 
     else:
@@ -86,25 +168,46 @@ def domain_name(domain_name_str):
         if domain_name_str.startswith("www."):
             raise ValueError("The domain name should not include the www. label")
 
-        if current_app.config.get("FQDN_REGISTRATION_CLOSED"):
-            # XXX: It's important not to let other users register a subdomain on someone else's
-            #      domain. But we also need to prevent users from trying to register domains
-            #      such as co.uk which would all registrations for that TLD.
-
-            # I'm going to disable automatic registration of FQDN for now. We can add domains
-            # manually.
+        if rules.fqdn_registration_closed:
             raise ValueError("It is not possible to register a full domain at the present time. "
                              "Please choose a sub-domain or contact the administrators")
 
-        if domain_name_str in current_app.config["DOMAIN_BLACKLIST"]:
+        # Blacklisted domains also cover all of their subdomains
+        if domain_name_str in rules.blacklisted_domains:
             raise ValueError("The domain is not allowed")
 
+        # Domains such as co.uk would capture all the registrations under them
+        if rules.public_suffixes.is_public_suffix(domain_name_str):
+            raise ValueError("{} is a public suffix and cannot be registered".format(
+                domain_name_str))
+
+        # Don't let users register a domain inside someone else's zone
+        owner = ownership_index().owner(domain_name_str)
+        if owner:
+            raise ValueError("{} is inside {} which is already registered".format(
+                domain_name_str, owner))
+
         # This FQDN is at the root of a zone, the label is None
         return {
                 'label': None,
                 'zone' : domain_name_str.lower()
         }
 
+def validate_domain_names(domain_names):
+    """
+    Validate many domain names at once, such as for an import
+
+    Returns a list with a (result, None) or (None, error message) tuple for each name.
+    """
+    rules = domain_rules()
+    results = []
+    for domain_name_str in domain_names:
+        try:
+            results.append((parse_domain_name(domain_name_str, rules), None))
+        except ValueError as e:
+            results.append((None, str(e)))
+    return results
+
 def ip_address(ip_address_str):
     """
     Validate that an address is a valid public IPv4 or IPv6 address.